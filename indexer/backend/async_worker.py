@@ -0,0 +1,273 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import sys
+import time
+import traceback
+
+import aiohttp
+from rq import Queue
+from rq.exceptions import DequeueTimeout
+from rq.job import JobStatus
+from rq.registry import StartedJobRegistry, clean_registries
+from rq.utils import utcformat, utcnow
+
+from . import worker
+from .. import ratelimit
+from ..structures import QueuedImage
+from ..tag_dict import get_tag_dictionary
+
+PROCESS_FUNC = "indexer.backend.worker.process_queued_image"
+PROCESS_BATCH_FUNC = "indexer.backend.worker.process_queued_images"
+PROCESS_PACKED_FUNC = "indexer.backend.worker.process_packed_image"
+PROCESS_PACKED_BATCH_FUNC = "indexer.backend.worker.process_packed_images"
+
+# started jobs stay in the StartedJobRegistry for this long past their
+# timeout, after which a registry cleanup moves them to the failed registry
+STARTED_TTL_MARGIN = 60
+
+# how often this worker cleans the queue's registries, as RQ workers do
+REGISTRY_CLEAN_INTERVAL = 600
+
+
+def unpack_images(payloads):
+    tag_dict = get_tag_dictionary(worker.REDIS)
+    return [QueuedImage.unpack(data, tag_dict) for data in payloads]
+
+
+async def fetch_image(session, limiter, url):
+    """Download an image file into memory."""
+    await limiter.acquire_async(url)
+
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        return await resp.read()
+
+
+class AsyncIndexer(object):
+    """Processes `backend-index` jobs concurrently.
+
+    Downloads run concurrently on an event loop (subject to the shared
+    per-host rate limits), hashing and thumbnail rendering run on a process
+    pool, and index reads and writes (deduplication and saving) run on a
+    single thread, since the index write path and snowflake generation
+    assume one writer per worker ID. Blocking dequeues, and jobs for other
+    functions (which don't write to the index), run on threads of their own
+    so they never hold up index writes.
+
+    As with RQ workers, jobs are recorded in the queue's
+    StartedJobRegistry while they run, and fail once they exceed their
+    timeout. Jobs left behind by a crashed worker are moved to the failed
+    registry when their registry entry expires.
+
+    Args:
+        concurrency (int): Maximum number of jobs in progress at once.
+        limiter (RateLimiter): The per-host rate limiter for downloads.
+            Defaults to the module-level limiter from `indexer.ratelimit`.
+        n_hash_procs (int): Number of hashing and thumbnailing processes.
+    """
+
+    def __init__(self, concurrency=32, limiter=None, n_hash_procs=None):
+        self.concurrency = concurrency
+        self.limiter = limiter if limiter is not None else ratelimit.LIMITER
+
+        self.redis_executor = ThreadPoolExecutor(max_workers=1)
+        self.dequeue_executor = ThreadPoolExecutor(max_workers=1)
+        self.perform_executor = ThreadPoolExecutor(max_workers=1)
+        self.hash_executor = ProcessPoolExecutor(max_workers=n_hash_procs)
+
+        self.queue = Queue("backend-index", connection=worker.REDIS)
+        self.started_registry = StartedJobRegistry(
+            queue=self.queue, connection=worker.REDIS
+        )
+        self.n_processed = 0
+        self.last_cleaned_at = None
+
+    async def _redis_call(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.redis_executor, fn, *args)
+
+    async def _dequeue_call(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.dequeue_executor, fn, *args)
+
+    async def process(self, session, queued_image):
+        if await self._redis_call(worker.is_already_indexed, queued_image):
+            return
+
+        data = await fetch_image(session, self.limiter, queued_image.source_url)
+
+        loop = asyncio.get_event_loop()
+        imhash = await loop.run_in_executor(
+            self.hash_executor, worker.hash_image_data, data
+        )
+
+        indexed_img = await self._redis_call(
+            worker.index_image, queued_image, imhash, data
+        )
+
+        if worker.needs_thumbnails(indexed_img):
+            rendered_thumbnails = await loop.run_in_executor(
+                self.hash_executor, worker.thumbnail_image_data, data
+            )
+            await self._redis_call(
+                worker.cache_thumbnails, indexed_img, rendered_thumbnails
+            )
+
+    async def process_batch(self, session, queued_images):
+        results = await asyncio.gather(
+            *(self.process(session, q) for q in queued_images), return_exceptions=True
+        )
+
+        failed = [
+            q.source_site + "#" + q.source_id
+            for q, r in zip(queued_images, results)
+            if isinstance(r, Exception)
+        ]
+
+        if len(failed) > 0:
+            raise RuntimeError(
+                "Failed to process {:d} of {:d} images: {}".format(
+                    len(failed), len(queued_images), ", ".join(failed)
+                )
+            )
+
+    def _job_timeout(self, job):
+        """Get a job's timeout in seconds, or `None` if it has none."""
+        timeout = job.timeout if job.timeout is not None else Queue.DEFAULT_TIMEOUT
+
+        if timeout < 0:
+            return None
+
+        return timeout
+
+    def _start_job(self, job):
+        timeout = self._job_timeout(job)
+
+        tr = worker.REDIS.pipeline()
+        self.started_registry.add(
+            job, timeout + STARTED_TTL_MARGIN if timeout is not None else -1, tr
+        )
+        job.set_status(JobStatus.STARTED, pipeline=tr)
+        tr.hset(job.key, "started_at", utcformat(utcnow()))
+        tr.execute()
+
+    def _finish_job(self, job, exc_string=None):
+        tr = worker.REDIS.pipeline()
+        self.started_registry.remove(job, pipeline=tr)
+
+        if exc_string is None:
+            job.delete(pipeline=tr)
+        else:
+            job.set_status(JobStatus.FAILED, pipeline=tr)
+            self.queue.failed_job_registry.add(job, exc_string=exc_string, pipeline=tr)
+
+        tr.execute()
+
+    async def _perform(self, session, job):
+        if job.func_name == PROCESS_FUNC:
+            await self.process(session, *job.args, **job.kwargs)
+        elif job.func_name == PROCESS_BATCH_FUNC:
+            await self.process_batch(session, *job.args, **job.kwargs)
+        elif job.func_name == PROCESS_PACKED_FUNC:
+            (queued_image,) = await self._redis_call(unpack_images, job.args)
+            await self.process(session, queued_image)
+        elif job.func_name == PROCESS_PACKED_BATCH_FUNC:
+            queued_images = await self._redis_call(unpack_images, job.args[0])
+            await self.process_batch(session, queued_images)
+        else:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self.perform_executor, job.perform)
+
+    async def run_job(self, session, job, slots):
+        exc_string = None
+        timeout = self._job_timeout(job)
+
+        try:
+            # jobs run on other threads can't be interrupted, but still fail
+            # once they time out
+            await asyncio.wait_for(self._perform(session, job), timeout)
+        except asyncio.TimeoutError:
+            exc_string = "Job exceeded maximum timeout value ({:d} seconds)".format(
+                int(timeout)
+            )
+            print("Job {} failed: {}".format(job.id, exc_string))
+        except Exception:
+            exc_string = traceback.format_exc()
+            print("Job {} failed:\n{}".format(job.id, exc_string))
+        finally:
+            await self._redis_call(self._finish_job, job, exc_string)
+            self.n_processed += 1
+            slots.release()
+
+    def _dequeue(self, timeout):
+        if (
+            self.last_cleaned_at is None
+            or time.monotonic() - self.last_cleaned_at > REGISTRY_CLEAN_INTERVAL
+        ):
+            clean_registries(self.queue)
+            self.last_cleaned_at = time.monotonic()
+
+        try:
+            result = Queue.dequeue_any([self.queue], timeout, connection=worker.REDIS)
+        except DequeueTimeout:
+            return None
+
+        if result is None:
+            return None
+
+        job, _ = result
+        self._start_job(job)
+
+        return job
+
+    async def run(self, burst=False):
+        """Pull and process jobs until the queue is empty (in burst mode) or
+        forever.
+        """
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            while True:
+                await slots.acquire()
+
+                job = await self._dequeue_call(self._dequeue, None if burst else 5)
+                if job is None:
+                    slots.release()
+
+                    if burst:
+                        break
+                    continue
+
+                task = asyncio.ensure_future(self.run_job(session, job, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if len(tasks) > 0:
+                await asyncio.wait(tasks)
+
+
+def main():
+    # jobs for other functions (such as `cache_saved_image`) use the shared
+    # requests session; image downloads go through aiohttp
+    worker.init(
+        sys.argv[1],
+        sys.argv[2],
+        sys.argv[3],
+        int(sys.argv[4]),
+        pool_size=worker.parse_pool_size(sys.argv[5:]),
+    )
+
+    args = [a for a in sys.argv[5:] if not a.startswith("--")]
+    concurrency = int(args[0]) if len(args) > 0 else 32
+    indexer = AsyncIndexer(concurrency=concurrency)
+
+    print(
+        "Async backend worker {:d} ({:d}) running with concurrency {:d}".format(
+            worker.WORKER_ID, os.getpid(), concurrency
+        )
+    )
+
+    asyncio.get_event_loop().run_until_complete(indexer.run())
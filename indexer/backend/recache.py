@@ -0,0 +1,190 @@
+import asyncio
+import os
+import os.path as osp
+import secrets
+import time
+
+import aiofiles
+import aiohttp
+
+from .. import ratelimit
+from ..structures import IndexedImage
+
+LOAD_BATCH_SIZE = 500
+DOWNLOAD_CHUNK_SIZE = 2 ** 16
+
+# concurrent downloads in total, and from any one host
+CONCURRENCY = 32
+PER_HOST_CONCURRENCY = 8
+
+
+class RecacheStats(object):
+    """Progress counters for a bulk recache."""
+
+    def __init__(self, total):
+        self.total = total
+        self.checked = 0
+        self.cached = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+
+    def format(self):
+        elapsed = time.perf_counter() - self.start
+
+        return (
+            "{:d} / {:d} checked, {:d} already cached, {:d} downloaded, "
+            "{:d} failed ({:.1f} MiB, {:.2f} MiB/s)"
+        ).format(
+            self.checked,
+            self.total,
+            self.cached,
+            self.downloaded,
+            self.failed,
+            self.bytes / 2 ** 20,
+            self.bytes / 2 ** 20 / elapsed if elapsed > 0 else 0,
+        )
+
+
+def cached_filenames(cache_dir):
+    """List the image cache directory once, as a set of filenames."""
+    return set(os.listdir(cache_dir))
+
+
+async def download_to_cache(session, limiter, url, path):
+    """Download an image into the cache, via a temporary file so that
+    partially-downloaded files are never visible under their final name.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    await limiter.acquire_async(url)
+
+    n_bytes = 0
+
+    # uniquely named, like the API's and thumbnail writers' temporary files,
+    # so concurrent downloads of the same image can't clobber each other's
+    tmp_path = "{}.{}.part".format(path, secrets.token_hex(4))
+
+    try:
+        async with session.get(url) as resp:
+            resp.raise_for_status()
+
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+                    n_bytes += len(chunk)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        if osp.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return n_bytes
+
+
+async def recache_images(
+    redis,
+    app_redis,
+    cache_dir,
+    img_ids,
+    concurrency=None,
+    limiter=None,
+    progress=None,
+):
+    """Download every listed image that is missing from the image cache.
+
+    Image metadata is loaded `LOAD_BATCH_SIZE` images at a time with
+    pipelined loads, and cached files are found with a single directory
+    listing. Downloads run concurrently, subject to the shared per-host rate
+    limits and to `PER_HOST_CONCURRENCY` connections per host.
+
+    Args:
+        redis (redis.Redis): The index Redis interface.
+        app_redis (redis.Redis): The API server's Redis interface, where
+            cached files are registered in `img_cache:live`.
+        cache_dir (str): The image cache directory.
+        img_ids (list): The images to recache.
+        concurrency (int): Maximum number of downloads in progress at once;
+            defaults to `CONCURRENCY`.
+        limiter (RateLimiter): The per-host rate limiter for downloads.
+            Defaults to the module-level limiter from `indexer.ratelimit`.
+        progress (callable): Called with a `RecacheStats` after each batch.
+
+    Returns:
+        RecacheStats: The final counters.
+    """
+    if concurrency is None:
+        concurrency = CONCURRENCY
+
+    if limiter is None:
+        limiter = ratelimit.LIMITER
+
+    img_ids = list(img_ids)
+    stats = RecacheStats(len(img_ids))
+    cached = cached_filenames(cache_dir)
+
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+    live = {}
+
+    async def fetch(session, indexed_image, path):
+        try:
+            n_bytes = await download_to_cache(
+                session, limiter, indexed_image.source_url, path
+            )
+            stats.bytes += n_bytes
+            stats.downloaded += 1
+            live[path] = int(time.time() * 1000)
+        except Exception as e:
+            stats.failed += 1
+            print("Failed to cache image {:d}: {}".format(indexed_image.img_id, e))
+        finally:
+            slots.release()
+
+    def flush_live():
+        if len(live) > 0:
+            app_redis.zadd("img_cache:live", live)
+            live.clear()
+
+    connector = aiohttp.TCPConnector(
+        limit=concurrency, limit_per_host=PER_HOST_CONCURRENCY
+    )
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for start in range(0, len(img_ids), LOAD_BATCH_SIZE):
+            batch_ids = img_ids[start : start + LOAD_BATCH_SIZE]
+            stats.checked += len(batch_ids)
+
+            # images missing from the index are skipped
+            for indexed_image in IndexedImage.load_many(redis, batch_ids):
+                if indexed_image.cache_filename in cached:
+                    stats.cached += 1
+                    continue
+
+                path = osp.join(cache_dir, indexed_image.cache_filename)
+
+                await slots.acquire()
+                task = asyncio.ensure_future(fetch(session, indexed_image, path))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            flush_live()
+            if progress is not None:
+                progress(stats)
+
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+
+    flush_live()
+    return stats
+
+
+def character_image_ids(redis, character):
+    """List the IDs of a character's images."""
+    return [
+        img_id.decode("utf-8")
+        for img_id, _ in redis.zscan_iter("index:characters:" + character, count=1000)
+    ]
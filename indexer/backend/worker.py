@@ -3,25 +3,29 @@ import os
 import os.path as osp
 import sys
 import time
+import traceback
 
 from PIL import Image
 from redis import Redis
-import requests
-from rq import Connection, Worker
+from rq import Connection, SimpleWorker
 
+from .. import http, ratelimit, thumbnails
 from ..structures import QueuedImage, IndexedImage
 from ..snowflake import generate_snowflake
 from ..index import compute_image_hash, search_index
+from ..mih import MultiIndexHash
+from ..tag_dict import get_tag_dictionary
 
 REDIS = None
 APP_REDIS = None
 WORKER_ID = None
 IMAGE_CACHE_DIR = None
+HASH_MATRIX = None
 
 
 def download_image(url):
     bio = io.BytesIO()
-    resp = requests.get(url, stream=True)
+    resp = http.get(url, stream=True)
     resp.raise_for_status()
 
     for chunk in resp.iter_content(chunk_size=128):
@@ -33,19 +37,55 @@ def download_image(url):
     return img, bio
 
 
-def process_queued_image(queued_image):
-    global REDIS, APP_REDIS, IMAGE_CACHE_DIR, WORKER_ID
+def hash_image_data(data):
+    """Decode and hash a downloaded image.
+
+    This is a top-level function so it can run in a process pool.
+    """
+    img = Image.open(io.BytesIO(data))
+    img.load()
+
+    return compute_image_hash(img)
+
+
+def thumbnail_image_data(data):
+    """Decode a downloaded image and render its thumbnails.
+
+    This is a top-level function so it can run in a process pool.
+
+    Returns:
+        dict: The rendered thumbnails (see `thumbnails.render_thumbnails`).
+    """
+    img = Image.open(io.BytesIO(data))
+    img.load()
+
+    return thumbnails.render_thumbnails(img)
+
+
+def is_already_indexed(queued_image):
+    global REDIS
 
-    if REDIS.sismember(
+    return REDIS.sismember(
         "index:sites:" + queued_image.source_site + ":source_ids",
         queued_image.source_id,
-    ):
-        return
+    )
 
-    img, bio = download_image(queued_image.source_url)
-    imhash = compute_image_hash(img)
 
-    results = search_index(REDIS, imhash, min_threshold=24)
+def index_image(queued_image, imhash, data):
+    """Add a downloaded and hashed image to the index and the image cache.
+
+    Args:
+        queued_image (QueuedImage): The image being indexed.
+        imhash (ndarray): The image's hash.
+        data (bytes): The downloaded image file.
+
+    Returns:
+        IndexedImage: The new index entry, or the existing entry this image
+            was found to duplicate.
+    """
+    global REDIS, APP_REDIS, IMAGE_CACHE_DIR, WORKER_ID, HASH_MATRIX
+
+    results = search_index(REDIS, imhash, min_threshold=24, matrix=HASH_MATRIX)
 
     if len(results) > 0:
         h = results[0][0]
@@ -65,11 +105,9 @@ def process_queued_image(queued_image):
 
     if not osp.isfile(path):
         with open(path, "wb") as f:
-            bio.seek(0)
-            f.write(bio.read())
-        APP_REDIS.zadd("img_cache:live", {path: int(time.time() * 1000)})
+            f.write(data)
 
-    bio.close()
+        APP_REDIS.zadd("img_cache:live", {path: int(time.time() * 1000)})
 
     print(
         "Processed: {}#{} ==> img_id:{}".format(
@@ -77,7 +115,87 @@ def process_queued_image(queued_image):
         )
     )
 
-    time.sleep(0.5)  # ratelimit to avoid hitting source servers too hard
+    return indexed_img
+
+
+def needs_thumbnails(indexed_img):
+    """Check whether an indexed image is missing any of its pregenerated
+    thumbnails. Duplicates share the existing image's thumbnails, so they are
+    only rendered for new images, or existing ones cached without them.
+    """
+    global IMAGE_CACHE_DIR
+
+    return not thumbnails.thumbnails_cached(IMAGE_CACHE_DIR, indexed_img.img_id)
+
+
+def cache_thumbnails(indexed_img, rendered_thumbnails):
+    """Add rendered thumbnails to the image cache, skipping any that exist.
+
+    Args:
+        indexed_img (IndexedImage): The image the thumbnails belong to.
+        rendered_thumbnails (dict): Thumbnails as returned by
+            `thumbnails.render_thumbnails`.
+    """
+    global APP_REDIS, IMAGE_CACHE_DIR
+
+    written = thumbnails.save_thumbnails(
+        IMAGE_CACHE_DIR, indexed_img.img_id, rendered_thumbnails
+    )
+
+    if len(written) > 0:
+        ts = int(time.time() * 1000)
+        APP_REDIS.zadd("img_cache:live", dict((p, ts) for p in written))
+
+
+def process_queued_image(queued_image):
+    if is_already_indexed(queued_image):
+        return
+
+    ratelimit.acquire(queued_image.source_url)
+    img, bio = download_image(queued_image.source_url)
+    imhash = compute_image_hash(img)
+
+    indexed_img = index_image(queued_image, imhash, bio.getvalue())
+    bio.close()
+
+    # rendered from the image decoded for hashing
+    if needs_thumbnails(indexed_img):
+        cache_thumbnails(indexed_img, thumbnails.render_thumbnails(img))
+
+
+def process_queued_images(queued_images):
+    """Process a batch of queued images in one job.
+
+    A failed image doesn't stop the rest of the batch; the job fails after
+    the whole batch has been attempted, and re-running it skips the images
+    that were already indexed.
+    """
+    failed = []
+
+    for queued_image in queued_images:
+        try:
+            process_queued_image(queued_image)
+        except Exception:
+            traceback.print_exc()
+            failed.append(queued_image.source_site + "#" + queued_image.source_id)
+
+    if len(failed) > 0:
+        raise RuntimeError(
+            "Failed to process {:d} of {:d} images: {}".format(
+                len(failed), len(queued_images), ", ".join(failed)
+            )
+        )
+
+
+def process_packed_image(data):
+    """Process an image sent in its `QueuedImage.pack` form."""
+    process_queued_image(QueuedImage.unpack(data, get_tag_dictionary(REDIS)))
+
+
+def process_packed_images(payloads):
+    """Process a batch of images sent in their `QueuedImage.pack` form."""
+    tag_dict = get_tag_dictionary(REDIS)
+    process_queued_images([QueuedImage.unpack(data, tag_dict) for data in payloads])
 
 
 def cache_saved_image(img_id):
@@ -88,28 +206,57 @@ def cache_saved_image(img_id):
     if osp.isfile(path):
         return
 
+    ratelimit.acquire(indexed_image.source_url)
+
     with open(path, "wb") as f:
-        resp = requests.get(indexed_image.source_url, stream=True)
+        resp = http.get(indexed_image.source_url, stream=True)
         resp.raise_for_status()
 
-        for chunk in resp.iter_content(chunk_size=128):
+        for chunk in resp.iter_content(chunk_size=2 ** 16):
             f.write(chunk)
 
     APP_REDIS.zadd("img_cache:live", {path: int(time.time() * 1000)})
 
 
-def main():
-    global REDIS, APP_REDIS, WORKER_ID, IMAGE_CACHE_DIR
+def parse_pool_size(args):
+    """Get the `--pool-size=N` option from command-line arguments."""
+    for arg in args:
+        if arg.startswith("--pool-size="):
+            return int(arg[len("--pool-size=") :])
+
+    return None
+
 
-    redis_url = sys.argv[1]
+def init(redis_url, app_redis_url, image_cache_dir, worker_id, pool_size=None):
+    global REDIS, APP_REDIS, WORKER_ID, IMAGE_CACHE_DIR, HASH_MATRIX
 
     REDIS = Redis.from_url(redis_url)
-    APP_REDIS = Redis.from_url(sys.argv[2])
-    IMAGE_CACHE_DIR = sys.argv[3]
-    WORKER_ID = int(sys.argv[4])
+    APP_REDIS = Redis.from_url(app_redis_url)
+    IMAGE_CACHE_DIR = image_cache_dir
+    WORKER_ID = worker_id
+
+    if pool_size is None:
+        pool_size = http.DEFAULT_POOL_SIZE
+
+    http.configure(pool_maxsize=pool_size)
+    ratelimit.configure(REDIS)
+
+    HASH_MATRIX = MultiIndexHash()
+    HASH_MATRIX.load(REDIS)
+    print("Loaded {:d} image hashes".format(len(HASH_MATRIX)))
+
+
+def main():
+    init(
+        sys.argv[1],
+        sys.argv[2],
+        sys.argv[3],
+        int(sys.argv[4]),
+        pool_size=parse_pool_size(sys.argv[5:]),
+    )
 
     with Connection(REDIS):
-        worker = Worker(
+        worker = SimpleWorker(
             ["backend-index"], name="backend-{:d}-{:d}".format(WORKER_ID, os.getpid())
         )
         worker.work()
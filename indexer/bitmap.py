@@ -0,0 +1,288 @@
+from functools import reduce
+import operator
+
+import numpy as np
+
+# Each image gets a dense ordinal, assigned in indexing order. Ordinals are
+# split into chunks of 2^16; for every facet (e.g. `rating:safe`) and chunk,
+# the ordinals are stored in a Roaring-style container: a Redis set of
+# offsets (stored as a compact intset) while small, or a 8 KiB Redis bitmap
+# once it grows past ARRAY_CONTAINER_MAX entries.
+
+ORDINALS_KEY = "index:ordinals"
+ORDINAL_IDS_KEY = "index:ordinal_ids"
+NEXT_ORDINAL_KEY = "index:ordinals:next"
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+BITMAP_BYTES = CHUNK_SIZE // 8
+
+# matches Redis' default set-max-intset-entries, so array containers stay
+# intset-encoded
+ARRAY_CONTAINER_MAX = 512
+
+_ASSIGN_ORDINAL_SCRIPT = """
+local ordinal = redis.call("HGET", KEYS[1], ARGV[1])
+if ordinal then
+    return tonumber(ordinal)
+end
+
+ordinal = redis.call("INCR", KEYS[3]) - 1
+redis.call("HSET", KEYS[1], ARGV[1], ordinal)
+redis.call("HSET", KEYS[2], ordinal, ARGV[1])
+
+return ordinal
+"""
+
+_ADD_SCRIPT = """
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    return redis.call("SETBIT", KEYS[2], ARGV[1], 1)
+end
+
+redis.call("SADD", KEYS[1], ARGV[1])
+
+if redis.call("SCARD", KEYS[1]) > tonumber(ARGV[2]) then
+    for _, offset in ipairs(redis.call("SMEMBERS", KEYS[1])) do
+        redis.call("SETBIT", KEYS[2], offset, 1)
+    end
+    redis.call("DEL", KEYS[1])
+end
+
+return 1
+"""
+
+_REMOVE_SCRIPT = """
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    redis.call("SETBIT", KEYS[2], ARGV[1], 0)
+end
+
+return redis.call("SREM", KEYS[1], ARGV[1])
+"""
+
+_scripts = {}
+
+
+def _script(redis, source):
+    key = (id(redis), source)
+
+    if key not in _scripts:
+        _scripts[key] = redis.register_script(source)
+
+    return _scripts[key]
+
+
+def container_keys(facet, chunk):
+    """Get the (array container, bitmap container) keys for a facet chunk."""
+    return (
+        "index:bitmap:a:{:d}:{}".format(chunk, facet),
+        "index:bitmap:b:{:d}:{}".format(chunk, facet),
+    )
+
+
+def facet_for_key(key):
+    """Get the facet name for an index key (`index:rating:safe` -> `rating:safe`)."""
+    if not key.startswith("index:"):
+        raise ValueError("Not an index key: " + key)
+
+    return key[len("index:") :]
+
+
+def image_facets(queued_img_data):
+    """List the facets an image belongs to.
+
+    These mirror the keys that character queries can filter on.
+    """
+    site = queued_img_data.source_site
+    facets = ["sites:" + site, "rating:" + queued_img_data.sfw_rating]
+
+    facets.extend("characters:" + c for c in queued_img_data.characters if len(c) > 0)
+    facets.extend("authors:" + a for a in queued_img_data.authors if len(a) > 0)
+
+    for tag in queued_img_data.source_tags:
+        if len(tag) > 0:
+            facets.append("tags:merged:" + tag)
+            facets.append("tags:merged:" + tag + "@" + site)
+
+    return facets
+
+
+def assign_ordinal(redis, img_id):
+    """Get the ordinal of an image, assigning the next free one if needed."""
+    script = _script(redis, _ASSIGN_ORDINAL_SCRIPT)
+
+    return int(
+        script(keys=[ORDINALS_KEY, ORDINAL_IDS_KEY, NEXT_ORDINAL_KEY], args=[img_id])
+    )
+
+
+def assign_ordinals(redis, img_ids):
+    """Get (or assign) the ordinals of several images in one pipeline.
+
+    Ordinals are assigned in the order the IDs are given.
+    """
+    script = _script(redis, _ASSIGN_ORDINAL_SCRIPT)
+    tr = redis.pipeline(transaction=False)
+
+    for img_id in img_ids:
+        script(
+            keys=[ORDINALS_KEY, ORDINAL_IDS_KEY, NEXT_ORDINAL_KEY],
+            args=[img_id],
+            client=tr,
+        )
+
+    return [int(o) for o in tr.execute()]
+
+
+def add_to_facets(redis, tr, ordinal, facets):
+    """Queue the commands that add an ordinal to a list of facets.
+
+    Args:
+        redis (redis.Redis): The Redis interface `tr` belongs to.
+        tr (redis.client.Pipeline): The pipeline to queue commands on.
+        ordinal (int): The image ordinal.
+        facets (iterable): Facet names.
+    """
+    script = _script(redis, _ADD_SCRIPT)
+    chunk, offset = divmod(ordinal, CHUNK_SIZE)
+
+    for facet in facets:
+        script(
+            keys=container_keys(facet, chunk),
+            args=[offset, ARRAY_CONTAINER_MAX],
+            client=tr,
+        )
+
+
+def remove_from_facets(redis, tr, ordinal, facets):
+    """Queue the commands that remove an ordinal from a list of facets.
+
+    Bitmap containers are left in place when they empty out.
+    """
+    script = _script(redis, _REMOVE_SCRIPT)
+    chunk, offset = divmod(ordinal, CHUNK_SIZE)
+
+    for facet in facets:
+        script(keys=container_keys(facet, chunk), args=[offset], client=tr)
+
+
+def facet_chunks(redis):
+    """Get the number of ordinal chunks in use."""
+    return (int(redis.get(NEXT_ORDINAL_KEY) or 0) + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+
+def queue_facet_load(tr, facet, n_chunks):
+    """Queue the commands that fetch every container of a facet."""
+    for chunk in range(n_chunks):
+        array_key, bitmap_key = container_keys(facet, chunk)
+
+        tr.smembers(array_key)
+        tr.get(bitmap_key)
+
+
+class RoaringBitmap(object):
+    """A compressed bitmap of image ordinals.
+
+    Containers are stored per 2^16-ordinal chunk, either as sorted `uint16`
+    arrays of offsets or as 8 KiB `uint8` bitmaps (most significant bit
+    first, like Redis' SETBIT).
+    """
+
+    def __init__(self, containers=None):
+        self.containers = containers if containers is not None else {}
+
+    @staticmethod
+    def _is_bitmap(container):
+        return container.dtype == np.uint8
+
+    @staticmethod
+    def _offsets(container):
+        if container.dtype == np.uint8:
+            return np.flatnonzero(np.unpackbits(container)).astype(np.uint16)
+        return container
+
+    @classmethod
+    def from_ordinals(cls, ordinals):
+        ordinals = np.unique(np.asarray(ordinals, dtype=np.int64))
+        containers = {}
+
+        for chunk in np.unique(ordinals >> CHUNK_BITS).tolist():
+            offsets = ordinals[(ordinals >> CHUNK_BITS) == chunk] & (CHUNK_SIZE - 1)
+            offsets = offsets.astype(np.uint16)
+
+            if len(offsets) > ARRAY_CONTAINER_MAX:
+                bits = np.zeros(CHUNK_SIZE, dtype=np.uint8)
+                bits[offsets] = 1
+                containers[chunk] = np.packbits(bits)
+            else:
+                containers[chunk] = offsets
+
+        return cls(containers)
+
+    @classmethod
+    def from_redis_results(cls, results):
+        """Build a bitmap from the results of `queue_facet_load` commands."""
+        containers = {}
+
+        for chunk in range(len(results) // 2):
+            members, bitmap = results[2 * chunk : 2 * chunk + 2]
+
+            if bitmap:
+                container = np.zeros(BITMAP_BYTES, dtype=np.uint8)
+                data = np.frombuffer(bitmap, dtype=np.uint8)[:BITMAP_BYTES]
+                container[: len(data)] = data
+                containers[chunk] = container
+            elif members:
+                containers[chunk] = np.array(
+                    sorted(int(m) for m in members), dtype=np.uint16
+                )
+
+        return cls(containers)
+
+    def __len__(self):
+        return sum(
+            int(np.unpackbits(c).sum()) if self._is_bitmap(c) else len(c)
+            for c in self.containers.values()
+        )
+
+    def __and__(self, other):
+        containers = {}
+
+        for chunk in self.containers.keys() & other.containers.keys():
+            a = self.containers[chunk]
+            b = other.containers[chunk]
+
+            if self._is_bitmap(a) and self._is_bitmap(b):
+                c = np.bitwise_and(a, b)
+                if not c.any():
+                    continue
+            else:
+                if self._is_bitmap(a):
+                    a, b = b, a
+
+                if self._is_bitmap(b):
+                    c = a[(b[a >> 3] & (0x80 >> (a & 7)).astype(np.uint8)) != 0]
+                else:
+                    c = np.intersect1d(a, b, assume_unique=True)
+
+                if len(c) == 0:
+                    continue
+
+            containers[chunk] = c
+
+        return RoaringBitmap(containers)
+
+    def to_ordinals(self):
+        """Get the ordinals in this bitmap, as a sorted `int64` ndarray."""
+        parts = [
+            (chunk << CHUNK_BITS) + self._offsets(c).astype(np.int64)
+            for chunk, c in sorted(self.containers.items())
+        ]
+
+        if len(parts) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(parts)
+
+
+def intersect(bitmaps):
+    """Intersect a list of bitmaps."""
+    return reduce(operator.and_, bitmaps)
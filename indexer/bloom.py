@@ -0,0 +1,80 @@
+import hashlib
+import math
+
+import numpy as np
+
+
+def _as_bytes(item):
+    if isinstance(item, bytes):
+        return item
+    return str(item).encode("utf-8")
+
+
+class BloomFilter(object):
+    """A fixed-size Bloom filter over strings, ints or bytes.
+
+    Ints and their decimal byte strings (as returned by Redis) hash the same.
+    Bit positions are derived from one 128-bit BLAKE2b digest per item with
+    double hashing.
+
+    Args:
+        capacity (int): Expected number of items.
+        error_rate (float): Target false positive rate at `capacity` items.
+    """
+
+    def __init__(self, capacity, error_rate=1e-6):
+        capacity = max(int(capacity), 1)
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_bits = int(
+            math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.n_hashes = max(int(round(self.n_bits / capacity * math.log(2))), 1)
+        self.bits = np.zeros((self.n_bits + 7) // 8, dtype=np.uint8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, items):
+        digests = b"".join(
+            hashlib.blake2b(_as_bytes(item), digest_size=16).digest() for item in items
+        )
+        h = np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+
+        i = np.arange(self.n_hashes, dtype=np.uint64)
+        return (h[:, :1] + i * h[:, 1:]) % np.uint64(self.n_bits)
+
+    def update(self, items):
+        """Add several items."""
+        items = list(items)
+        if len(items) == 0:
+            return
+
+        pos = self._positions(items).ravel()
+        np.bitwise_or.at(
+            self.bits, pos >> np.uint64(3), np.uint8(0x80) >> (pos & np.uint64(7))
+        )
+        self.count += len(items)
+
+    def add(self, item):
+        self.update([item])
+
+    def contains_many(self, items):
+        """Check several items at once.
+
+        Returns:
+            A `bool` ndarray, with one entry per item.
+        """
+        items = list(items)
+        if len(items) == 0:
+            return np.zeros(0, dtype=bool)
+
+        pos = self._positions(items)
+        mask = np.uint8(0x80) >> (pos & np.uint64(7)).astype(np.uint8)
+
+        return np.all((self.bits[pos >> np.uint64(3)] & mask) != 0, axis=1)
+
+    def __contains__(self, item):
+        return bool(self.contains_many([item])[0])
@@ -0,0 +1,353 @@
+from .bitmap import (
+    ORDINALS_KEY,
+    add_to_facets,
+    container_keys,
+    facet_chunks,
+    remove_from_facets,
+)
+from .structures.indexed_image import INVALIDATION_CHANNEL, replace_packed_character
+
+# sites whose scrapers keep `<site>:characters` tag associations
+SITES = ("danbooru", "gelbooru")
+
+BATCH_SIZE = 1000
+
+# Moves one image from one character to another. The image is removed from
+# the work set in the same call, so a batch that was interrupted part-way is
+# simply picked up again. A packed record that changed since it was read is
+# dropped rather than overwritten; loads fall back to the normalized sets
+# until scripts/migrate_packed_records.py regenerates it.
+_MOVE_IMAGE_SCRIPT = """
+redis.call("SREM", KEYS[1], ARGV[3])
+redis.call("SADD", KEYS[1], ARGV[4])
+
+if ARGV[5] ~= "" and redis.call("GET", KEYS[2]) == ARGV[5] then
+    redis.call("SET", KEYS[2], ARGV[6])
+else
+    redis.call("DEL", KEYS[2])
+end
+
+redis.call("ZADD", KEYS[4], ARGV[2], ARGV[1])
+redis.call("ZREM", KEYS[3], ARGV[1])
+redis.call("ZREM", KEYS[5], ARGV[1])
+
+redis.call("PUBLISH", ARGV[7], "image:" .. ARGV[1])
+return 1
+"""
+
+_scripts = {}
+
+
+def _move_script(redis):
+    key = id(redis)
+
+    if key not in _scripts:
+        _scripts[key] = redis.register_script(_MOVE_IMAGE_SCRIPT)
+
+    return _scripts[key]
+
+
+def moving_key(name):
+    """Key recording the character an in-progress operation is moving
+    `name`'s images to.
+    """
+    return "index:characters:" + name + ":moving"
+
+
+def split_key(from_name, to_name):
+    """Key holding the images a split still has to move."""
+    return "index:characters:" + from_name + ":split:" + to_name
+
+
+def _begin(redis, from_name, to_name, work_key=None, work_sources=None):
+    """Record that `from_name`'s images are being moved to `to_name`.
+
+    If `work_key` is given, it is built by a ZINTERSTORE of `work_sources`
+    in the same transaction, unless it already exists and this is resuming
+    an interrupted operation.
+
+    Returns:
+        bool: Whether this is resuming an interrupted operation.
+
+    Raises:
+        ValueError: If `from_name` is already being moved to another
+            character, or is not a character and this is not resuming.
+    """
+    in_progress = redis.get(moving_key(from_name))
+
+    if in_progress is not None and in_progress.decode("utf-8") != to_name:
+        raise ValueError(
+            "{} is already being moved to {}".format(
+                from_name, in_progress.decode("utf-8")
+            )
+        )
+
+    if in_progress is None and redis.zscore("index:characters", from_name) is None:
+        raise ValueError(from_name + " is not a character")
+
+    tr = redis.pipeline()
+    tr.set(moving_key(from_name), to_name)
+    tr.zadd("index:characters", {to_name: "0"})
+
+    if work_key is not None and (in_progress is None or not redis.exists(work_key)):
+        tr.zinterstore(work_key, work_sources)
+
+    tr.execute()
+
+    return in_progress is not None
+
+
+def _move_batch(redis, work_key, from_name, to_name, img_ids, scores):
+    script = _move_script(redis)
+
+    tr = redis.pipeline(transaction=False)
+    for img_id in img_ids:
+        tr.get("index:image:" + img_id + ":packed")
+    tr.hmget(ORDINALS_KEY, img_ids)
+    results = tr.execute()
+
+    packed, ordinals = results[:-1], results[-1]
+
+    tr = redis.pipeline(transaction=False)
+
+    for img_id, score, data, ordinal in zip(img_ids, scores, packed, ordinals):
+        redis_key = "index:image:" + img_id
+        new_data = (
+            replace_packed_character(data, from_name, to_name)
+            if data is not None
+            else b""
+        )
+
+        script(
+            keys=[
+                redis_key + ":characters",
+                redis_key + ":packed",
+                "index:characters:" + from_name,
+                "index:characters:" + to_name,
+                work_key,
+            ],
+            args=[
+                img_id,
+                score,
+                from_name,
+                to_name,
+                data if data is not None else b"",
+                new_data,
+                INVALIDATION_CHANNEL,
+            ],
+            client=tr,
+        )
+
+        # images indexed before the filter bitmaps were built have no ordinal
+        if ordinal is not None:
+            add_to_facets(redis, tr, int(ordinal), ["characters:" + to_name])
+            remove_from_facets(redis, tr, int(ordinal), ["characters:" + from_name])
+
+    tr.execute()
+
+
+def _move_images(redis, work_key, from_name, to_name, batch_size, progress):
+    """Move every image in `work_key` from one character to another.
+
+    Each batch takes two round trips, and finished images leave the work set,
+    so rerunning an interrupted operation resumes it.
+    """
+    total = redis.zcard(work_key)
+    n_moved = 0
+
+    while True:
+        batch = redis.zrange(work_key, 0, batch_size - 1, withscores=True)
+        if len(batch) == 0:
+            break
+
+        img_ids = [img_id.decode("utf-8") for img_id, _ in batch]
+        scores = [int(score) for _, score in batch]
+
+        _move_batch(redis, work_key, from_name, to_name, img_ids, scores)
+
+        n_moved += len(batch)
+        if progress is not None:
+            progress(n_moved, max(total, n_moved))
+
+    return n_moved
+
+
+def _move_metadata(redis, from_name, to_name):
+    """Hand `from_name`'s friendly name, scraper tag associations and crawl
+    state over to `to_name`, where `to_name` has none of its own, and delete
+    everything else that is keyed by `from_name`.
+
+    Returns:
+        list: Sites whose tag association for `from_name` was dropped in
+            favour of `to_name`'s own.
+    """
+    name_keys = ["character:" + n + ":name" for n in (from_name, to_name)]
+    assoc_keys = [
+        site + ":characters:" + n for site in SITES for n in (from_name, to_name)
+    ]
+
+    tr = redis.pipeline(transaction=False)
+    for key in name_keys + assoc_keys:
+        tr.exists(key)
+    exists = tr.execute()
+
+    names_exist, assocs_exist = exists[:2], exists[2:]
+    dropped = []
+
+    tr = redis.pipeline()
+
+    tr.zrem("index:characters", from_name)
+    tr.zadd("index:characters", {to_name: "0"})
+    tr.delete("index:characters:" + from_name)
+
+    for chunk in range(facet_chunks(redis)):
+        tr.delete(*container_keys("characters:" + from_name, chunk))
+
+    if names_exist[0] and not names_exist[1]:
+        tr.rename(name_keys[0], name_keys[1])
+    elif names_exist[0]:
+        tr.delete(name_keys[0])
+
+    for i, site in enumerate(SITES):
+        from_exists, to_exists = assocs_exist[2 * i : 2 * i + 2]
+        if not from_exists:
+            continue
+
+        from_crawl = "crawl:" + site + ":" + from_name
+        tr.srem(site + ":characters", from_name)
+
+        if not to_exists:
+            tr.sadd(site + ":characters", to_name)
+            tr.rename(
+                site + ":characters:" + from_name, site + ":characters:" + to_name
+            )
+            tr.delete("crawl:" + site + ":" + to_name)
+            tr.eval(
+                "if redis.call('EXISTS', KEYS[1]) == 1 then "
+                "redis.call('RENAME', KEYS[1], KEYS[2]) end",
+                2,
+                from_crawl,
+                "crawl:" + site + ":" + to_name,
+            )
+        else:
+            tr.delete(site + ":characters:" + from_name, from_crawl)
+            dropped.append(site)
+
+    tr.delete(moving_key(from_name))
+
+    tr.publish(INVALIDATION_CHANNEL, "character:" + from_name)
+    tr.publish(INVALIDATION_CHANNEL, "character:" + to_name)
+
+    tr.execute()
+
+    return dropped
+
+
+def merge_characters(redis, from_name, into_name, batch_size=None, progress=None):
+    """Move every image of one character to another, and remove the first
+    character.
+
+    Interrupted merges can be resumed by calling this again with the same
+    arguments; images indexed under `from_name` in the meantime are moved as
+    well.
+
+    Args:
+        redis (redis.Redis): A Redis interface.
+        from_name (str): The character to remove.
+        into_name (str): The character to move its images to.
+        batch_size (int): Images per batch; defaults to `BATCH_SIZE`.
+        progress (callable): Called with `(n_moved, total)` after each batch.
+
+    Returns:
+        list: Sites whose tag association for `from_name` was dropped,
+            because `into_name` already had one.
+
+    Raises:
+        ValueError: If `from_name` is not a character, and this is not
+            resuming an interrupted merge.
+    """
+    if batch_size is None:
+        batch_size = BATCH_SIZE
+
+    if from_name == into_name:
+        raise ValueError("Cannot merge a character into itself")
+
+    _begin(redis, from_name, into_name)
+    _move_images(
+        redis,
+        "index:characters:" + from_name,
+        from_name,
+        into_name,
+        batch_size,
+        progress,
+    )
+
+    return _move_metadata(redis, from_name, into_name)
+
+
+def rename_character(redis, from_name, to_name, batch_size=None, progress=None):
+    """Rename a character.
+
+    This is a merge into a character that does not exist yet.
+
+    Raises:
+        ValueError: If `from_name` does not exist or `to_name` already
+            exists, and this is not resuming an interrupted rename.
+    """
+    resuming = redis.get(moving_key(from_name)) == to_name.encode("utf-8")
+
+    if not resuming and redis.exists("index:characters:" + to_name):
+        raise ValueError(to_name + " already exists; merge the characters instead")
+
+    return merge_characters(
+        redis, from_name, to_name, batch_size=batch_size, progress=progress
+    )
+
+
+def split_character(redis, from_name, to_name, tag, batch_size=None, progress=None):
+    """Move the images of a character that have a source tag to another
+    character.
+
+    The selection is made once, when the split starts; calling this again
+    with the same arguments resumes an interrupted split.
+
+    Args:
+        redis (redis.Redis): A Redis interface.
+        from_name (str): The character to split.
+        to_name (str): The character to move the selected images to.
+        tag (str): Images with this tag are moved, as in the `tag` query
+            filter (`<tag>` or `<tag>@<site>`).
+        batch_size (int): Images per batch; defaults to `BATCH_SIZE`.
+        progress (callable): Called with `(n_moved, total)` after each batch.
+
+    Returns:
+        int: The number of images moved.
+
+    Raises:
+        ValueError: If `from_name` is not a character, and this is not
+            resuming an interrupted split.
+    """
+    if batch_size is None:
+        batch_size = BATCH_SIZE
+
+    if from_name == to_name:
+        raise ValueError("Cannot split a character into itself")
+
+    work_key = split_key(from_name, to_name)
+    _begin(
+        redis,
+        from_name,
+        to_name,
+        work_key,
+        {"index:characters:" + from_name: 1, "index:tags:merged:" + tag: 0},
+    )
+
+    n_moved = _move_images(redis, work_key, from_name, to_name, batch_size, progress)
+
+    tr = redis.pipeline()
+    tr.delete(work_key, moving_key(from_name))
+    tr.publish(INVALIDATION_CHANNEL, "character:" + from_name)
+    tr.publish(INVALIDATION_CHANNEL, "character:" + to_name)
+    tr.execute()
+
+    return n_moved
@@ -0,0 +1,243 @@
+import numpy as np
+
+IMHASH_KEY_PREFIX = b"imhash:"
+IMHASH_LOG_KEY = "index:imhash_log"
+IMHASH_LOG_GENERATION_KEY = "index:imhash_log:generation"
+
+# number of entries trimmed off the head of the log, so that log offsets stay
+# meaningful across trims
+IMHASH_LOG_TRIMMED_KEY = "index:imhash_log:trimmed"
+
+# the log is trimmed to this many entries; matrices that fall further behind
+# reload from scratch
+IMHASH_LOG_MAX_LEN = 100000
+
+# popcount for every possible 16-bit value
+_POPCOUNT16 = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+
+def _as_hash_bytes(h):
+    if isinstance(h, np.ndarray):
+        return h.astype(np.uint8, copy=False).tobytes()
+    return bytes(h)
+
+
+class HashMatrix(object):
+    """An in-memory matrix of every image hash in the index.
+
+    All hashes are packed into a single contiguous `uint64` array, so that
+    the Hamming distances from a query hash to every indexed hash can be
+    computed in one batched XOR + popcount.
+
+    The matrix is loaded from the `imhash:<bytes>` keys in Redis, and kept up
+    to date afterwards by replaying the `index:imhash_log` list (which
+    `IndexedImage.save_to_index` appends to). The log only keeps its last
+    `IMHASH_LOG_MAX_LEN` entries; matrices that fall behind the trimmed head,
+    and all matrices after the hash index is rebuilt (which bumps the log
+    generation), reload from scratch.
+
+    Args:
+        hash_bytes (int): Length of each hash in bytes. Must be a multiple
+            of 8.
+        initial_capacity (int): Number of rows to preallocate.
+    """
+
+    def __init__(self, hash_bytes=16, initial_capacity=1024):
+        if hash_bytes % 8 != 0:
+            raise ValueError("Hash length must be a multiple of 8 bytes")
+
+        self.hash_bytes = hash_bytes
+        self._words = hash_bytes // 8
+        self._hashes = np.zeros((max(initial_capacity, 1), self._words), np.uint64)
+        self._count = 0
+        self._rows = {}
+        self._log_offset = 0
+        self._log_generation = None
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, h):
+        return _as_hash_bytes(h) in self._rows
+
+    @property
+    def hashes(self):
+        """ndarray: A `uint64` view of the populated rows of the matrix."""
+        return self._hashes[: self._count]
+
+    def hash_at(self, row):
+        """Get the hash stored at a given row, as `bytes`."""
+        return self._hashes[row].tobytes()
+
+    def clear(self):
+        self._count = 0
+        self._rows = {}
+        self._log_offset = 0
+        self._log_generation = None
+
+    def add(self, h):
+        """Add a hash to the matrix.
+
+        Args:
+            h (bytes or ndarray): The hash to add.
+
+        Returns:
+            int: The row the hash is stored at, or `None` if the hash was
+                already present.
+        """
+        h = _as_hash_bytes(h)
+        if len(h) != self.hash_bytes:
+            raise ValueError(
+                "Expected {:d}-byte hash, got {:d} bytes".format(
+                    self.hash_bytes, len(h)
+                )
+            )
+
+        if h in self._rows:
+            return None
+
+        if self._count >= self._hashes.shape[0]:
+            grown = np.zeros((self._hashes.shape[0] * 2, self._words), np.uint64)
+            grown[: self._count] = self._hashes[: self._count]
+            self._hashes = grown
+
+        row = self._count
+        self._hashes[row] = np.frombuffer(h, dtype=np.uint64)
+        self._rows[h] = row
+        self._count += 1
+
+        return row
+
+    def _query_words(self, imhash):
+        h = _as_hash_bytes(imhash)
+        if len(h) != self.hash_bytes:
+            raise ValueError(
+                "Expected {:d}-byte hash, got {:d} bytes".format(
+                    self.hash_bytes, len(h)
+                )
+            )
+
+        return np.frombuffer(h, dtype=np.uint64)
+
+    def distances(self, imhash, rows=None):
+        """Compute the Hamming distances from a hash to indexed hashes.
+
+        Args:
+            imhash (bytes or ndarray): The query hash.
+            rows (ndarray): If given, only compute distances to these rows.
+
+        Returns:
+            A `uint16` ndarray of distances, one per (selected) row.
+        """
+        q = self._query_words(imhash)
+        mat = self.hashes if rows is None else self._hashes[rows]
+
+        x = np.bitwise_xor(mat, q)
+        return _POPCOUNT16[x.view(np.uint16)].sum(axis=1, dtype=np.uint16)
+
+    def _collect(self, imhash, min_threshold, rows=None):
+        dists = self.distances(imhash, rows)
+        matches = np.flatnonzero(dists < min_threshold)
+        matches = matches[np.argsort(dists[matches], kind="stable")]
+
+        if rows is not None:
+            return [(self.hash_at(rows[i]), int(dists[i])) for i in matches]
+        return [(self.hash_at(i), int(dists[i])) for i in matches]
+
+    def search(self, imhash, min_threshold=64):
+        """Search the matrix for hashes near a given hash.
+
+        Args:
+            imhash (bytes or ndarray): The query hash.
+            min_threshold (int): Only hashes with a distance less than this
+                value are returned.
+
+        Returns:
+            A list of (hash, distance) tuples, sorted by increasing distance.
+        """
+        if self._count == 0:
+            return []
+
+        return self._collect(imhash, min_threshold)
+
+    def exists(self, imhash, min_threshold=64):
+        """Check if any hash within a given distance is in the matrix."""
+        if self._count == 0:
+            return False
+
+        return bool(np.any(self.distances(imhash) < min_threshold))
+
+    def load(self, redis, batch_size=1000):
+        """(Re)load the matrix from the `imhash:*` keys in Redis.
+
+        Args:
+            redis (redis.Redis): A Redis interface.
+            batch_size (int): SCAN batch size hint.
+        """
+        self.clear()
+
+        # Note the current log position first: anything appended while we
+        # scan gets replayed (and deduplicated) on the next sync.
+        self._log_generation, trimmed, log_len = self._log_position(redis)
+        self._log_offset = trimmed + log_len
+
+        for key in redis.scan_iter(match=IMHASH_KEY_PREFIX + b"*", count=batch_size):
+            h = key[len(IMHASH_KEY_PREFIX) :]
+            if len(h) == self.hash_bytes:
+                self.add(h)
+
+    @staticmethod
+    def _log_position(redis):
+        tr = redis.pipeline()
+        tr.get(IMHASH_LOG_GENERATION_KEY)
+        tr.get(IMHASH_LOG_TRIMMED_KEY)
+        tr.llen(IMHASH_LOG_KEY)
+        generation, trimmed, log_len = tr.execute()
+
+        return generation, int(trimmed or 0), log_len
+
+    def sync(self, redis, batch_size=1000):
+        """Add any hashes written to the index since the last load or sync.
+
+        Args:
+            redis (redis.Redis): A Redis interface.
+            batch_size (int): Number of log entries to fetch per request.
+
+        Returns:
+            int: The number of new hashes added.
+        """
+        n_added = 0
+
+        while True:
+            generation, trimmed, log_len = self._log_position(redis)
+
+            if generation != self._log_generation or not (
+                trimmed <= self._log_offset <= trimmed + log_len
+            ):
+                # log was rebuilt, or trimmed past our offset
+                self.load(redis)
+                return self._count
+
+            if self._log_offset == trimmed + log_len:
+                return n_added
+
+            start = self._log_offset - trimmed
+
+            tr = redis.pipeline()
+            tr.get(IMHASH_LOG_GENERATION_KEY)
+            tr.get(IMHASH_LOG_TRIMMED_KEY)
+            tr.lrange(IMHASH_LOG_KEY, start, start + batch_size - 1)
+            batch_generation, batch_trimmed, hashes = tr.execute()
+
+            if batch_generation != generation or int(batch_trimmed or 0) != trimmed:
+                # trimmed or rebuilt since we read the position; try again
+                continue
+
+            if len(hashes) == 0:
+                return n_added
+
+            for h in hashes:
+                if len(h) == self.hash_bytes and self.add(h) is not None:
+                    n_added += 1
+
+            self._log_offset += len(hashes)
@@ -0,0 +1,152 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 60)
+USER_AGENT = "waifustream-indexer"
+
+# idle keep-alive connections kept per host; workers can change this at
+# startup through `configure`
+DEFAULT_POOL_SIZE = 10
+
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "connections": 0}
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+class _CountingPoolMixin(object):
+    """Counts connection checkouts and new connections, to measure how often
+    keep-alive connections are reused.
+    """
+
+    def _new_conn(self):
+        _count("connections")
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        _count("requests")
+        return super()._get_conn(timeout=timeout)
+
+
+class CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class PooledAdapter(HTTPAdapter):
+    """An HTTPAdapter with a default timeout and connection counting."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+def create_session(
+    pool_connections=10,
+    pool_maxsize=DEFAULT_POOL_SIZE,
+    retries=3,
+    backoff_factor=0.5,
+    timeout=DEFAULT_TIMEOUT,
+):
+    """Create a requests session with keep-alive connection pooling.
+
+    Args:
+        pool_connections (int): Number of per-host pools to keep.
+        pool_maxsize (int): Maximum number of idle connections kept per host.
+        retries (int): How many times to retry failed connections, reads and
+            429/5xx responses.
+        backoff_factor (float): Exponential backoff factor between retries,
+            in seconds.
+        timeout: Default (connect, read) timeout, in seconds.
+
+    Returns:
+        requests.Session
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    )
+
+    adapter = PooledAdapter(
+        timeout=timeout,
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+SESSION = create_session()
+
+
+def configure(**kwargs):
+    """Replace the shared session; takes the same arguments as
+    `create_session`.
+    """
+    global SESSION
+
+    SESSION.close()
+    SESSION = create_session(**kwargs)
+    return SESSION
+
+
+def get(url, **kwargs):
+    """Make a GET request through the shared session."""
+    return SESSION.get(url, **kwargs)
+
+
+def stats():
+    """Get connection reuse counters for every session in this process.
+
+    Returns:
+        dict: `requests` (connection checkouts, including retries),
+            `connections` (new connections opened) and `reuse_rate`.
+    """
+    with _stats_lock:
+        ret = dict(_stats)
+
+    reused = max(ret["requests"] - ret["connections"], 0)
+    ret["reuse_rate"] = reused / ret["requests"] if ret["requests"] > 0 else 0.0
+
+    return ret
+
+
+def format_stats():
+    s = stats()
+
+    return "{:d} requests over {:d} connections ({:.1%} reused)".format(
+        s["requests"], s["connections"], s["reuse_rate"]
+    )
@@ -1,6 +1,46 @@
 import imagehash
 import numpy as np
 
+from .hash_matrix import (
+    IMHASH_KEY_PREFIX,
+    IMHASH_LOG_GENERATION_KEY,
+    IMHASH_LOG_KEY,
+    IMHASH_LOG_MAX_LEN,
+    IMHASH_LOG_TRIMMED_KEY,
+)
+from .settings import env_flag
+
+# Whether to maintain the `hash_idx:NN:XX` bucket sets. Only `search_index`
+# and `exists_in_index` calls without an in-memory matrix read them, and they
+# store every hash 16 more times, so they are off unless
+# WAIFUSTREAM_HASH_BUCKET_SETS is set.
+HASH_BUCKET_SETS = env_flag("HASH_BUCKET_SETS")
+
+# Appends a hash to the log, trimming it to ARGV[2] entries and counting the
+# entries trimmed off its head.
+_APPEND_LOG_SCRIPT = """
+local log_len = redis.call("RPUSH", KEYS[1], ARGV[1])
+local excess = log_len - tonumber(ARGV[2])
+
+if excess > 0 then
+    redis.call("LTRIM", KEYS[1], excess, -1)
+    redis.call("INCRBY", KEYS[2], excess)
+end
+
+return log_len
+"""
+
+_scripts = {}
+
+
+def _append_log_script(redis):
+    key = id(redis)
+
+    if key not in _scripts:
+        _scripts[key] = redis.register_script(_APPEND_LOG_SCRIPT)
+
+    return _scripts[key]
+
 
 def compute_image_hash(img):
     """Compute a combined perceptual hash for an image.
@@ -34,25 +74,142 @@ def construct_hash_idx_key(idx, val):
     return "hash_idx:{:02d}:{:02x}".format(idx, val).encode("utf-8")
 
 
-def exists_in_index(redis, imhash, min_threshold=64):
+def _bucket_set_hashes(redis, imhash, bucket_sets):
+    if bucket_sets is None:
+        bucket_sets = HASH_BUCKET_SETS
+
+    # searching bucket sets that aren't written would silently find nothing
+    if not bucket_sets:
+        raise ValueError(
+            "Hash bucket sets are disabled; search with a hash matrix instead"
+        )
+
+    keys = []
+    for idx, val in enumerate(imhash.tobytes()):
+        keys.append(construct_hash_idx_key(idx, val))
+
+    return redis.sunion(*keys)
+
+
+def add_to_hash_index(redis, tr, imhash, img_id, bucket_sets=None):
+    """Queue the commands that add an image hash to the near-duplicate index.
+
+    This writes the `imhash:<bytes>` key and the (bounded) hash log that
+    in-memory hash matrices load and sync from, and, if enabled, the
+    `hash_idx:NN:XX` bucket sets.
+
+    Args:
+        redis (redis.Redis): The Redis interface `tr` belongs to.
+        tr (redis.client.Pipeline): The pipeline to queue commands on.
+        imhash (bytes or ndarray): The image hash.
+        img_id (int): The ID of the image with this hash.
+        bucket_sets (bool): Whether to write the bucket sets. Defaults to
+            `HASH_BUCKET_SETS`.
+    """
+
+    if bucket_sets is None:
+        bucket_sets = HASH_BUCKET_SETS
+
+    if isinstance(imhash, np.ndarray):
+        imhash = imhash.tobytes()
+
+    tr.set(IMHASH_KEY_PREFIX + imhash, img_id)
+    _append_log_script(redis)(
+        keys=[IMHASH_LOG_KEY, IMHASH_LOG_TRIMMED_KEY],
+        args=[imhash, IMHASH_LOG_MAX_LEN],
+        client=tr,
+    )
+
+    if bucket_sets:
+        for idx, val in enumerate(imhash):
+            tr.sadd(construct_hash_idx_key(idx, val), imhash)
+
+
+def rebuild_hash_index(redis, batch_size=1000, clear=True, bucket_sets=None):
+    """Rebuild the near-duplicate hash index from the stored image data.
+
+    Image IDs are streamed from `index:images` with SSCAN, and their hashes
+    fetched with one pipelined HMGET per batch.
+
+    Args:
+        redis (redis.Redis): A Redis interface.
+        batch_size (int): Number of images to process per batch.
+        clear (bool): Whether to delete the existing bucket sets and hash log
+            before rebuilding.
+        bucket_sets (bool): Whether to write the bucket sets. Defaults to
+            `HASH_BUCKET_SETS`.
+
+    Yields:
+        int: The running total of images processed, once per batch.
+    """
+
+    if clear:
+        tr = redis.pipeline(transaction=False)
+        for key in redis.scan_iter(match=b"hash_idx:*", count=batch_size):
+            tr.delete(key)
+        tr.execute()
+
+        tr = redis.pipeline()
+        tr.delete(IMHASH_LOG_KEY, IMHASH_LOG_TRIMMED_KEY)
+        tr.incr(IMHASH_LOG_GENERATION_KEY)
+        tr.execute()
+
+    batch = []
+    n_processed = 0
+
+    def flush():
+        tr = redis.pipeline(transaction=False)
+        for img_id in batch:
+            tr.hmget(b"index:image:" + img_id, "imhash")
+        imhashes = tr.execute()
+
+        tr = redis.pipeline(transaction=False)
+        for img_id, (imhash,) in zip(batch, imhashes):
+            if imhash is not None:
+                add_to_hash_index(
+                    redis, tr, imhash, int(img_id), bucket_sets=bucket_sets
+                )
+        tr.execute()
+
+        return len(batch)
+
+    for img_id in redis.sscan_iter("index:images", count=batch_size):
+        batch.append(img_id)
+
+        if len(batch) >= batch_size:
+            n_processed += flush()
+            batch = []
+            yield n_processed
+
+    if len(batch) > 0:
+        n_processed += flush()
+        yield n_processed
+
+
+def exists_in_index(redis, imhash, min_threshold=64, matrix=None, bucket_sets=None):
     """Check if any image exists in the image with a nearby hash.
     
     Args:
         redis (redis.Redis): A Redis interface.
         imhash (ndarray): An image hash to look up. Must be of type `uint8`.
         min_threshold (int): A minimum distance threshold for filtering results.
+        matrix (HashMatrix): If given, search this in-memory hash matrix
+            (after syncing it with Redis) instead of the Redis bucket sets.
+        bucket_sets (bool): Whether the bucket sets are maintained, and can
+            be searched if no matrix is given. Defaults to `HASH_BUCKET_SETS`.
             
     Returns:
         bool: True if a closely-matching image exists, False otherwise.
+
+    Raises:
+        ValueError: If no matrix is given and the bucket sets are disabled.
     """
 
-    h_bytes = imhash.tobytes()
+    if matrix is not None:
+        matrix.sync(redis)
+        return matrix.exists(imhash, min_threshold=min_threshold)
 
-    keys = []
-    for idx, val in enumerate(h_bytes):
-        keys.append(construct_hash_idx_key(idx, val))
-
-    hashes = redis.sunion(*keys)
+    hashes = _bucket_set_hashes(redis, imhash, bucket_sets)
     _t = []
 
     for h in hashes:
@@ -65,7 +222,7 @@ def exists_in_index(redis, imhash, min_threshold=64):
     return False
 
 
-def search_index(redis, imhash, min_threshold=64):
+def search_index(redis, imhash, min_threshold=64, matrix=None, bucket_sets=None):
     """Search the index for images with nearby hashes.
     
     Args:
@@ -74,18 +231,23 @@ def search_index(redis, imhash, min_threshold=64):
         min_threshold (int): A minimum distance threshold for filtering results.
             The result list will only contain images with a result less than
             this value.
+        matrix (HashMatrix): If given, search this in-memory hash matrix
+            (after syncing it with Redis) instead of the Redis bucket sets.
+        bucket_sets (bool): Whether the bucket sets are maintained, and can
+            be searched if no matrix is given. Defaults to `HASH_BUCKET_SETS`.
             
     Returns:
         A list of (hash, distance) tuples, sorted by increasing distance.
-    """
 
-    h_bytes = imhash.tobytes()
+    Raises:
+        ValueError: If no matrix is given and the bucket sets are disabled.
+    """
 
-    keys = []
-    for idx, val in enumerate(h_bytes):
-        keys.append(construct_hash_idx_key(idx, val))
+    if matrix is not None:
+        matrix.sync(redis)
+        return matrix.search(imhash, min_threshold=min_threshold)
 
-    hashes = redis.sunion(*keys)
+    hashes = _bucket_set_hashes(redis, imhash, bucket_sets)
     _t = []
 
     for h in hashes:
@@ -0,0 +1,138 @@
+from functools import lru_cache
+from itertools import combinations
+
+import numpy as np
+
+from .hash_matrix import HashMatrix, _as_hash_bytes
+
+_SUBSTRING_DTYPES = {8: np.uint8, 16: np.uint16, 32: np.uint32}
+
+
+@lru_cache(maxsize=None)
+def flip_masks(bits, radius):
+    """Get every XOR mask with at most `radius` set bits out of `bits` bits.
+
+    Returns:
+        A sorted tuple of ints, starting with 0 (the zero-distance mask).
+    """
+    masks = []
+    for k in range(min(radius, bits) + 1):
+        for positions in combinations(range(bits), k):
+            m = 0
+            for p in positions:
+                m |= 1 << p
+            masks.append(m)
+
+    return tuple(masks)
+
+
+def n_probes(bits, radius):
+    """Count the number of values within `radius` of a `bits`-bit value."""
+    return len(flip_masks(bits, radius))
+
+
+class MultiIndexHash(HashMatrix):
+    """A multi-index hashing (MIH) structure over the image hash matrix.
+
+    Each hash is split into `n_tables` disjoint substrings, and each table
+    maps substring values to the rows holding them. By the pigeonhole
+    principle, any hash within distance `r` of a query has at least one
+    substring within distance `r // n_tables` of the matching query
+    substring, so a radius query only has to probe those neighbouring
+    substring values before verifying the candidates against the full
+    hashes.
+
+    Searches are exact. When a query radius is so large that probing the
+    tables would cost more than scanning the matrix, it falls back to a
+    linear scan.
+
+    Args:
+        hash_bytes (int): Length of each hash in bytes.
+        n_tables (int): Number of substrings to split hashes into. The
+            resulting substrings must be 8, 16 or 32 bits long.
+        initial_capacity (int): Number of rows to preallocate.
+    """
+
+    def __init__(self, hash_bytes=16, n_tables=8, initial_capacity=1024):
+        super().__init__(hash_bytes=hash_bytes, initial_capacity=initial_capacity)
+
+        if (hash_bytes * 8) % n_tables != 0:
+            raise ValueError("Hash length must be divisible by the number of tables")
+
+        self.n_tables = n_tables
+        self.substring_bits = (hash_bytes * 8) // n_tables
+
+        if self.substring_bits not in _SUBSTRING_DTYPES:
+            raise ValueError(
+                "Unsupported substring length: {:d} bits".format(self.substring_bits)
+            )
+
+        self._substring_dtype = _SUBSTRING_DTYPES[self.substring_bits]
+        self._tables = [{} for _ in range(n_tables)]
+
+        # number of candidates verified by the last search
+        self.last_candidates = 0
+
+    def substrings(self, h):
+        """Split a hash into its per-table substring values."""
+        return np.frombuffer(_as_hash_bytes(h), dtype=self._substring_dtype)
+
+    def clear(self):
+        super().clear()
+        self._tables = [{} for _ in range(self.n_tables)]
+
+    def add(self, h):
+        row = super().add(h)
+        if row is None:
+            return None
+
+        for table, val in zip(self._tables, self.substrings(h).tolist()):
+            table.setdefault(val, []).append(row)
+
+        return row
+
+    def table_radius(self, min_threshold):
+        """Get the per-table search radius for a distance threshold."""
+        return max(min_threshold - 1, 0) // self.n_tables
+
+    def candidates(self, imhash, min_threshold=64):
+        """Collect the rows that may lie within a distance threshold.
+
+        Returns:
+            A sorted `int64` ndarray of row indices, or `None` if probing the
+            tables would be more expensive than a linear scan.
+        """
+        radius = self.table_radius(min_threshold)
+        masks = flip_masks(self.substring_bits, radius)
+
+        if len(masks) * self.n_tables >= self._count:
+            return None
+
+        rows = set()
+        for table, val in zip(self._tables, self.substrings(imhash).tolist()):
+            for mask in masks:
+                bucket = table.get(val ^ mask)
+                if bucket is not None:
+                    rows.update(bucket)
+
+        return np.array(sorted(rows), dtype=np.int64)
+
+    def search(self, imhash, min_threshold=64):
+        if min_threshold <= 0 or self._count == 0:
+            self.last_candidates = 0
+            return []
+
+        rows = self.candidates(imhash, min_threshold)
+
+        if rows is None:
+            self.last_candidates = self._count
+            return super().search(imhash, min_threshold=min_threshold)
+
+        self.last_candidates = len(rows)
+        if len(rows) == 0:
+            return []
+
+        return self._collect(imhash, min_threshold, rows)
+
+    def exists(self, imhash, min_threshold=64):
+        return len(self.search(imhash, min_threshold=min_threshold)) > 0
@@ -0,0 +1,251 @@
+import abc
+import asyncio
+from fnmatch import fnmatchcase
+import math
+import threading
+import time
+from urllib.parse import urlsplit
+
+# (requests per second, burst size), by host, parent domain, or host pattern
+DEFAULT_RATES = {
+    "danbooru.donmai.us": (2.0, 4),
+    "cdn.donmai.us": (5.0, 10),
+    "gelbooru.com": (2.0, 4),
+    # image CDNs get their own buckets, rather than sharing the API's
+    "img*.gelbooru.com": (5.0, 10),
+    "video-cdn*.gelbooru.com": (5.0, 10),
+}
+DEFAULT_RATE = (2.0, 2)
+
+CONFIG_KEY = "ratelimit:config"
+BUCKET_KEY_PREFIX = "ratelimit:bucket:"
+STATS_KEY_PREFIX = "ratelimit:stats:"
+
+# Reserves one token from a bucket, letting the token count go negative so
+# concurrent callers queue up in order, and returns how long the caller has to
+# wait for its token in milliseconds.
+_RESERVE_SCRIPT = """
+redis.replicate_commands()
+
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+
+local t = redis.call("TIME")
+local now = tonumber(t[1]) * 1000 + tonumber(t[2]) / 1000
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate / 1000) - 1
+
+local wait = 0
+if tokens < 0 then
+    wait = math.ceil(-tokens * 1000 / rate)
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil((burst - tokens) * 1000 / rate) + 1000)
+
+redis.call("HINCRBY", KEYS[2], "requests", 1)
+if wait > 0 then
+    redis.call("HINCRBY", KEYS[2], "waited", 1)
+    redis.call("HINCRBY", KEYS[2], "wait_ms", wait)
+end
+
+return wait
+"""
+
+
+def host_of(url_or_host):
+    if "://" in url_or_host:
+        return urlsplit(url_or_host).hostname
+    return url_or_host
+
+
+class RateLimiter(abc.ABC):
+    """Base class for per-host token-bucket rate limiters.
+
+    Hosts are matched against the configured rates by hostname pattern
+    (`img*.gelbooru.com`) first, then by hostname or parent domain (so
+    `api.example.com` uses an `example.com` entry), and hosts matching the
+    same entry share a bucket.
+
+    Args:
+        rates (dict): Maps hosts, domains or patterns to (rate, burst) tuples,
+            where rate is in requests per second.
+        default_rate (tuple): The (rate, burst) for hosts not in `rates`.
+    """
+
+    def __init__(self, rates=None, default_rate=DEFAULT_RATE):
+        self.rates = dict(DEFAULT_RATES if rates is None else rates)
+        self.default_rate = default_rate
+
+    def bucket_for(self, host):
+        """Get the bucket name and (rate, burst) for a host."""
+        for pattern, rate in self.rates.items():
+            if "*" in pattern and fnmatchcase(host, pattern):
+                return pattern, rate
+
+        parts = host.split(".")
+
+        for i in range(len(parts)):
+            domain = ".".join(parts[i:])
+            if domain in self.rates:
+                return domain, self.rates[domain]
+
+        return host, self.default_rate
+
+    @abc.abstractmethod
+    def reserve(self, host):
+        """Take a token for a host.
+
+        Returns:
+            float: How long to wait before making the request, in seconds.
+        """
+
+    def acquire(self, url_or_host):
+        """Block until a request to a host is allowed.
+
+        Returns:
+            float: The time spent waiting, in seconds.
+        """
+        wait = self.reserve(host_of(url_or_host))
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+    async def acquire_async(self, url_or_host):
+        """Wait until a request to a host is allowed, without blocking the
+        event loop.
+        """
+        loop = asyncio.get_event_loop()
+        wait = await loop.run_in_executor(None, self.reserve, host_of(url_or_host))
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        return wait
+
+
+class LocalRateLimiter(RateLimiter):
+    """A rate limiter whose buckets only apply within this process."""
+
+    def __init__(self, rates=None, default_rate=DEFAULT_RATE):
+        super().__init__(rates=rates, default_rate=default_rate)
+
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.stats = {}
+
+    def reserve(self, host):
+        name, (rate, burst) = self.bucket_for(host)
+
+        with self._lock:
+            now = time.monotonic()
+            tokens, ts = self._buckets.get(name, (burst, now))
+
+            tokens = min(burst, tokens + (now - ts) * rate) - 1
+            self._buckets[name] = (tokens, now)
+
+            wait = -tokens / rate if tokens < 0 else 0
+
+            stats = self.stats.setdefault(
+                name, {"requests": 0, "waited": 0, "wait_ms": 0}
+            )
+            stats["requests"] += 1
+            if wait > 0:
+                stats["waited"] += 1
+                stats["wait_ms"] += int(math.ceil(wait * 1000))
+
+        return wait
+
+
+class RedisRateLimiter(RateLimiter):
+    """A rate limiter whose buckets are shared through Redis.
+
+    All scraper and backend workers using the same Redis instance draw from
+    the same per-host buckets. Rates can be overridden at runtime through the
+    `ratelimit:config` hash (host -> "rate,burst"), which is re-read every
+    `config_refresh` seconds. Wait-time metrics are kept in
+    `ratelimit:stats:<bucket>`.
+
+    Args:
+        redis (redis.Redis): A Redis interface.
+        rates (dict): Default (rate, burst) tuples by host or domain.
+        default_rate (tuple): The (rate, burst) for other hosts.
+        config_refresh (float): How often to re-read the config hash, in
+            seconds.
+    """
+
+    def __init__(self, redis, rates=None, default_rate=DEFAULT_RATE, config_refresh=60):
+        super().__init__(rates=rates, default_rate=default_rate)
+
+        self.redis = redis
+        self.config_refresh = config_refresh
+
+        self._defaults = dict(self.rates)
+        self._config_loaded = None
+        self._reserve_script = redis.register_script(_RESERVE_SCRIPT)
+
+    def _refresh_config(self):
+        now = time.monotonic()
+        if (
+            self._config_loaded is not None
+            and now - self._config_loaded < self.config_refresh
+        ):
+            return
+
+        rates = dict(self._defaults)
+        for host, value in self.redis.hgetall(CONFIG_KEY).items():
+            rate, burst = value.decode("utf-8").split(",")
+            rates[host.decode("utf-8")] = (float(rate), float(burst))
+
+        self.rates = rates
+        self._config_loaded = now
+
+    def reserve(self, host):
+        self._refresh_config()
+        name, (rate, burst) = self.bucket_for(host)
+
+        wait_ms = self._reserve_script(
+            keys=[BUCKET_KEY_PREFIX + name, STATS_KEY_PREFIX + name],
+            args=[rate, burst],
+        )
+
+        return int(wait_ms) / 1000
+
+    def stats(self):
+        """Get the wait-time metrics for every bucket.
+
+        Returns:
+            dict: Maps bucket names to dicts of `requests`, `waited` and
+                `wait_ms` counters.
+        """
+        ret = {}
+
+        for key in self.redis.scan_iter(match=STATS_KEY_PREFIX + "*"):
+            name = key.decode("utf-8")[len(STATS_KEY_PREFIX) :]
+            ret[name] = dict(
+                (k.decode("utf-8"), int(v)) for k, v in self.redis.hgetall(key).items()
+            )
+
+        return ret
+
+
+LIMITER = LocalRateLimiter()
+
+
+def configure(redis, **kwargs):
+    """Share rate limits with other workers through a Redis instance."""
+    global LIMITER
+
+    LIMITER = RedisRateLimiter(redis, **kwargs)
+    return LIMITER
+
+
+def acquire(url_or_host):
+    """Block until the module-level limiter allows a request to a host."""
+    return LIMITER.acquire(url_or_host)
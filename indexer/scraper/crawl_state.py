@@ -0,0 +1,122 @@
+CRAWL_STATE_KEY_PREFIX = "crawl:"
+
+
+def crawl_state_key(site, character):
+    return "{}{}:{}".format(CRAWL_STATE_KEY_PREFIX, site, character)
+
+
+def _int_or_none(value):
+    return int(value) if value is not None else None
+
+
+class CrawlState(object):
+    """Persistent crawl progress for one (site, character) pair.
+
+    Searches return posts newest first. Each crawl records the highest post
+    ID it has seen (`crawl_top`) and the lowest post ID it has finished
+    processing (`resume_before`) after every page; when a crawl runs to
+    completion, `crawl_top` becomes the pair's `high_water` mark and the
+    in-progress fields are cleared.
+
+    A refresh then only has to search for posts above `high_water`, and a
+    crawl that was interrupted (or stopped at the page limit) picks up below
+    `resume_before`, keeping the same lower bound as before.
+
+    Args:
+        redis (redis.Redis): A Redis interface.
+        site (str): The site being crawled.
+        character (str): The normalized character name.
+        full (bool): Ignore any saved progress and crawl every post. The
+            high-water mark is still updated when the crawl completes.
+    """
+
+    def __init__(self, redis, site, character, full=False):
+        self.redis = redis
+        self.key = crawl_state_key(site, character)
+
+        if full:
+            self.redis.hdel(self.key, "resume_before", "crawl_top")
+
+        high_water, resume_before, crawl_top = self.redis.hmget(
+            self.key, "high_water", "resume_before", "crawl_top"
+        )
+
+        self.full = full
+        self.high_water = _int_or_none(high_water)
+        self.resume_before = _int_or_none(resume_before)
+        self.crawl_top = _int_or_none(crawl_top)
+
+    @property
+    def after_id(self):
+        """Only posts with IDs above this need to be searched for."""
+        return None if self.full else self.high_water
+
+    @property
+    def before_id(self):
+        """Only posts with IDs below this need to be searched for."""
+        return self.resume_before
+
+    def describe(self):
+        if self.after_id is None and self.before_id is None:
+            return "full crawl"
+        elif self.before_id is None:
+            return "refresh from post {:d}".format(self.after_id)
+        elif self.after_id is None:
+            return "resuming below post {:d}".format(self.before_id)
+
+        return "resuming refresh between posts {:d} and {:d}".format(
+            self.after_id, self.before_id
+        )
+
+    def page_done(self, ids):
+        """Record that every post in a page has been processed."""
+        if len(ids) == 0:
+            return
+
+        top, bottom = max(ids), min(ids)
+
+        if self.crawl_top is None or top > self.crawl_top:
+            self.crawl_top = top
+        if self.resume_before is None or bottom < self.resume_before:
+            self.resume_before = bottom
+
+        self.redis.hmset(
+            self.key,
+            {"crawl_top": self.crawl_top, "resume_before": self.resume_before},
+        )
+
+    def finish(self):
+        """Record that the crawl ran to completion."""
+        tops = [h for h in (self.high_water, self.crawl_top) if h is not None]
+
+        tr = self.redis.pipeline()
+        if len(tops) > 0:
+            self.high_water = max(tops)
+            tr.hset(self.key, "high_water", self.high_water)
+        tr.hdel(self.key, "resume_before", "crawl_top")
+        tr.execute()
+
+        self.resume_before = None
+        self.crawl_top = None
+
+    def track(self, pages):
+        """Wrap a search page generator, recording progress as pages are
+        consumed.
+
+        A page counts as done once the next page is requested. The crawl is
+        marked as finished if the wrapped generator returns `True`.
+        """
+        while True:
+            try:
+                page = next(pages)
+            except StopIteration as e:
+                complete = e.value
+                break
+
+            yield page
+            self.page_done([int(d["id"]) for d in page])
+
+        if complete:
+            self.finish()
+
+        return complete
@@ -1,13 +1,16 @@
 import io
 from pathlib import Path
-import time
 
-import requests
 import attr
 import numpy as np
 from rq import Queue
 
+from .. import http, ratelimit
 from ..structures import QueuedImage
+from .crawl_state import CrawlState
+from .enqueue import enqueue_images
+from .paginate import paginate
+from .source_ids import filter_unindexed
 
 base_url = "https://danbooru.donmai.us"
 ratings = {"s": "safe", "q": "questionable", "e": "explicit"}
@@ -37,15 +40,21 @@ def danbooru_post_to_queued_image(normalized_characters, data):
     )
 
 
-def construct_search_endpoint(page, tags, start_id):
+def construct_search_endpoint(page, tags, start_id, after_id=None):
     endpoint = "/posts.json?page={}&limit=200".format(page)
     tags = list(tags)
 
-    if start_id is not None:
+    if start_id is not None or after_id is not None:
         if len(tags) >= 2:
             tags = list(tags[:1])
 
-        tags.append("id%3A%3C" + str(start_id))
+        # a single range metatag, so it only counts once against the tag limit
+        if after_id is None:
+            tags.append("id%3A%3C" + str(start_id))
+        elif start_id is None:
+            tags.append("id%3A%3E" + str(after_id))
+        else:
+            tags.append("id%3A{:d}..{:d}".format(after_id + 1, start_id - 1))
 
     if len(tags) > 0:
         endpoint += "&tags={}".format(
@@ -55,61 +64,82 @@ def construct_search_endpoint(page, tags, start_id):
     return base_url + endpoint
 
 
-def search_api(tags, start_id=None):
-    if len(tags) > 2:
-        raise ValueError("Cannot search for more than two tags at a time")
+def fetch_search_page(tags, page, start_id=None, after_id=None):
+    """Fetch one page of a tag search.
 
-    if start_id is not None:
-        start_id = int(start_id)
+    Returns:
+        list: Post data dicts, or `None` if the request failed.
+    """
+    print("[search] tags: {} - page {}".format(" ".join(tags), page))
+    ratelimit.acquire(base_url)
+    response = http.get(construct_search_endpoint(page, tags, start_id, after_id))
 
-    page = 0
-    n_tries = 0
+    if response.status_code < 200 or response.status_code > 299:
+        print(
+            "    Got error response code {} when retrieving {} page {}".format(
+                str(response.status_code), " ".join(tags), page
+            )
+        )
+        return None
 
-    while page < 1000:
-        time.sleep(0.5)
+    data = response.json()
 
-        if n_tries > 5:
-            print("Giving up.")
-            return
+    if not isinstance(data, list):
+        print("    Got weird response: " + str(data))
+        return None
 
-        print("[search] tags: {} - page {}".format(" ".join(tags), page))
-        response = requests.get(construct_search_endpoint(page, tags, start_id))
+    return data
 
-        if response.status_code < 200 or response.status_code > 299:
-            print(
-                "    Got error response code {} when retrieving {} page {}".format(
-                    str(response.status_code), " ".join(tags), page
-                )
-            )
-            n_tries += 1
-            continue
 
-        data = response.json()
+def search_api_pages(tags, start_id=None, after_id=None, prefetch=None):
+    """Iterate over the pages of a tag search, newest posts first.
 
-        if not isinstance(data, list):
-            print("    Got weird response: " + str(data))
-            n_tries += 1
-            continue
+    Args:
+        tags (list): Up to two tags to search for.
+        start_id (int): If given, only search for posts below this ID.
+        after_id (int): If given, only search for posts above this ID.
+        prefetch (int): How many pages to fetch ahead; see `paginate`.
 
-        if len(data) == 0:
-            return
+    Yields:
+        Lists of post data dicts, with excluded posts filtered out.
 
-        page += 1
-        n_tries = 0
+    Returns:
+        bool: `True` if the search ran to completion, `False` if it gave up
+            or hit the page limit.
+    """
+    if len(tags) > 2:
+        raise ValueError("Cannot search for more than two tags at a time")
 
-        ids = list(int(d["id"]) for d in data)
-        last_id = min(ids)
+    if start_id is not None:
+        start_id = int(start_id)
 
-        if start_id is not None and last_id > start_id:
-            continue
+    if after_id is not None:
+        after_id = int(after_id)
 
-        for d in data:
-            ts = d["tag_string"].split()
+    def process(data):
+        last_id = min(int(d["id"]) for d in data)
+
+        if start_id is not None and last_id > start_id:
+            return None
+
+        return [
+            d
+            for d in data
+            if not any(t in exclude_tags for t in d["tag_string"].split())
+        ]
+
+    return (
+        yield from paginate(
+            lambda page: fetch_search_page(tags, page, start_id, after_id),
+            process,
+            prefetch,
+        )
+    )
 
-            if any(t in exclude_tags for t in ts):
-                continue
 
-            yield d
+def search_api(tags, start_id=None):
+    for page in search_api_pages(tags, start_id):
+        yield from page
 
 
 def associate_character_tag(redis, normalized_character, character_tag):
@@ -121,35 +151,51 @@ def associate_character_tag(redis, normalized_character, character_tag):
     tr.execute()
 
 
-def index_character(redis, normalized_character):
+def index_character(redis, normalized_character, full=False):
     character_tag = redis.get("danbooru:characters:" + normalized_character)
     if character_tag is None:
         return
 
     character_tag = character_tag.decode("utf-8")
 
+    state = CrawlState(redis, "danbooru", normalized_character, full=full)
+    print("Danbooru: {} ({})".format(normalized_character, state.describe()))
+
+    pages = search_api_pages([character_tag], state.before_id, state.after_id)
+
     queue = Queue("backend-index", connection=redis)
-    for post_data in search_api([character_tag]):
-        if redis.sismember("index:sites:danbooru:source_ids", post_data["id"]):
-            continue
+    for page in state.track(pages):
+        unindexed = set(filter_unindexed(redis, "danbooru", [d["id"] for d in page]))
 
-        queue_data = danbooru_post_to_queued_image((normalized_character,), post_data)
+        to_enqueue = []
 
-        # check URL filetype:
-        if queue_data.source_url is None:
-            continue
+        for post_data in page:
+            if post_data["id"] not in unindexed:
+                continue
 
-        # pylint: disable=no-member
-        splits = queue_data.source_url.rsplit(".", maxsplit=1)
+            queue_data = danbooru_post_to_queued_image(
+                (normalized_character,), post_data
+            )
 
-        if len(splits) == 2:
-            if splits[1] not in ["png", "jpeg", "jpg", "gif"]:
+            # check URL filetype:
+            if queue_data.source_url is None:
                 continue
-        else:
-            continue
 
-        queue.enqueue("indexer.backend.worker.process_queued_image", queue_data)
-        print("Danbooru: Enqueued post {} for indexing".format(queue_data.source_id))
+            # pylint: disable=no-member
+            splits = queue_data.source_url.rsplit(".", maxsplit=1)
+
+            if len(splits) == 2:
+                if splits[1] not in ["png", "jpeg", "jpg", "gif"]:
+                    continue
+            else:
+                continue
+
+            to_enqueue.append(queue_data)
+
+        enqueue_images(queue, to_enqueue)
+        print("Danbooru: Enqueued {:d} posts for indexing".format(len(to_enqueue)))
+
+    print("[http] " + http.format_stats())
 
 
 ops = {"index": index_character, "associate": associate_character_tag}
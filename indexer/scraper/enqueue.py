@@ -0,0 +1,92 @@
+from ..tag_dict import get_tag_dictionary
+
+PROCESS_FUNC = "indexer.backend.worker.process_queued_image"
+PROCESS_BATCH_FUNC = "indexer.backend.worker.process_queued_images"
+PROCESS_PACKED_FUNC = "indexer.backend.worker.process_packed_image"
+PROCESS_PACKED_BATCH_FUNC = "indexer.backend.worker.process_packed_images"
+
+# number of images carried by each backend job; 1 enqueues one job per image
+BATCH_SIZE = 1
+
+# job timeouts, in seconds: batch jobs get JOB_TIMEOUT_PER_IMAGE for each of
+# their images (downloads can queue behind shared per-host rate limits), but
+# never less than a single-image job
+JOB_TIMEOUT = 180
+JOB_TIMEOUT_PER_IMAGE = 60
+
+# send images as `QueuedImage.pack` payloads rather than pickled objects; the
+# pinned RQ version has no pluggable serializers, so jobs carry the packed
+# bytes as their only argument instead
+PACKED = True
+
+
+def _describe(queued_images):
+    return ", ".join(q.source_site + "#" + q.source_id for q in queued_images)
+
+
+def job_timeout(n_images):
+    """Get the timeout for a job carrying `n_images` images, in seconds."""
+    return max(JOB_TIMEOUT, JOB_TIMEOUT_PER_IMAGE * n_images)
+
+
+def enqueue_images(queue, queued_images, batch_size=None, packed=None):
+    """Enqueue a list of images for indexing, in one pipelined round trip.
+
+    Args:
+        queue (rq.Queue): The `backend-index` queue.
+        queued_images (list): `QueuedImage`s to enqueue.
+        batch_size (int): How many images each job carries; defaults to
+            `BATCH_SIZE`. With more than one image per job, the backend
+            worker processes them with `process_queued_images`.
+        packed (bool): Whether to send images in their packed form; defaults
+            to `PACKED`.
+
+    Returns:
+        list: The enqueued jobs.
+    """
+    if batch_size is None:
+        batch_size = BATCH_SIZE
+
+    if packed is None:
+        packed = PACKED
+
+    if packed:
+        tag_dict = get_tag_dictionary(queue.connection)
+
+        # intern the whole page's tags at once
+        tag_dict.ids(t for q in queued_images for t in q.source_tags)
+
+        payloads = [q.pack(tag_dict) for q in queued_images]
+        func, batch_func = PROCESS_PACKED_FUNC, PROCESS_PACKED_BATCH_FUNC
+    else:
+        payloads = list(queued_images)
+        func, batch_func = PROCESS_FUNC, PROCESS_BATCH_FUNC
+
+    # RQ defaults to the full call repr (every tag) as the job description
+    if batch_size > 1:
+        jobs = [
+            queue.create_job(
+                batch_func,
+                args=(payloads[i : i + batch_size],),
+                timeout=job_timeout(len(payloads[i : i + batch_size])),
+                description=_describe(queued_images[i : i + batch_size]),
+            )
+            for i in range(0, len(payloads), batch_size)
+        ]
+    else:
+        jobs = [
+            queue.create_job(
+                func, args=(p,), timeout=job_timeout(1), description=_describe([q])
+            )
+            for q, p in zip(queued_images, payloads)
+        ]
+
+    if len(jobs) == 0:
+        return jobs
+
+    tr = queue.connection.pipeline()
+    for job in jobs:
+        queue.enqueue_job(job, pipeline=tr)
+    tr.execute()
+
+    return jobs
@@ -1,37 +1,78 @@
 import io
 from pathlib import Path
-import time
+import re
 
-from bs4 import BeautifulSoup
-import requests
+from bs4 import BeautifulSoup, SoupStrainer
 import attr
 import numpy as np
 from rq import Queue
 
+from .. import http, ratelimit
 from ..structures import QueuedImage
+from .crawl_state import CrawlState
+from .enqueue import enqueue_images
+from .gelbooru_tags import ARTIST, UNKNOWN, TagTypeResolver, parse_tag_type
+from .paginate import paginate
+from .source_ids import filter_unindexed
 
 base_url = "https://gelbooru.com/"
 ratings = {"s": "safe", "q": "questionable", "e": "explicit"}
 exclude_tags = ["loli", "shota", "bestiality", "guro", "shadman"]
 
 
-def gelbooru_post_to_queued_image(normalized_characters, data):
-    tags = data["tags"].split()
+def scrape_post_tag_types(post_id, tags):
+    """Find the types of a post's tags by scraping its HTML page.
 
-    resp = requests.get(
-        "https://gelbooru.com/index.php?page=post&s=view&id=" + str(data["id"])
-    )
-    soup = BeautifulSoup(resp.text)
-    artists = []
+    This is only needed when the tag API can't resolve the post's tags. Every
+    tag list item is parsed, so the types of all of the post's tags can be
+    recorded, not just its artists.
+
+    Returns:
+        dict: Maps the post's tags to numeric types. Tags missing from the
+            page, or with unrecognized types, are left out.
+    """
+    ratelimit.acquire(base_url)
+    resp = http.get(base_url + "index.php?page=post&s=view&id=" + str(post_id))
 
-    for artist_li in soup.find_all(
-        "li", attrs={"class": "tag-type-artist"}, recursive=True
-    ):
-        for a_elem in artist_li.find_all("a", recursive=True):
+    strainer = SoupStrainer("li", attrs={"class": re.compile("^tag-type-")})
+    soup = BeautifulSoup(resp.text, "html.parser", parse_only=strainer)
+    tag_types = {}
+
+    for tag_li in soup.find_all("li", recursive=True):
+        tag_type = UNKNOWN
+        for cls in tag_li.get("class", []):
+            if cls.startswith("tag-type-"):
+                tag_type = parse_tag_type(cls[len("tag-type-") :])
+
+        if tag_type == UNKNOWN:
+            continue
+
+        for a_elem in tag_li.find_all("a", recursive=True):
             text = "".join(str(t) for t in a_elem.stripped_strings)
 
             if text != "?" and text in tags:
-                artists.append(text)
+                tag_types[text] = tag_type
+
+    return tag_types
+
+
+def gelbooru_post_to_queued_image(normalized_characters, data, resolver=None):
+    tags = data["tags"].split()
+    artists = None
+
+    if resolver is not None:
+        tag_types = resolver.resolve(tags)
+
+        # tags without a known type are left out, and fall back to the HTML
+        if all(t in tag_types for t in tags):
+            artists = [t for t in tags if tag_types[t] == ARTIST]
+
+    if artists is None:
+        tag_types = scrape_post_tag_types(data["id"], tags)
+        artists = [t for t in tags if tag_types.get(t) == ARTIST]
+
+        if resolver is not None:
+            resolver.record(tag_types)
 
     return QueuedImage(
         source_site="gelbooru",
@@ -45,10 +86,16 @@ def gelbooru_post_to_queued_image(normalized_characters, data):
     )
 
 
-def construct_search_endpoint(page, tags):
+def construct_search_endpoint(page, tags, start_id=None, after_id=None):
     endpoint = "/index.php?page=dapi&s=post&q=index&json=1&pid={:d}".format(page)
     tags = list(tags)
 
+    if start_id is not None:
+        tags.append("id%3A%3C" + str(start_id))
+
+    if after_id is not None:
+        tags.append("id%3A%3E" + str(after_id))
+
     if len(tags) > 0:
         endpoint += "&tags={}".format(
             "+".join(map(lambda s: str(s).lower().strip(), tags))
@@ -57,49 +104,67 @@ def construct_search_endpoint(page, tags):
     return base_url + endpoint
 
 
-def search_api(tags):
-    page = 0
-    n_tries = 0
+def fetch_search_page(tags, page, start_id=None, after_id=None):
+    """Fetch one page of a tag search.
 
-    while page < 1000:
-        time.sleep(0.5)
+    Returns:
+        list: Post data dicts, or `None` if the request failed.
+    """
+    print("[search] tags: {} - page {}".format(" ".join(tags), page))
+    ratelimit.acquire(base_url)
+    response = http.get(construct_search_endpoint(page, tags, start_id, after_id))
 
-        if n_tries > 5:
-            print("Giving up.")
-            return
+    if response.status_code < 200 or response.status_code > 299:
+        print(
+            "    Got error response code {} when retrieving {} page {}".format(
+                str(response.status_code), " ".join(tags), page
+            )
+        )
+        return None
 
-        print("[search] tags: {} - page {}".format(" ".join(tags), page))
-        response = requests.get(construct_search_endpoint(page, tags))
+    data = response.json()
 
-        if response.status_code < 200 or response.status_code > 299:
-            print(
-                "    Got error response code {} when retrieving {} page {}".format(
-                    str(response.status_code), " ".join(tags), page
-                )
-            )
-            n_tries += 1
-            continue
+    if not isinstance(data, list):
+        print("    Got weird response: " + str(data))
+        return None
 
-        data = response.json()
+    return data
 
-        if not isinstance(data, list):
-            print("    Got weird response: " + str(data))
-            n_tries += 1
-            continue
 
-        if len(data) == 0:
-            return
+def search_api_pages(tags, start_id=None, after_id=None, prefetch=None):
+    """Iterate over the pages of a tag search, newest posts first.
 
-        page += 1
-        n_tries = 0
+    Args:
+        tags (list): Tags to search for.
+        start_id (int): If given, only search for posts below this ID.
+        after_id (int): If given, only search for posts above this ID.
+        prefetch (int): How many pages to fetch ahead; see `paginate`.
 
-        for d in data:
-            ts = d["tags"].split()
+    Yields:
+        Lists of post data dicts, with excluded posts filtered out.
 
-            if any(t in exclude_tags for t in ts):
-                continue
+    Returns:
+        bool: `True` if the search ran to completion, `False` if it gave up
+            or hit the page limit.
+    """
 
-            yield d
+    def process(data):
+        return [
+            d for d in data if not any(t in exclude_tags for t in d["tags"].split())
+        ]
+
+    return (
+        yield from paginate(
+            lambda page: fetch_search_page(tags, page, start_id, after_id),
+            process,
+            prefetch,
+        )
+    )
+
+
+def search_api(tags):
+    for page in search_api_pages(tags):
+        yield from page
 
 
 def associate_character_tag(redis, normalized_character, character_tag):
@@ -111,7 +176,7 @@ def associate_character_tag(redis, normalized_character, character_tag):
     tr.execute()
 
 
-def index_character(redis, normalized_character):
+def index_character(redis, normalized_character, full=False):
     character_tags = redis.get("gelbooru:characters:" + normalized_character)
     if character_tags is None:
         return
@@ -119,28 +184,47 @@ def index_character(redis, normalized_character):
     character_tags = character_tags.decode("utf-8")
     character_tags = character_tags.split(",")
 
+    state = CrawlState(redis, "gelbooru", normalized_character, full=full)
+    print("Gelbooru: {} ({})".format(normalized_character, state.describe()))
+
+    pages = search_api_pages(character_tags, state.before_id, state.after_id)
+
     queue = Queue("backend-index", connection=redis)
-    for post_data in search_api(character_tags):
-        if redis.sismember("index:sites:gelbooru:source_ids", post_data["id"]):
-            continue
+    resolver = TagTypeResolver(redis)
 
-        queue_data = gelbooru_post_to_queued_image((normalized_character,), post_data)
+    for page in state.track(pages):
+        unindexed = set(filter_unindexed(redis, "gelbooru", [d["id"] for d in page]))
+        page = [post_data for post_data in page if post_data["id"] in unindexed]
 
-        # check URL filetype:
-        if queue_data.source_url is None:
-            continue
+        # resolve every tag on the page at once, in as few requests as possible
+        resolver.resolve(t for post_data in page for t in post_data["tags"].split())
 
-        # pylint: disable=no-member
-        splits = queue_data.source_url.rsplit(".", maxsplit=1)
+        to_enqueue = []
 
-        if len(splits) == 2:
-            if splits[1] not in ["png", "jpeg", "jpg", "gif"]:
+        for post_data in page:
+            queue_data = gelbooru_post_to_queued_image(
+                (normalized_character,), post_data, resolver
+            )
+
+            # check URL filetype:
+            if queue_data.source_url is None:
                 continue
-        else:
-            continue
 
-        queue.enqueue("indexer.backend.worker.process_queued_image", queue_data)
-        print("Gelbooru: Enqueued post {} for indexing".format(queue_data.source_id))
+            # pylint: disable=no-member
+            splits = queue_data.source_url.rsplit(".", maxsplit=1)
+
+            if len(splits) == 2:
+                if splits[1] not in ["png", "jpeg", "jpg", "gif"]:
+                    continue
+            else:
+                continue
+
+            to_enqueue.append(queue_data)
+
+        enqueue_images(queue, to_enqueue)
+        print("Gelbooru: Enqueued {:d} posts for indexing".format(len(to_enqueue)))
+
+    print("[http] " + http.format_stats())
 
 
 ops = {"index": index_character, "associate": associate_character_tag}
@@ -0,0 +1,207 @@
+import time
+
+from .. import http, ratelimit
+
+base_url = "https://gelbooru.com/"
+
+TAG_TYPES_KEY = "gelbooru:tag_types"
+
+# tags the tag API couldn't type, scored by when they may be looked up again
+UNKNOWN_TAGS_KEY = "gelbooru:tag_types:unknown"
+UNKNOWN_TTL = 24 * 3600
+
+# Gelbooru's numeric tag types
+GENERAL = 0
+ARTIST = 1
+COPYRIGHT = 3
+CHARACTER = 4
+METADATA = 5
+DEPRECATED = 6
+
+# returned by `parse_tag_type` for unrecognized types; never cached as a type
+UNKNOWN = -1
+
+type_names = {
+    "general": GENERAL,
+    "tag": GENERAL,
+    "artist": ARTIST,
+    "copyright": COPYRIGHT,
+    "character": CHARACTER,
+    "metadata": METADATA,
+    "deprecated": DEPRECATED,
+}
+
+
+def parse_tag_type(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return type_names.get(str(value).lower(), UNKNOWN)
+
+
+def fetch_tag_types(names):
+    """Look up the types of a batch of tags with Gelbooru's tag API.
+
+    Returns:
+        dict: Maps tag names to numeric types, or `None` if the request
+            failed. Tags the API had no entry for are left out.
+    """
+    ratelimit.acquire(base_url)
+    response = http.get(
+        base_url + "index.php",
+        params={
+            "page": "dapi",
+            "s": "tag",
+            "q": "index",
+            "json": "1",
+            "limit": str(len(names)),
+            "names": " ".join(names),
+        },
+    )
+
+    if response.status_code < 200 or response.status_code > 299:
+        print(
+            "    Got error response code {} when retrieving tag types".format(
+                response.status_code
+            )
+        )
+        return None
+
+    try:
+        data = response.json()
+    except ValueError:
+        print("    Got non-JSON response when retrieving tag types")
+        return None
+
+    # newer API versions wrap the tag list in an object
+    if isinstance(data, dict):
+        data = data.get("tag", [])
+
+    if not isinstance(data, list):
+        print("    Got weird tag response: " + str(data))
+        return None
+
+    return dict((tag["name"], parse_tag_type(tag.get("type"))) for tag in data)
+
+
+class TagTypeResolver(object):
+    """Resolves Gelbooru tag types through a persistent cache.
+
+    Types are looked up in an in-process dict first, then in a Redis hash
+    shared by every scraper, and only tags missing from both are fetched
+    from the tag API, `batch_size` names per request. This lets whole result
+    pages be resolved with at most a few requests, instead of scraping every
+    post's HTML page.
+
+    Tags the API has no type for stay unresolved, so callers fall back to
+    another source. They are only remembered for `unknown_ttl` seconds, so
+    they aren't requested again on every page, but are retried later.
+
+    Args:
+        redis (redis.Redis): A Redis interface.
+        key (str): The Redis hash to cache tag types in.
+        batch_size (int): Maximum number of tags per tag API request.
+        unknown_ttl (float): How long to wait before looking up a tag the API
+            couldn't type again, in seconds.
+    """
+
+    def __init__(self, redis, key=TAG_TYPES_KEY, batch_size=100, unknown_ttl=None):
+        self.redis = redis
+        self.key = key
+        self.batch_size = batch_size
+        self.unknown_ttl = unknown_ttl if unknown_ttl is not None else UNKNOWN_TTL
+
+        self.cache = {}
+        self.unknown = set()
+        self.n_api_requests = 0
+
+    def _load(self, tags):
+        """Fill the in-process caches from Redis.
+
+        Returns:
+            list: The tags that have to be fetched from the API.
+        """
+        tr = self.redis.pipeline(transaction=False)
+        tr.hmget(self.key, tags)
+        for tag in tags:
+            tr.zscore(UNKNOWN_TAGS_KEY, tag)
+        results = tr.execute()
+
+        values, retry_at = results[0], results[1:]
+        now = time.time()
+        missing = []
+
+        for tag, value, score in zip(tags, values, retry_at):
+            # earlier versions stored UNKNOWN in the hash itself
+            if value is not None and int(value) != UNKNOWN:
+                self.cache[tag] = int(value)
+            elif score is not None and score > now:
+                self.unknown.add(tag)
+            else:
+                missing.append(tag)
+
+        return missing
+
+    def resolve(self, tags):
+        """Get the types of a collection of tags.
+
+        Returns:
+            dict: Maps tags to numeric types. Tags whose types are unknown
+                (because the tag API failed, or had no type for them) are
+                left out.
+        """
+        tags = set(tags)
+        missing = sorted(
+            t for t in tags if t not in self.cache and t not in self.unknown
+        )
+
+        if len(missing) > 0:
+            missing = self._load(missing)
+
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i : i + self.batch_size]
+
+            fetched = fetch_tag_types(batch)
+            self.n_api_requests += 1
+
+            if fetched is None:
+                continue
+
+            found = dict(
+                (tag, fetched[tag])
+                for tag in batch
+                if fetched.get(tag, UNKNOWN) != UNKNOWN
+            )
+            unknown = [tag for tag in batch if tag not in found]
+
+            tr = self.redis.pipeline(transaction=False)
+
+            if len(found) > 0:
+                tr.hmset(self.key, found)
+
+            if len(unknown) > 0:
+                retry_at = time.time() + self.unknown_ttl
+
+                tr.hdel(self.key, *unknown)
+                tr.zadd(UNKNOWN_TAGS_KEY, dict((tag, retry_at) for tag in unknown))
+                tr.zremrangebyscore(UNKNOWN_TAGS_KEY, "-inf", time.time())
+
+            tr.execute()
+
+            self.cache.update(found)
+            self.unknown.update(unknown)
+
+        return dict((t, self.cache[t]) for t in tags if t in self.cache)
+
+    def record(self, tag_types):
+        """Store tag types discovered some other way (e.g. from post HTML)."""
+        if len(tag_types) == 0:
+            return
+
+        tr = self.redis.pipeline(transaction=False)
+        tr.hmset(self.key, tag_types)
+        tr.zrem(UNKNOWN_TAGS_KEY, *tag_types.keys())
+        tr.execute()
+
+        self.cache.update(tag_types)
+        self.unknown.difference_update(tag_types.keys())
@@ -0,0 +1,95 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# number of search pages requested ahead of the one being consumed; requests
+# still go through the per-host rate limiter, so this only hides latency
+PREFETCH_PAGES = 3
+
+
+def _fetch_and_process(fetch_page, process, page):
+    data = fetch_page(page)
+
+    if data is None or len(data) == 0 or process is None:
+        return data, data
+
+    return data, process(data)
+
+
+def paginate(fetch_page, process=None, prefetch=None, max_pages=1000, max_tries=5):
+    """Iterate over the pages of a numbered search.
+
+    With `prefetch` > 0, up to that many pages are fetched and processed on
+    background threads while earlier pages are being consumed, so network
+    waits and JSON parsing overlap with the consumer's work. Pages are still
+    yielded in order, and the generator is consumed lazily.
+
+    Args:
+        fetch_page (callable): Takes a page number, and returns the list of
+            results on that page, or `None` if the request failed. An empty
+            list marks the end of the search.
+        process (callable): Optionally transforms each non-empty page before
+            it is yielded. Pages it returns `None` for are skipped.
+        prefetch (int): How many pages to keep in flight; defaults to
+            `PREFETCH_PAGES`. 0 fetches pages one at a time on the calling
+            thread.
+        max_pages (int): Stop after this many pages.
+        max_tries (int): Give up after a page fails this many times in a row.
+
+    Yields:
+        Processed pages.
+
+    Returns:
+        bool: `True` if the search ran to completion, `False` if it gave up
+            or hit the page limit.
+    """
+    if prefetch is None:
+        prefetch = PREFETCH_PAGES
+
+    executor = ThreadPoolExecutor(max_workers=prefetch) if prefetch > 0 else None
+    pending = deque()
+    next_page = 0
+
+    try:
+        while True:
+            if executor is not None:
+                while len(pending) < prefetch and next_page < max_pages:
+                    future = executor.submit(
+                        _fetch_and_process, fetch_page, process, next_page
+                    )
+                    pending.append((next_page, future))
+                    next_page += 1
+
+                if len(pending) == 0:
+                    return False
+
+                page, future = pending.popleft()
+                data, processed = future.result()
+            else:
+                if next_page >= max_pages:
+                    return False
+
+                page = next_page
+                next_page += 1
+                data, processed = _fetch_and_process(fetch_page, process, page)
+
+            # retry failed pages in order, on this thread
+            n_tries = 1
+            while data is None:
+                if n_tries > max_tries:
+                    print("Giving up.")
+                    return False
+
+                data, processed = _fetch_and_process(fetch_page, process, page)
+                n_tries += 1
+
+            if len(data) == 0:
+                return True
+
+            if processed is not None:
+                yield processed
+    finally:
+        if executor is not None:
+            for _, future in pending:
+                future.cancel()
+
+            executor.shutdown(wait=True)
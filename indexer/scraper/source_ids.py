@@ -0,0 +1,102 @@
+import time
+
+from ..bloom import BloomFilter
+
+# When enabled, crawls keep an in-process Bloom filter of every indexed
+# source ID per site. Posts the filter reports as known are skipped without
+# touching Redis; only the (few) new posts on a page are checked, so re-crawls
+# of fully indexed characters make almost no Redis requests. Forking workers
+# should seed the filters in the parent (see `refresh_bloom_filters`), so
+# each job inherits them instead of seeding its own.
+USE_BLOOM_FILTER = False
+BLOOM_ERROR_RATE = 1e-6
+BLOOM_MAX_AGE = 3600
+
+_bloom_filters = {}
+
+
+def source_ids_key(site):
+    return "index:sites:" + site + ":source_ids"
+
+
+def seed_bloom_filter(redis, site, batch_size=10000):
+    """Build a Bloom filter of a site's indexed source IDs."""
+    key = source_ids_key(site)
+
+    # leave room for the IDs added over the filter's lifetime
+    bloom = BloomFilter(max(redis.scard(key) * 3 // 2, 1024), BLOOM_ERROR_RATE)
+    batch = []
+
+    for source_id in redis.sscan_iter(key, count=batch_size):
+        batch.append(source_id)
+
+        if len(batch) >= batch_size:
+            bloom.update(batch)
+            batch = []
+
+    bloom.update(batch)
+    return bloom
+
+
+def get_bloom_filter(redis, site):
+    """Get a site's Bloom filter, (re)seeding it if it is missing, old or full."""
+    bloom, seeded_at = _bloom_filters.get(site, (None, 0))
+
+    if (
+        bloom is None
+        or time.monotonic() - seeded_at > BLOOM_MAX_AGE
+        or len(bloom) > bloom.capacity
+    ):
+        start = time.perf_counter()
+        bloom = seed_bloom_filter(redis, site)
+        _bloom_filters[site] = (bloom, time.monotonic())
+
+        print(
+            "[source ids] Seeded {} Bloom filter with {:d} IDs in {:.2f}s".format(
+                site, len(bloom), time.perf_counter() - start
+            )
+        )
+
+    return bloom
+
+
+def refresh_bloom_filters(redis, sites):
+    """Seed or reseed the Bloom filters of several sites, where needed."""
+    for site in sites:
+        get_bloom_filter(redis, site)
+
+
+def filter_unindexed(redis, site, source_ids):
+    """Find which of a page of source IDs have not been indexed yet.
+
+    IDs are checked with one pipelined round trip. With `USE_BLOOM_FILTER`,
+    IDs in the site's Bloom filter are assumed indexed, and only the rest are
+    checked.
+
+    Returns:
+        list: The unindexed source IDs, in their original order.
+    """
+    candidates = list(source_ids)
+    bloom = None
+
+    if USE_BLOOM_FILTER:
+        bloom = get_bloom_filter(redis, site)
+        known = bloom.contains_many(candidates)
+        candidates = [i for i, k in zip(candidates, known) if not k]
+
+    if len(candidates) == 0:
+        return []
+
+    key = source_ids_key(site)
+    tr = redis.pipeline(transaction=False)
+
+    for source_id in candidates:
+        tr.sismember(key, source_id)
+
+    results = tr.execute()
+
+    if bloom is not None:
+        # IDs indexed since the filter was seeded
+        bloom.update(i for i, indexed in zip(candidates, results) if indexed)
+
+    return [i for i, indexed in zip(candidates, results) if not indexed]
@@ -4,6 +4,8 @@ import os
 from redis import Redis
 from rq import Connection, Worker
 
+from .. import http, ratelimit
+from . import enqueue, paginate, source_ids
 from .danbooru import ops as danbooru_ops
 from .gelbooru import ops as gelbooru_ops
 
@@ -14,10 +16,27 @@ WORKER_ID = None
 site_ops = {"danbooru": danbooru_ops, "gelbooru": gelbooru_ops}
 
 
-def do_indexing_crawl(site, character):
+class ScraperWorker(Worker):
+    """An RQ worker that refreshes the source ID Bloom filters before waiting
+    for each job, so the job's forked work horse inherits them. Filters seeded
+    in a work horse would be lost with it when the job ends.
+
+    Filters are seeded when the worker starts, and reseeded when they age out,
+    while no job is dequeued, so a slow seed of a large index doesn't hold up
+    a job or count against its timeout.
+    """
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        if source_ids.USE_BLOOM_FILTER:
+            source_ids.refresh_bloom_filters(self.connection, site_ops.keys())
+
+        return super().dequeue_job_and_maintain_ttl(timeout)
+
+
+def do_indexing_crawl(site, character, full=False):
     global REDIS
 
-    site_ops[site]["index"](REDIS, character)
+    site_ops[site]["index"](REDIS, character, full=full)
 
 
 def do_associate_character(site, character, tags):
@@ -33,9 +52,27 @@ def main():
 
     REDIS = Redis.from_url(redis_url)
     WORKER_ID = int(sys.argv[2])
+    source_ids.USE_BLOOM_FILTER = "--bloom" in sys.argv[3:]
+    pool_size = None
+
+    for arg in sys.argv[3:]:
+        if arg.startswith("--prefetch="):
+            paginate.PREFETCH_PAGES = int(arg[len("--prefetch=") :])
+        elif arg.startswith("--batch="):
+            enqueue.BATCH_SIZE = int(arg[len("--batch=") :])
+        elif arg.startswith("--pool-size="):
+            pool_size = int(arg[len("--pool-size=") :])
+
+    # prefetch threads and the crawl itself each hold a connection to the
+    # site being crawled
+    if pool_size is None:
+        pool_size = max(http.DEFAULT_POOL_SIZE, paginate.PREFETCH_PAGES + 1)
+
+    http.configure(pool_maxsize=pool_size)
+    ratelimit.configure(REDIS)
 
     with Connection(REDIS):
-        worker = Worker(
+        worker = ScraperWorker(
             ["scraper"], name="scraper-{:d}-{:d}".format(WORKER_ID, os.getpid())
         )
         worker.work()
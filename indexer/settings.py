@@ -0,0 +1,27 @@
+import os
+
+# prefix of the environment variables the API server loads its config from;
+# settings that the indexer's writers and the API have to agree on are read
+# from the same variables
+ENV_PREFIX = "WAIFUSTREAM_"
+
+_FALSE_VALUES = ("", "0", "false", "no", "off")
+
+
+def env_flag(name, default=False):
+    """Read a boolean setting from the `WAIFUSTREAM_<name>` environment
+    variable.
+
+    Args:
+        name (str): The setting name, e.g. `PACKED_RECORDS`.
+        default (bool): The value to use if the variable is not set.
+
+    Returns:
+        bool: False if the variable is set to an empty string, `0`, `false`,
+            `no` or `off` (in any case); True for any other value.
+    """
+    value = os.environ.get(ENV_PREFIX + name)
+    if value is None:
+        return default
+
+    return value.strip().lower() not in _FALSE_VALUES
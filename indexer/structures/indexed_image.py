@@ -1,11 +1,62 @@
 import attr
+import msgpack
 import numpy as np
 import os.path as osp
 
+from ..bitmap import add_to_facets, assign_ordinal, image_facets
+from ..index import add_to_hash_index
+from ..settings import env_flag
 from ..snowflake import get_timestamp
+from ..tag_dict import get_tag_dictionary
 from .queued_image import QueuedImage
 
 
+# version 1 records hold source tags as strings; version 2 records hold
+# tag dictionary IDs
+PACKED_RECORD_VERSION = 2
+
+# Whether `save_to_index` writes packed records, and loads read them. Packed
+# records are stored alongside the normalized hash and sets, so they trade
+# Redis memory for single-GET loads; enable them (and backfill existing images
+# with scripts/migrate_packed_records.py) only where memory allows. Set by
+# WAIFUSTREAM_PACKED_RECORDS, which the API reads as well.
+PACKED_RECORDS = env_flag("PACKED_RECORDS")
+
+# Whether images are added to the facet bitmaps as they are indexed. This
+# costs an ordinal assignment and a script call per facet, so enable it (after
+# backfilling with scripts/build_filter_bitmaps.py) only where the bitmaps are
+# queried. Set by WAIFUSTREAM_FILTER_BITMAPS, which also switches the API to
+# bitmap queries, so the bitmaps are maintained wherever they are read.
+FILTER_BITMAPS = env_flag("FILTER_BITMAPS")
+
+# pub/sub channel announcing index changes, as `image:<id>` and
+# `character:<name>` messages
+INVALIDATION_CHANNEL = "index:invalidate"
+
+
+# position of `QueuedImage.characters` in a packed record
+_PACKED_CHARACTERS_FIELD = 2 + [f.name for f in attr.fields(QueuedImage)].index(
+    "characters"
+)
+
+
+def replace_packed_character(data, old_name, new_name):
+    """Replace a character in a packed record, leaving its other fields
+    (including tag IDs) as they are.
+
+    Returns:
+        bytes: The updated record.
+    """
+    fields = IndexedImage._decode_packed(data)
+    characters = fields[_PACKED_CHARACTERS_FIELD]
+
+    fields[_PACKED_CHARACTERS_FIELD] = [c for c in characters if c != old_name]
+    if new_name not in characters:
+        fields[_PACKED_CHARACTERS_FIELD].append(new_name)
+
+    return msgpack.packb(fields, use_bin_type=True)
+
+
 def _cvt_imhash(h):
     if isinstance(h, np.ndarray):
         return h.tobytes()
@@ -45,23 +96,12 @@ class IndexedImage(object):
         return getattr(self.queued_img_data, name)
 
     @classmethod
-    def load_from_index(cls, redis, img_id):
-        redis_key = "index:image:" + str(img_id)
-        exists = redis.exists(redis_key)
-
-        if not exists:
-            raise KeyError("No image " + str(img_id) + " exists in index")
-
-        ret_data = redis.hgetall(redis_key)
+    def _from_redis_data(cls, img_id, ret_data, characters, authors, source_tags):
         data = {}
 
         for key, value in ret_data.items():
             data[key.decode("utf-8")] = value
 
-        characters = redis.smembers(redis_key + ":characters")
-        authors = redis.smembers(redis_key + ":authors")
-        source_tags = redis.smembers(redis_key + ":source_tags")
-
         queued_img_data = QueuedImage.from_redis_data(
             data, characters, authors, source_tags
         )
@@ -70,38 +110,332 @@ class IndexedImage(object):
             img_id=img_id, imhash=data["imhash"], queued_img_data=queued_img_data
         )
 
+    def pack(self, tag_dict):
+        """Encode this image as a compact msgpack record.
+
+        Args:
+            tag_dict (TagDictionary): The dictionary used to store source tags
+                as integer IDs.
+
+        Returns:
+            bytes: The encoded record, as stored in `index:image:<id>:packed`.
+        """
+        fields = list(attr.astuple(self.queued_img_data, retain_collection_types=True))
+        fields[-1] = tag_dict.ids(fields[-1])
+
+        return msgpack.packb(
+            [PACKED_RECORD_VERSION, self.imhash] + fields, use_bin_type=True
+        )
+
+    @staticmethod
+    def _decode_packed(data):
+        fields = msgpack.unpackb(data, raw=False)
+
+        if fields[0] not in (1, PACKED_RECORD_VERSION):
+            raise ValueError("Unsupported packed record version " + str(fields[0]))
+
+        return fields
+
+    @staticmethod
+    def _packed_tag_ids(fields):
+        return fields[-1] if fields[0] == PACKED_RECORD_VERSION else []
+
     @classmethod
-    async def load_from_index_async(cls, aredis, img_id):
+    def _from_packed_fields(cls, img_id, fields, tag_strings):
+        queued_fields = fields[2:]
+
+        if fields[0] == PACKED_RECORD_VERSION:
+            queued_fields[-1] = [tag_strings[i] for i in queued_fields[-1]]
+
+        return cls(
+            img_id=img_id, imhash=fields[1], queued_img_data=QueuedImage(*queued_fields)
+        )
+
+    @classmethod
+    def unpack(cls, img_id, data, tag_dict):
+        """Decode a record produced by `pack`.
+
+        Args:
+            img_id (int): The ID of the image the record belongs to.
+            data (bytes): The encoded record.
+            tag_dict (TagDictionary): The dictionary the record was encoded
+                with.
+        """
+        fields = cls._decode_packed(data)
+        tag_ids = cls._packed_tag_ids(fields)
+
+        return cls._from_packed_fields(
+            img_id, fields, dict(zip(tag_ids, tag_dict.strings(tag_ids)))
+        )
+
+    @classmethod
+    def load_from_index(cls, redis, img_id, packed=None):
+        redis_key = "index:image:" + str(img_id)
+
+        tag_dict = get_tag_dictionary(redis)
+
+        if packed is None:
+            packed = PACKED_RECORDS
+
+        if packed:
+            data = redis.get(redis_key + ":packed")
+            if data is not None:
+                return cls.unpack(img_id, data, tag_dict)
+
+        exists = redis.exists(redis_key)
+
+        if not exists:
+            raise KeyError("No image " + str(img_id) + " exists in index")
+
+        ret_data = redis.hgetall(redis_key)
+
+        characters = redis.smembers(redis_key + ":characters")
+        authors = redis.smembers(redis_key + ":authors")
+
+        # images indexed before the tag dictionary have plain tag sets
+        tag_ids = redis.smembers(redis_key + ":tag_ids")
+        if len(tag_ids) > 0:
+            source_tags = tag_dict.strings(tag_ids)
+        else:
+            source_tags = redis.smembers(redis_key + ":source_tags")
+
+        return cls._from_redis_data(img_id, ret_data, characters, authors, source_tags)
+
+    @classmethod
+    async def load_from_index_async(cls, aredis, img_id, packed=None):
         redis_key = "index:image:" + str(img_id)
+
+        tag_dict = get_tag_dictionary(aredis)
+
+        if packed is None:
+            packed = PACKED_RECORDS
+
+        if packed:
+            data = await aredis.get(redis_key + ":packed")
+            if data is not None:
+                fields = cls._decode_packed(data)
+                tag_ids = cls._packed_tag_ids(fields)
+                tag_strings = await tag_dict.strings_async(tag_ids)
+
+                return cls._from_packed_fields(
+                    img_id, fields, dict(zip(tag_ids, tag_strings))
+                )
+
         exists = await aredis.exists(redis_key)
 
         if not exists:
             raise KeyError("No image " + str(img_id) + " exists in index")
 
         ret_data = await aredis.hgetall(redis_key)
-        data = {}
-
-        for key, value in ret_data.items():
-            data[key.decode("utf-8")] = value
 
         characters = await aredis.smembers(redis_key + ":characters", encoding="utf-8")
         authors = await aredis.smembers(redis_key + ":authors", encoding="utf-8")
-        source_tags = await aredis.smembers(
-            redis_key + ":source_tags", encoding="utf-8"
-        )
 
-        queued_img_data = QueuedImage.from_redis_data(
-            data, characters, authors, source_tags
-        )
+        # images indexed before the tag dictionary have plain tag sets
+        tag_ids = await aredis.smembers(redis_key + ":tag_ids")
+        if len(tag_ids) > 0:
+            source_tags = await tag_dict.strings_async(tag_ids)
+        else:
+            source_tags = await aredis.smembers(
+                redis_key + ":source_tags", encoding="utf-8"
+            )
 
-        return cls(
-            img_id=img_id, imhash=data["imhash"], queued_img_data=queued_img_data
-        )
+        return cls._from_redis_data(img_id, ret_data, characters, authors, source_tags)
+
+    @classmethod
+    def _decode_packed_results(cls, results):
+        """Decode a list of packed records (or `None`s), and list the tag IDs
+        they refer to.
+        """
+        decoded = [cls._decode_packed(d) if d is not None else None for d in results]
+        tag_ids = set()
+
+        for fields in decoded:
+            if fields is not None:
+                tag_ids.update(cls._packed_tag_ids(fields))
+
+        return decoded, list(tag_ids)
+
+    @classmethod
+    def _from_packed_results(cls, img_ids, decoded, tag_strings):
+        return [
+            cls._from_packed_fields(int(img_id), fields, tag_strings)
+            if fields is not None
+            else None
+            for img_id, fields in zip(img_ids, decoded)
+        ]
+
+    @staticmethod
+    def _pipeline_tag_ids(results):
+        """List the tag IDs in the results of a normalized-record pipeline."""
+        tag_ids = set()
+
+        for i in range(0, len(results), 5):
+            tag_ids.update(int(t) for t in results[i + 3])
+
+        return list(tag_ids)
+
+    @classmethod
+    def _from_pipeline_results(cls, img_ids, results, tag_strings):
+        ret = []
+
+        for i, img_id in enumerate(img_ids):
+            ret_data, characters, authors, tag_ids, source_tags = results[
+                5 * i : 5 * i + 5
+            ]
+
+            # a missing image hash comes back as an empty dict
+            if not ret_data:
+                ret.append(None)
+                continue
+
+            if len(tag_ids) > 0:
+                source_tags = [tag_strings[int(t)] for t in tag_ids]
+
+            ret.append(
+                cls._from_redis_data(
+                    int(img_id), ret_data, characters, authors, source_tags
+                )
+            )
+
+        return ret
+
+    @staticmethod
+    def _merge_loaded(loaded, fallback):
+        fallback = iter(fallback)
+        ret = []
+
+        for img in loaded:
+            if img is None:
+                img = next(fallback)
+
+            if img is not None:
+                ret.append(img)
+
+        return ret
+
+    @classmethod
+    def load_many(cls, redis, img_ids, packed=None):
+        """Load several images from the index in pipelined batches.
+
+        Packed records (if enabled) are fetched first; images without one are
+        then loaded from the normalized hash and sets in a second pipeline.
+
+        Args:
+            redis (redis.Redis): A Redis interface.
+            img_ids (list): The IDs of the images to load.
+            packed (bool): Whether to read packed records at all. Defaults to
+                `PACKED_RECORDS`.
+
+        Returns:
+            A list of `IndexedImage`s, in the same order as `img_ids`. IDs that
+            do not exist in the index are skipped.
+        """
+        img_ids = list(img_ids)
+        loaded = [None] * len(img_ids)
+        tag_dict = get_tag_dictionary(redis)
+
+        if packed is None:
+            packed = PACKED_RECORDS
+
+        if packed:
+            tr = redis.pipeline(transaction=False)
+            for img_id in img_ids:
+                tr.get("index:image:" + str(img_id) + ":packed")
+
+            decoded, tag_ids = cls._decode_packed_results(tr.execute())
+            tag_strings = dict(zip(tag_ids, tag_dict.strings(tag_ids)))
+            loaded = cls._from_packed_results(img_ids, decoded, tag_strings)
+
+        missing = [img_id for img_id, img in zip(img_ids, loaded) if img is None]
+        if len(missing) == 0:
+            return loaded
+
+        tr = redis.pipeline(transaction=False)
+
+        for img_id in missing:
+            redis_key = "index:image:" + str(img_id)
+
+            tr.hgetall(redis_key)
+            tr.smembers(redis_key + ":characters")
+            tr.smembers(redis_key + ":authors")
+            tr.smembers(redis_key + ":tag_ids")
+            tr.smembers(redis_key + ":source_tags")
+
+        results = tr.execute()
+        tag_ids = cls._pipeline_tag_ids(results)
+        tag_strings = dict(zip(tag_ids, tag_dict.strings(tag_ids)))
+
+        fallback = cls._from_pipeline_results(missing, results, tag_strings)
+        return cls._merge_loaded(loaded, fallback)
+
+    @classmethod
+    async def load_many_async(cls, aredis, img_ids, packed=None):
+        """Load several images from the index in pipelined batches.
+
+        Packed records (if enabled) are fetched first; images without one are
+        then loaded from the normalized hash and sets in a second pipeline.
+
+        Args:
+            aredis (aioredis.Redis): An asynchronous Redis interface.
+            img_ids (list): The IDs of the images to load.
+            packed (bool): Whether to read packed records at all. Defaults to
+                `PACKED_RECORDS`.
+
+        Returns:
+            A list of `IndexedImage`s, in the same order as `img_ids`. IDs that
+            do not exist in the index are skipped.
+        """
+        img_ids = list(img_ids)
+        loaded = [None] * len(img_ids)
+        tag_dict = get_tag_dictionary(aredis)
+
+        if packed is None:
+            packed = PACKED_RECORDS
+
+        if packed:
+            tr = aredis.pipeline()
+            for img_id in img_ids:
+                tr.get("index:image:" + str(img_id) + ":packed")
+
+            decoded, tag_ids = cls._decode_packed_results(await tr.execute())
+            tag_strings = dict(zip(tag_ids, await tag_dict.strings_async(tag_ids)))
+            loaded = cls._from_packed_results(img_ids, decoded, tag_strings)
+
+        missing = [img_id for img_id, img in zip(img_ids, loaded) if img is None]
+        if len(missing) == 0:
+            return loaded
+
+        tr = aredis.pipeline()
+
+        for img_id in missing:
+            redis_key = "index:image:" + str(img_id)
+
+            tr.hgetall(redis_key)
+            tr.smembers(redis_key + ":characters", encoding="utf-8")
+            tr.smembers(redis_key + ":authors", encoding="utf-8")
+            tr.smembers(redis_key + ":tag_ids")
+            tr.smembers(redis_key + ":source_tags", encoding="utf-8")
+
+        results = await tr.execute()
+        tag_ids = cls._pipeline_tag_ids(results)
+        tag_strings = dict(zip(tag_ids, await tag_dict.strings_async(tag_ids)))
+
+        fallback = cls._from_pipeline_results(missing, results, tag_strings)
+        return cls._merge_loaded(loaded, fallback)
 
     @classmethod
     def from_queued_image(cls, img_id, img_hash, queued_image):
         return cls(img_id=img_id, imhash=img_hash, queued_img_data=queued_image)
 
+    def publish_invalidation(self, tr):
+        """Queue invalidation messages for this image and its characters."""
+        tr.publish(INVALIDATION_CHANNEL, "image:" + str(self.img_id))
+
+        # pylint: disable=no-member
+        for character in self.queued_img_data.characters:
+            tr.publish(INVALIDATION_CHANNEL, "character:" + character)
+
     def save_duplicate_info(self, redis):
         redis_key = "index:image:" + str(self.img_id)
 
@@ -121,11 +455,22 @@ class IndexedImage(object):
             self.source_id,
         )
 
+        # only the alias site is added, mirroring the sets above; the duplicate
+        # post's other metadata isn't indexed for the existing image
+        if FILTER_BITMAPS:
+            ordinal = assign_ordinal(redis, self.img_id)
+
+            # pylint: disable=no-member
+            add_to_facets(
+                redis, tr, ordinal, ["sites:" + self.queued_img_data.source_site]
+            )
+
+        self.publish_invalidation(tr)
+
         tr.execute()
 
     def save_to_index(self, redis):
         redis_key = "index:image:" + str(self.img_id)
-        imhash_key = b"imhash:" + self.imhash
 
         d = {"imhash": self.imhash}
         d.update(
@@ -140,13 +485,22 @@ class IndexedImage(object):
         del d["authors"]
         del d["source_tags"]
 
+        tag_dict = get_tag_dictionary(redis)
+        # pylint: disable=no-member
+        tag_ids = tag_dict.ids(self.queued_img_data.source_tags)
+
         tr = redis.pipeline()
 
-        tr.set(imhash_key, self.img_id)
+        add_to_hash_index(redis, tr, self.imhash, self.img_id)
         tr.sadd("index:images", self.img_id)
 
         tr.delete(redis_key)
         tr.hmset(redis_key, d)
+        # with packed records off, any existing record is left alone: nothing
+        # reads it, and scripts/migrate_packed_records.py rewrites every record
+        # before they are turned on
+        if PACKED_RECORDS:
+            tr.set(redis_key + ":packed", self.pack(tag_dict))
 
         # pylint: disable=no-member
         tr.sadd(
@@ -166,10 +520,13 @@ class IndexedImage(object):
         if len(self.queued_img_data.authors) > 0:
             tr.sadd(redis_key + ":authors", *self.queued_img_data.authors)
 
+        # source tags are stored as tag dictionary IDs, so the set stays a
+        # compact intset
         tr.delete(redis_key + ":source_tags")
+        tr.delete(redis_key + ":tag_ids")
 
-        if len(self.queued_img_data.source_tags) > 0:
-            tr.sadd(redis_key + ":source_tags", *self.queued_img_data.source_tags)
+        if len(tag_ids) > 0:
+            tr.sadd(redis_key + ":tag_ids", *tag_ids)
 
         ts = get_timestamp(self.img_id)
 
@@ -233,5 +590,10 @@ class IndexedImage(object):
 
             tr.zadd("index:tags:merged:" + tag, {self.img_id: ts})
 
-        tr.execute()
+        if FILTER_BITMAPS:
+            ordinal = assign_ordinal(redis, self.img_id)
+            add_to_facets(redis, tr, ordinal, image_facets(self.queued_img_data))
 
+        self.publish_invalidation(tr)
+
+        tr.execute()
@@ -1,4 +1,7 @@
 import attr
+import msgpack
+
+PACKED_VERSION = 1
 
 
 def convert_redis_sequence(l):
@@ -37,3 +40,44 @@ class QueuedImage(object):
             authors=authors,
             source_tags=source_tags,
         )
+
+    def pack(self, tag_dict):
+        """Encode this image in a compact msgpack format for the job queue.
+
+        Args:
+            tag_dict (TagDictionary): The dictionary used to store source tags
+                as integer IDs.
+
+        Returns:
+            bytes
+        """
+        return msgpack.packb(
+            [
+                PACKED_VERSION,
+                self.source_site,
+                self.source_id,
+                self.source_url,
+                self.source_original,
+                self.sfw_rating,
+                self.characters,
+                self.authors,
+                tag_dict.ids(self.source_tags),
+            ],
+            use_bin_type=True,
+        )
+
+    @classmethod
+    def unpack(cls, data, tag_dict):
+        """Decode an image encoded with `pack`.
+
+        Args:
+            data (bytes): The encoded image.
+            tag_dict (TagDictionary): The dictionary the image was encoded
+                with.
+        """
+        fields = msgpack.unpackb(data, raw=False)
+
+        if fields[0] != PACKED_VERSION:
+            raise ValueError("Unsupported packed image version " + str(fields[0]))
+
+        return cls(*fields[1:8], source_tags=tag_dict.strings(fields[8]))
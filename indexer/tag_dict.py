@@ -0,0 +1,146 @@
+import threading
+
+# Tag strings are interned as small integers, assigned in first-seen order.
+# Both directions are stored in Redis hashes and cached in-process; IDs are
+# never reassigned, so cached entries never go stale.
+
+TAG_IDS_KEY = "tagdict:ids"
+TAG_STRINGS_KEY = "tagdict:strings"
+NEXT_TAG_ID_KEY = "tagdict:next"
+
+_INTERN_SCRIPT = """
+local ids = {}
+
+for i, tag in ipairs(ARGV) do
+    local id = redis.call("HGET", KEYS[1], tag)
+
+    if not id then
+        id = redis.call("INCR", KEYS[3]) - 1
+        redis.call("HSET", KEYS[1], tag, id)
+        redis.call("HSET", KEYS[2], id, tag)
+    end
+
+    ids[i] = tonumber(id)
+end
+
+return ids
+"""
+
+
+class TagDictionary(object):
+    """Maps tag strings to integer IDs and back.
+
+    Args:
+        redis: A Redis interface. With an `aioredis.Redis` interface, only
+            `strings_async` can be used.
+        batch_size (int): Maximum number of tags to intern per script call.
+    """
+
+    def __init__(self, redis, batch_size=1000):
+        self.redis = redis
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._strings = {}
+        self._intern_script = None
+
+    def __len__(self):
+        return int(self.redis.get(NEXT_TAG_ID_KEY) or 0)
+
+    def _remember(self, tags, ids):
+        with self._lock:
+            for tag, tag_id in zip(tags, ids):
+                self._ids[tag] = tag_id
+                self._strings[tag_id] = tag
+
+    def ids(self, tags):
+        """Get the IDs of a sequence of tags, assigning IDs to new tags.
+
+        Returns:
+            list: Integer IDs, in the same order as `tags`.
+        """
+        tags = list(tags)
+        missing = list(set(t for t in tags if t not in self._ids))
+
+        if len(missing) > 0:
+            found = self.redis.hmget(TAG_IDS_KEY, missing)
+            self._remember(
+                [t for t, i in zip(missing, found) if i is not None],
+                [int(i) for i in found if i is not None],
+            )
+
+            missing = [t for t, i in zip(missing, found) if i is None]
+
+        if len(missing) > 0 and self._intern_script is None:
+            self._intern_script = self.redis.register_script(_INTERN_SCRIPT)
+
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i : i + self.batch_size]
+            ids = self._intern_script(
+                keys=[TAG_IDS_KEY, TAG_STRINGS_KEY, NEXT_TAG_ID_KEY], args=batch
+            )
+
+            self._remember(batch, [int(i) for i in ids])
+
+        return [self._ids[t] for t in tags]
+
+    def id(self, tag):
+        return self.ids([tag])[0]
+
+    def strings(self, ids):
+        """Get the tag strings for a sequence of IDs.
+
+        Raises:
+            KeyError: If an ID has not been assigned.
+        """
+        ids = [int(i) for i in ids]
+        missing = list(set(i for i in ids if i not in self._strings))
+
+        if len(missing) > 0:
+            found = self.redis.hmget(TAG_STRINGS_KEY, missing)
+
+            for tag_id, tag in zip(missing, found):
+                if tag is None:
+                    raise KeyError("Unknown tag ID " + str(tag_id))
+
+            self._remember([t.decode("utf-8") for t in found], missing)
+
+        return [self._strings[i] for i in ids]
+
+    def string(self, tag_id):
+        return self.strings([tag_id])[0]
+
+    async def strings_async(self, ids):
+        """Get the tag strings for a sequence of IDs, through an asynchronous
+        Redis interface.
+
+        Raises:
+            KeyError: If an ID has not been assigned.
+        """
+        ids = [int(i) for i in ids]
+        missing = list(set(i for i in ids if i not in self._strings))
+
+        if len(missing) > 0:
+            found = await self.redis.hmget(TAG_STRINGS_KEY, *missing, encoding="utf-8")
+
+            for tag_id, tag in zip(missing, found):
+                if tag is None:
+                    raise KeyError("Unknown tag ID " + str(tag_id))
+
+            self._remember(found, missing)
+
+        return [self._strings[i] for i in ids]
+
+
+_dictionaries = {}
+
+
+def get_tag_dictionary(redis):
+    """Get the shared tag dictionary for a Redis interface."""
+    key = id(redis)
+
+    if key not in _dictionaries:
+        _dictionaries[key] = TagDictionary(redis)
+
+    return _dictionaries[key]
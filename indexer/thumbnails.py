@@ -0,0 +1,150 @@
+import io
+import os
+import os.path as osp
+import secrets
+
+from PIL import Image
+
+# standard thumbnail widths; requests for other widths get the next size up
+THUMBNAIL_WIDTHS = (160, 320, 640, 1280)
+
+# format name -> (PIL format, file extension, MIME type)
+FORMATS = {
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+}
+
+# formats the backend worker renders for every new image; other formats are
+# rendered on demand by the API
+PREGENERATE_FORMATS = ("webp",)
+
+QUALITY = 80
+
+
+def thumbnail_width(requested):
+    """Get the standard width to serve for a requested width."""
+    for width in THUMBNAIL_WIDTHS:
+        if width >= requested:
+            return width
+
+    return THUMBNAIL_WIDTHS[-1]
+
+
+def thumbnail_filename(img_id, width, fmt):
+    """Get the cache filename of a thumbnail (`<img_id>.w<width>.<ext>`)."""
+    return "{}.w{:d}.{}".format(img_id, width, FORMATS[fmt][1])
+
+
+def _resize(img, width):
+    if img.width <= width:
+        return img
+
+    height = max(1, round(img.height * width / img.width))
+    return img.resize((width, height), Image.LANCZOS)
+
+
+def _encode(img, fmt):
+    pil_format = FORMATS[fmt][0]
+
+    if pil_format == "JPEG" and img.mode != "RGB":
+        # flatten any transparency onto white
+        rgba = img.convert("RGBA")
+        img = Image.new("RGB", rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.split()[3])
+    elif img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA")
+
+    bio = io.BytesIO()
+    img.save(bio, format=pil_format, quality=QUALITY)
+
+    return bio.getvalue()
+
+
+def render_thumbnails(img, widths=None, formats=None):
+    """Render an image's thumbnails.
+
+    Sizes are rendered from largest to smallest, each from the one before,
+    so the full-size image is only resampled once.
+
+    Args:
+        img (PIL.Image): The decoded image.
+        widths (iterable): Thumbnail widths; defaults to `THUMBNAIL_WIDTHS`.
+        formats (iterable): Format names; defaults to `PREGENERATE_FORMATS`.
+
+    Returns:
+        dict: Encoded thumbnails, keyed by `(width, format)`.
+    """
+    if widths is None:
+        widths = THUMBNAIL_WIDTHS
+
+    if formats is None:
+        formats = PREGENERATE_FORMATS
+
+    thumbnails = {}
+    source = img
+
+    for width in sorted(widths, reverse=True):
+        source = _resize(source, width)
+
+        for fmt in formats:
+            thumbnails[(width, fmt)] = _encode(source, fmt)
+
+    return thumbnails
+
+
+def write_file(path, data):
+    """Write a file atomically, via a uniquely named `.part` file, so that
+    concurrent writers (in the backend and API workers) can't interleave.
+    """
+    part_path = "{}.{}.part".format(path, secrets.token_hex(4))
+
+    with open(part_path, "wb") as f:
+        f.write(data)
+
+    os.replace(part_path, path)
+
+
+def thumbnails_cached(cache_dir, img_id):
+    """Check whether all of an image's pregenerated thumbnails are in the
+    image cache.
+    """
+    return all(
+        osp.isfile(osp.join(cache_dir, thumbnail_filename(img_id, width, fmt)))
+        for width in THUMBNAIL_WIDTHS
+        for fmt in PREGENERATE_FORMATS
+    )
+
+
+def save_thumbnails(cache_dir, img_id, thumbnails):
+    """Write rendered thumbnails into the image cache, skipping any that
+    already exist.
+
+    Returns:
+        list: The paths that were written.
+    """
+    paths = []
+
+    for (width, fmt), data in thumbnails.items():
+        path = osp.join(cache_dir, thumbnail_filename(img_id, width, fmt))
+
+        if not osp.isfile(path):
+            write_file(path, data)
+            paths.append(path)
+
+    return paths
+
+
+def generate_thumbnail(src_path, dest_path, width, fmt):
+    """Render one thumbnail of a cached image file.
+
+    This is a top-level function so it can run in a process pool.
+    """
+    img = Image.open(src_path)
+
+    # let JPEG sources decode at a reduced scale
+    img.draft("RGB", (width, max(1, img.height * width // img.width)))
+    img.load()
+
+    write_file(dest_path, _encode(_resize(img, width), fmt))
+
+    return dest_path
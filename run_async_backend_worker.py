@@ -0,0 +1,4 @@
+from indexer.backend.async_worker import main
+
+if __name__ == "__main__":
+    main()
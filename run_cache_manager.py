@@ -0,0 +1,4 @@
+from ws_api.cache_manager import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import io
+import sys
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+import numpy as np
+from PIL import Image
+
+from indexer.backend import worker
+from indexer.backend.async_worker import fetch_image
+from indexer.index import compute_image_hash
+from indexer.ratelimit import LocalRateLimiter
+
+
+def make_png(size=512):
+    arr = np.random.randint(0, 256, (size, size, 3), dtype=np.uint8)
+    bio = io.BytesIO()
+    Image.fromarray(arr).save(bio, format="PNG")
+
+    return bio.getvalue()
+
+
+def start_server(data, latency, port):
+    """Serve `data` at /img/<n>.png after `latency` seconds, on a thread."""
+
+    async def handle(request):
+        await asyncio.sleep(latency)
+        return web.Response(body=data, content_type="image/png")
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get("/img/{n}.png", handle)
+
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+
+def run_sync(urls):
+    for url in urls:
+        img, bio = worker.download_image(url)
+        compute_image_hash(img)
+        bio.close()
+
+
+async def run_async(urls, concurrency):
+    # mirrors AsyncIndexer.process, minus the Redis steps
+    limiter = LocalRateLimiter(default_rate=(1e9, 1e9))
+    hash_executor = ProcessPoolExecutor()
+    slots = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_event_loop()
+
+    async def one(session, url):
+        async with slots:
+            data = await fetch_image(session, limiter, url)
+            await loop.run_in_executor(hash_executor, worker.hash_image_data, data)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(one(session, url) for url in urls))
+
+    hash_executor.shutdown()
+
+
+def main():
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    port = 18093
+
+    start_server(make_png(), latency, port)
+
+    urls = [
+        "http://127.0.0.1:{:d}/img/{:d}.png".format(port, i) for i in range(n_images)
+    ]
+
+    print(
+        "{:d} images, {:.0f} ms simulated upstream latency".format(
+            n_images, latency * 1000
+        )
+    )
+
+    start = time.perf_counter()
+    run_sync(urls)
+    elapsed = time.perf_counter() - start
+    print(
+        "    sync worker (without 0.5s sleeps): {:7.1f} images/s".format(
+            n_images / elapsed
+        )
+    )
+    print(
+        "    sync worker (with 0.5s sleeps):    {:7.1f} images/s".format(
+            n_images / (elapsed + 0.5 * n_images)
+        )
+    )
+
+    start = time.perf_counter()
+    asyncio.get_event_loop().run_until_complete(run_async(urls, concurrency))
+    elapsed = time.perf_counter() - start
+    print(
+        "    async worker (concurrency {:d}):   {:7.1f} images/s".format(
+            concurrency, n_images / elapsed
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import random
+import sys
+import time
+
+from redis import Redis
+from rq import Queue
+
+from indexer.scraper.enqueue import PROCESS_FUNC, enqueue_images
+from indexer.structures import QueuedImage
+
+PAGE_SIZE = 200
+
+
+def make_queued_image(source_id, tags):
+    return QueuedImage(
+        source_site="danbooru",
+        source_id=source_id,
+        source_url="https://cdn.donmai.us/original/ab/cd/{:032x}.jpg".format(source_id),
+        source_original="https://twitter.com/example/status/{:d}".format(source_id),
+        sfw_rating="safe",
+        characters=("benchmark_character",),
+        authors=("benchmark_artist",),
+        source_tags=random.sample(tags, 50),
+    )
+
+
+def enqueue_one_by_one(queue, page):
+    for queued_image in page:
+        queue.enqueue(PROCESS_FUNC, queued_image)
+
+
+def run(redis, name, pages, enqueue_page):
+    queue = Queue("backend-index", connection=redis)
+    redis.flushdb()
+
+    start = time.perf_counter()
+    for page in pages:
+        enqueue_page(queue, page)
+    elapsed = time.perf_counter() - start
+
+    n_posts = sum(len(page) for page in pages)
+    print(
+        "{:>24s}: {:8.2f}s  {:10.1f} posts/s  {:8d} jobs  {:8.1f} MiB".format(
+            name,
+            elapsed,
+            n_posts / elapsed,
+            len(queue),
+            redis.info("memory")["used_memory"] / 2 ** 20,
+        )
+    )
+
+
+def main():
+    redis_url = sys.argv[1]
+    n_posts = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    redis = Redis.from_url(redis_url)
+    if redis.dbsize() > 0:
+        print("Refusing to run: benchmark database is not empty")
+        sys.exit(1)
+
+    random.seed(0)
+    tags = ["tag_{:d}".format(i) for i in range(5000)]
+    posts = [make_queued_image(i, tags) for i in range(n_posts)]
+    pages = [posts[i : i + PAGE_SIZE] for i in range(0, n_posts, PAGE_SIZE)]
+
+    print("Enqueueing {:d} posts in pages of {:d}:".format(n_posts, PAGE_SIZE))
+
+    try:
+        run(redis, "one job per enqueue call", pages, enqueue_one_by_one)
+        run(
+            redis,
+            "pipelined per page",
+            pages,
+            lambda queue, page: enqueue_images(queue, page, batch_size=1, packed=False),
+        )
+        run(
+            redis,
+            "pipelined, packed",
+            pages,
+            lambda queue, page: enqueue_images(queue, page, batch_size=1, packed=True),
+        )
+
+        for batch_size in (10, 50):
+            run(
+                redis,
+                "batch jobs of {:d}".format(batch_size),
+                pages,
+                lambda queue, page: enqueue_images(
+                    queue, page, batch_size=batch_size, packed=False
+                ),
+            )
+    finally:
+        redis.flushdb()
+
+
+if __name__ == "__main__":
+    main()
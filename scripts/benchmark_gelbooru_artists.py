@@ -0,0 +1,159 @@
+import json
+import sys
+import time
+
+from redis import Redis
+import requests
+
+from indexer import http, ratelimit
+from indexer.scraper import gelbooru
+from indexer.scraper.gelbooru_tags import TagTypeResolver
+
+TAG_TYPES_KEY = "benchmark:gelbooru:tag_types"
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def request_url(url, params=None):
+    return requests.Request("GET", url, params=params).prepare().url
+
+
+def record(fixture_path, tags, n_pages, redis):
+    """Run a crawl against Gelbooru, saving every response to a fixture."""
+    responses = {}
+    real_get = http.get
+
+    def recording_get(url, params=None, **kwargs):
+        resp = real_get(url, params=params, **kwargs)
+        responses[request_url(url, params)] = [resp.status_code, resp.text]
+
+        return resp
+
+    http.get = recording_get
+    pages = []
+
+    # shared across pages, like the cold run in `replay`
+    redis.delete(TAG_TYPES_KEY)
+    resolver = TagTypeResolver(redis, key=TAG_TYPES_KEY)
+
+    try:
+        for page in gelbooru.search_api_pages(tags):
+            pages.append(page)
+
+            # both artist lookup paths, so either can be replayed
+            for post_data in page:
+                gelbooru.scrape_post_tag_types(
+                    post_data["id"], post_data["tags"].split()
+                )
+
+            resolver.resolve(t for d in page for t in d["tags"].split())
+
+            if len(pages) >= n_pages:
+                break
+    finally:
+        http.get = real_get
+        redis.delete(TAG_TYPES_KEY)
+
+    with open(fixture_path, "w", encoding="utf-8") as f:
+        json.dump({"pages": pages, "responses": responses}, f)
+
+    print("Recorded {:d} pages, {:d} responses".format(len(pages), len(responses)))
+
+
+def replay(fixture_path, latency, redis):
+    with open(fixture_path, "r", encoding="utf-8") as f:
+        fixture = json.load(f)
+
+    n_requests = 0
+
+    def replaying_get(url, params=None, **kwargs):
+        nonlocal n_requests
+
+        n_requests += 1
+        time.sleep(latency)
+
+        status_code, text = fixture["responses"][request_url(url, params)]
+        return FakeResponse(status_code, text)
+
+    http.get = replaying_get
+    ratelimit.LIMITER = ratelimit.LocalRateLimiter(rates={}, default_rate=(1e9, 1e9))
+
+    pages = fixture["pages"]
+    n_posts = sum(len(page) for page in pages)
+
+    def run(name, make_resolver):
+        nonlocal n_requests
+        n_requests = 0
+
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+
+        for page in pages:
+            resolver = make_resolver()
+            if resolver is not None:
+                resolver.resolve(t for d in page for t in d["tags"].split())
+
+            for post_data in page:
+                gelbooru.gelbooru_post_to_queued_image(
+                    ("benchmark",), post_data, resolver
+                )
+
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+
+        print(
+            "{:>16s}: {:8.1f} posts/s  {:6d} requests  {:8.3f} ms CPU/post".format(
+                name, n_posts / wall, n_requests, 1000 * cpu / n_posts
+            )
+        )
+
+    redis.delete(TAG_TYPES_KEY)
+    resolver = TagTypeResolver(redis, key=TAG_TYPES_KEY)
+
+    try:
+        print(
+            "Replaying {:d} posts with {:.0f} ms simulated latency:".format(
+                n_posts, latency * 1000
+            )
+        )
+
+        run("HTML scrape", lambda: None)
+        run("resolver (cold)", lambda: resolver)
+        run("resolver (Redis)", lambda: TagTypeResolver(redis, key=TAG_TYPES_KEY))
+        run("resolver (local)", lambda: resolver)
+    finally:
+        redis.delete(TAG_TYPES_KEY)
+
+
+def main():
+    if len(sys.argv) < 4:
+        print(
+            "usage: benchmark_gelbooru_artists.py <redis url> record <fixture> "
+            + "<tags> [n_pages]"
+        )
+        print(
+            "       benchmark_gelbooru_artists.py <redis url> replay <fixture> "
+            + "[latency ms]"
+        )
+        sys.exit(1)
+
+    redis = Redis.from_url(sys.argv[1])
+    mode, fixture_path = sys.argv[2:4]
+
+    if mode == "record":
+        n_pages = int(sys.argv[5]) if len(sys.argv) > 5 else 5
+        record(fixture_path, sys.argv[4].split(","), n_pages, redis)
+    else:
+        latency = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.1
+        replay(fixture_path, latency, redis)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import sys
+import time
+
+import numpy as np
+from redis import Redis
+
+from indexer.index import construct_hash_idx_key, search_index
+from indexer.mih import MultiIndexHash
+
+THRESHOLD = 24
+
+
+def populate(redis, hashes, batch_size=1000):
+    for start in range(0, len(hashes), batch_size):
+        tr = redis.pipeline(transaction=False)
+
+        for h in hashes[start : start + batch_size]:
+            h_bytes = h.tobytes()
+            tr.set(b"imhash:" + h_bytes, 0)
+
+            for idx, val in enumerate(h_bytes):
+                tr.sadd(construct_hash_idx_key(idx, val), h_bytes)
+
+        tr.execute()
+
+
+def make_queries(rng, hashes, n_queries):
+    queries = []
+
+    for src in rng.integers(0, len(hashes), n_queries):
+        bits = np.unpackbits(hashes[src])
+        flips = rng.choice(len(bits), rng.integers(0, THRESHOLD), replace=False)
+        bits[flips] ^= 1
+
+        queries.append((np.packbits(bits), hashes[src].tobytes()))
+
+    return queries
+
+
+def run(name, queries, search_fn, candidates_fn):
+    n_found = 0
+    n_candidates = 0
+    elapsed = 0
+
+    for q, expected in queries:
+        start = time.perf_counter()
+        results = search_fn(q)
+        elapsed += time.perf_counter() - start
+
+        n_candidates += candidates_fn(q)
+
+        if any(h == expected for h, _ in results):
+            n_found += 1
+
+    print(
+        "    {:<8s} {:9.3f} ms/query  {:10.1f} candidates/query  recall {:.3f}".format(
+            name,
+            1000 * elapsed / len(queries),
+            n_candidates / len(queries),
+            n_found / len(queries),
+        )
+    )
+
+
+def main():
+    redis_url = sys.argv[1]
+    n_images = int(sys.argv[2])
+    n_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    redis = Redis.from_url(redis_url)
+    if redis.dbsize() > 0:
+        print("Refusing to run: benchmark database is not empty")
+        sys.exit(1)
+
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(0, 256, (n_images, 16), dtype=np.uint8)
+
+    try:
+        print("Populating {:d} hashes...".format(n_images))
+        populate(redis, hashes)
+
+        mih = MultiIndexHash()
+        mih.load(redis)
+
+        queries = make_queries(rng, hashes, n_queries)
+
+        print("Distance threshold {:d}, {:d} queries:".format(THRESHOLD, n_queries))
+
+        def sunion_candidates(q):
+            keys = [construct_hash_idx_key(i, v) for i, v in enumerate(q.tobytes())]
+            return len(redis.sunion(*keys))
+
+        run(
+            "sunion",
+            queries,
+            lambda q: search_index(redis, q, min_threshold=THRESHOLD, bucket_sets=True),
+            sunion_candidates,
+        )
+        run(
+            "mih",
+            queries,
+            lambda q: search_index(redis, q, min_threshold=THRESHOLD, matrix=mih),
+            lambda q: mih.last_candidates,
+        )
+    finally:
+        redis.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import asyncio
+import io
+import itertools
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+import aioredis
+import numpy as np
+from PIL import Image
+
+from ws_api.img_cache import CacheAccessLog, PendingImage, load_indexed_image
+
+UPSTREAM_CHUNK_SIZE = 2 ** 16
+
+
+def make_png(size=2048):
+    arr = np.random.randint(0, 256, (size, size, 3), dtype=np.uint8)
+    bio = io.BytesIO()
+    Image.fromarray(arr).save(bio, format="PNG")
+
+    return bio.getvalue()
+
+
+def start_server(data, latency, bandwidth, port):
+    """Serve `data` at /img/<n>.png on a thread, after `latency` seconds and
+    at `bandwidth` bytes/s.
+    """
+
+    async def handle(request):
+        await asyncio.sleep(latency)
+
+        resp = web.StreamResponse(headers={"Content-Type": "image/png"})
+        resp.content_length = len(data)
+        await resp.prepare(request)
+
+        for i in range(0, len(data), UPSTREAM_CHUNK_SIZE):
+            await resp.write(data[i : i + UPSTREAM_CHUNK_SIZE])
+            await asyncio.sleep(UPSTREAM_CHUNK_SIZE / bandwidth)
+
+        return resp
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get("/img/{n}.png", handle)
+
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+
+class FakeApp(object):
+    """The parts of the Sanic app that `ws_api.img_cache` uses."""
+
+    def __init__(self, app_redis, http_session, cache_dir):
+        self.config = {"IMAGE_CACHE_DIR": cache_dir}
+        self.app_redis = app_redis
+        self.http_session = http_session
+        self.cache_access = CacheAccessLog()
+        self.image_downloads = {}
+
+
+class FakeImage(object):
+    def __init__(self, img_id, url):
+        self.img_id = img_id
+        self.source_url = url
+
+
+class TimingResponse(object):
+    """Stands in for a streaming response, recording when data is sent."""
+
+    def __init__(self, start):
+        self.start = start
+        self.ttfb = None
+        self.n_bytes = 0
+
+    async def write(self, data):
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self.start
+        self.n_bytes += len(data)
+
+
+async def buffered(app, img):
+    """Download the whole file, then send it (`STREAM_UNCACHED_IMAGES` off)."""
+    start = time.perf_counter()
+    resp = TimingResponse(start)
+
+    path, pending = await load_indexed_image(app, img)
+    await pending.wait_complete()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPSTREAM_CHUNK_SIZE), b""):
+            await resp.write(chunk)
+
+    return resp.ttfb, time.perf_counter() - start
+
+
+async def tee(app, img):
+    """Send upstream bytes as they arrive."""
+    start = time.perf_counter()
+    resp = TimingResponse(start)
+
+    _, pending = await load_indexed_image(app, img)
+    await pending.wait_started()
+    await pending.stream(resp)
+
+    return resp.ttfb, time.perf_counter() - start
+
+
+async def follower(app, img):
+    """Follow a download started by another worker."""
+    start = time.perf_counter()
+    resp = TimingResponse(start)
+
+    _, pending = await load_indexed_image(app, img)
+    await pending.wait_started()
+
+    # read through the `.part` file, as another API worker would
+    await PendingImage(app, pending.filename, lock_token=pending.lock_token).stream(
+        resp
+    )
+
+    return resp.ttfb, time.perf_counter() - start
+
+
+async def run(redis_url, port, n_images):
+    app_redis = await aioredis.create_redis(redis_url)
+    if await app_redis.dbsize() > 0:
+        print("Refusing to run: benchmark database is not empty")
+        sys.exit(1)
+
+    cache_dir = tempfile.mkdtemp()
+    img_ids = itertools.count(1)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            app = FakeApp(app_redis, session, cache_dir)
+
+            for name, mode in (
+                ("download, then send", buffered),
+                ("tee", tee),
+                ("follow other worker", follower),
+            ):
+                ttfbs = []
+                totals = []
+
+                for i in range(n_images):
+                    url = "http://127.0.0.1:{:d}/img/{:d}.png".format(port, i)
+                    ttfb, total = await mode(app, FakeImage(next(img_ids), url))
+
+                    ttfbs.append(ttfb)
+                    totals.append(total)
+
+                print(
+                    "{:>24s}: TTFB median {:7.1f} ms, p95 {:7.1f} ms; "
+                    "total median {:7.1f} ms".format(
+                        name,
+                        np.median(ttfbs) * 1000,
+                        np.percentile(ttfbs, 95) * 1000,
+                        np.median(totals) * 1000,
+                    )
+                )
+    finally:
+        shutil.rmtree(cache_dir)
+        await app_redis.flushdb()
+        app_redis.close()
+        await app_redis.wait_closed()
+
+
+def main():
+    redis_url = sys.argv[1]
+    n_images = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    bandwidth = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    latency = float(sys.argv[4]) if len(sys.argv) > 4 else 0.05
+    port = 18094
+
+    data = make_png()
+    start_server(data, latency, bandwidth * 2 ** 20, port)
+
+    print(
+        "{:.1f} MiB PNG, {:.0f} ms upstream latency, {:.1f} MiB/s upstream".format(
+            len(data) / 2 ** 20, latency * 1000, bandwidth
+        )
+    )
+
+    asyncio.get_event_loop().run_until_complete(run(redis_url, port, n_images))
+
+
+if __name__ == "__main__":
+    main()
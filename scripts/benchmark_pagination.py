@@ -0,0 +1,133 @@
+import asyncio
+import random
+import sys
+import time
+
+import aioredis
+from redis import Redis
+
+from ws_api.pagination import Cursor, cursor_page
+
+CHARACTER_KEY = "index:characters:benchmark"
+TAG_KEY = "index:tags:merged:benchmark"
+RATING_KEY = "index:rating:benchmark"
+COUNT = 100
+
+
+def populate(redis, n_images, batch_size=10000):
+    for start in range(0, n_images, batch_size):
+        tr = redis.pipeline(transaction=False)
+
+        for i in range(start, min(start + batch_size, n_images)):
+            img_id = 10 ** 12 + i
+            ts = 1543536000000 + i * 1000
+
+            tr.zadd(CHARACTER_KEY, {img_id: ts})
+            if random.random() < 0.3:
+                tr.zadd(TAG_KEY, {img_id: ts})
+            if random.random() < 0.5:
+                tr.sadd(RATING_KEY, img_id)
+
+        tr.execute()
+
+
+async def offset_page(aredis, keys, start_index):
+    if len(keys) > 1:
+        # cold query: the intersection is materialized from scratch
+        await aredis.delete("tmp_query:benchmark")
+        await aredis.zinterstore("tmp_query:benchmark", *keys, aggregate="max")
+        key = "tmp_query:benchmark"
+    else:
+        key = keys[0]
+
+    return await aredis.zrange(key, start_index, start_index + COUNT - 1)
+
+
+async def cursor_at(aredis, keys, start_index):
+    """Build the cursor a client following X-Next-Cursor would hold."""
+    if start_index == 0:
+        return Cursor.start()
+
+    key = keys[0]
+    if len(keys) > 1:
+        key = "tmp_query:benchmark"
+        await aredis.zinterstore(key, *keys, aggregate="max")
+
+    ((member, score),) = await aredis.zrange(
+        key, start_index - 1, start_index - 1, withscores=True, encoding="utf-8"
+    )
+
+    return Cursor(reverse=False, score=score, last_member=member)
+
+
+async def query_size(aredis, keys):
+    if len(keys) == 1:
+        return await aredis.zcard(keys[0])
+
+    await aredis.zinterstore("tmp_query:benchmark", *keys, aggregate="max")
+    return await aredis.zcard("tmp_query:benchmark")
+
+
+async def timed(coro_fn, n_repeats):
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        await coro_fn()
+
+    return 1000 * (time.perf_counter() - start) / n_repeats
+
+
+async def run(redis_url, n_images, n_repeats):
+    aredis = await aioredis.create_redis(redis_url)
+
+    for name, keys in (
+        ("unfiltered", [CHARACTER_KEY]),
+        ("filtered", [CHARACTER_KEY, TAG_KEY, RATING_KEY]),
+    ):
+        total = await query_size(aredis, keys)
+        print("{} query ({:d} results):".format(name, total))
+
+        for depth in (0.0, 0.1, 0.5, 0.9):
+            start_index = int(total * depth) // COUNT * COUNT
+
+            cursor = await cursor_at(aredis, keys, start_index)
+
+            offset_ms = await timed(
+                lambda: offset_page(aredis, keys, start_index), n_repeats
+            )
+            cursor_ms = await timed(
+                lambda: cursor_page(aredis, keys, cursor, COUNT), n_repeats
+            )
+
+            print(
+                "    item {:>9d}:  offset {:9.3f} ms   cursor {:9.3f} ms".format(
+                    start_index, offset_ms, cursor_ms
+                )
+            )
+
+    aredis.close()
+    await aredis.wait_closed()
+
+
+def main():
+    redis_url = sys.argv[1]
+    n_images = int(sys.argv[2])
+    n_repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    redis = Redis.from_url(redis_url)
+    if redis.dbsize() > 0:
+        print("Refusing to run: benchmark database is not empty")
+        sys.exit(1)
+
+    random.seed(0)
+
+    try:
+        print("Populating {:d} images...".format(n_images))
+        populate(redis, n_images)
+
+        asyncio.get_event_loop().run_until_complete(run(redis_url, n_images, n_repeats))
+    finally:
+        redis.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import random
+import sys
+
+from redis import Redis
+from rq import Queue
+
+from indexer.scraper.enqueue import enqueue_images
+from indexer.structures import QueuedImage
+
+PAGE_SIZE = 1000
+
+
+def make_queued_image(source_id, tags):
+    return QueuedImage(
+        source_site="danbooru",
+        source_id=source_id,
+        source_url="https://cdn.donmai.us/original/ab/cd/{:032x}.jpg".format(source_id),
+        source_original="https://twitter.com/example/status/{:d}".format(source_id),
+        sfw_rating="safe",
+        characters=("benchmark_character",),
+        authors=("benchmark_artist",),
+        source_tags=random.sample(tags, random.randint(20, 80)),
+    )
+
+
+def measure(redis, n_jobs, tags, packed):
+    redis.flushdb()
+    queue = Queue("backend-index", connection=redis)
+
+    # create the tag dictionary up front, so it isn't counted as queue memory
+    if packed:
+        enqueue_images(queue, [make_queued_image(0, tags)], packed=True)
+        redis.delete(queue.key, *redis.keys("rq:job:*"))
+
+    base = redis.info("memory")["used_memory"]
+
+    for start in range(0, n_jobs, PAGE_SIZE):
+        page = [
+            make_queued_image(i, tags)
+            for i in range(start, min(start + PAGE_SIZE, n_jobs))
+        ]
+        enqueue_images(queue, page, batch_size=1, packed=packed)
+
+    used = redis.info("memory")["used_memory"] - base
+    sample = redis.memory_usage(queue.job_class.key_for(queue.job_ids[0]))
+
+    print(
+        "{:>8s}: {:10.1f} MiB for {:d} jobs ({:.0f} bytes/job, job hash {:d} bytes)".format(
+            "packed" if packed else "pickled",
+            used / 2 ** 20,
+            len(queue),
+            used / n_jobs,
+            sample,
+        )
+    )
+
+
+def main():
+    redis_url = sys.argv[1]
+    n_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+
+    redis = Redis.from_url(redis_url)
+    if redis.dbsize() > 0:
+        print("Refusing to run: benchmark database is not empty")
+        sys.exit(1)
+
+    tags = ["tag_{:d}".format(i) for i in range(20000)]
+
+    try:
+        for packed in (False, True):
+            random.seed(0)
+            measure(redis, n_jobs, tags, packed)
+    finally:
+        redis.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import sys
+
+from redis import Redis
+
+from indexer.bitmap import add_to_facets, assign_ordinals, image_facets
+from indexer.structures import IndexedImage
+
+
+def main():
+    redis_url = sys.argv[1]
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    redis = Redis.from_url(redis_url)
+
+    # assign ordinals in ID (i.e. indexing time) order
+    img_ids = sorted(int(i) for i in redis.sscan_iter("index:images", count=1000))
+    print("Building filter bitmaps for {:d} images".format(len(img_ids)))
+
+    for start in range(0, len(img_ids), batch_size):
+        images = IndexedImage.load_many(redis, img_ids[start : start + batch_size])
+        ordinals = assign_ordinals(redis, [img.img_id for img in images])
+
+        tr = redis.pipeline(transaction=False)
+        for img in images:
+            tr.smembers("index:image:" + str(img.img_id) + ":aliases")
+        aliases = tr.execute()
+
+        tr = redis.pipeline(transaction=False)
+        for img, ordinal, img_aliases in zip(images, ordinals, aliases):
+            facets = image_facets(img.queued_img_data)
+
+            # duplicates found on other sites count towards those sites too
+            for alias in img_aliases:
+                facets.append("sites:" + alias.decode("utf-8").split("#", 1)[0])
+
+            add_to_facets(redis, tr, ordinal, set(facets))
+        tr.execute()
+
+        print(
+            "Processed {:d} / {:d} images".format(
+                min(start + batch_size, len(img_ids)), len(img_ids)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import secrets
+import sys
+
+from redis import Redis
+
+from indexer.bitmap import (
+    CHUNK_SIZE,
+    NEXT_ORDINAL_KEY,
+    ORDINAL_IDS_KEY,
+    RoaringBitmap,
+    facet_for_key,
+    intersect,
+    queue_facet_load,
+)
+
+filter_prefixes = {
+    "tag": "index:tags:merged:",
+    "author": "index:authors:",
+    "site": "index:sites:",
+    "rating": "index:rating:",
+}
+
+
+def bitmap_query(redis, keys):
+    n_ordinals = int(redis.get(NEXT_ORDINAL_KEY) or 0)
+    n_chunks = (n_ordinals + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    tr = redis.pipeline(transaction=False)
+    for key in keys:
+        queue_facet_load(tr, facet_for_key(key), n_chunks)
+    results = tr.execute()
+
+    bitmaps = [
+        RoaringBitmap.from_redis_results(
+            results[2 * n_chunks * i : 2 * n_chunks * (i + 1)]
+        )
+        for i in range(len(keys))
+    ]
+
+    ordinals = intersect(bitmaps).to_ordinals()
+    if len(ordinals) == 0:
+        return []
+
+    return [int(i) for i in redis.hmget(ORDINAL_IDS_KEY, *(int(o) for o in ordinals))]
+
+
+def zinterstore_query(redis, keys):
+    dest_key = "tmp_query:check:" + secrets.token_hex(8)
+
+    try:
+        redis.zinterstore(dest_key, keys, aggregate="max")
+        return [int(i) for i in redis.zrange(dest_key, 0, -1)]
+    finally:
+        redis.delete(dest_key)
+
+
+def main():
+    redis_url = sys.argv[1]
+    character = sys.argv[2]
+
+    keys = ["index:characters:" + character]
+    for arg in sys.argv[3:]:
+        name, value = arg.split("=", 1)
+        keys.append(filter_prefixes[name] + value)
+
+    redis = Redis.from_url(redis_url)
+
+    expected = zinterstore_query(redis, keys)
+    actual = bitmap_query(redis, keys)
+
+    missing = set(expected) - set(actual)
+    extra = set(actual) - set(expected)
+
+    print(
+        "ZINTERSTORE: {:d} images, bitmaps: {:d} images".format(
+            len(expected), len(actual)
+        )
+    )
+    print("  missing from bitmaps: {:d}".format(len(missing)))
+    print("  extra in bitmaps:     {:d}".format(len(extra)))
+
+    if len(missing) == 0 and len(extra) == 0:
+        print("  same order:           {}".format(expected == actual))
+    else:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
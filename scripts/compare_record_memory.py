@@ -0,0 +1,70 @@
+import sys
+
+from redis import Redis
+
+NORMALIZED_SUFFIXES = ("", ":characters", ":authors", ":source_tags", ":tag_ids")
+
+
+def main():
+    redis_url = sys.argv[1]
+    n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    redis = Redis.from_url(redis_url)
+
+    total = redis.scard("index:images")
+    img_ids = redis.srandmember("index:images", n_samples)
+
+    tr = redis.pipeline(transaction=False)
+    for img_id in img_ids:
+        redis_key = "index:image:" + img_id.decode("utf-8")
+
+        for suffix in NORMALIZED_SUFFIXES:
+            tr.memory_usage(redis_key + suffix)
+        tr.memory_usage(redis_key + ":packed")
+    usage = tr.execute()
+
+    normalized = 0
+    packed = 0
+    n_packed = 0
+    stride = len(NORMALIZED_SUFFIXES) + 1
+
+    for i in range(len(img_ids)):
+        sizes = usage[i * stride : (i + 1) * stride]
+
+        if sizes[-1] is None:
+            continue
+
+        normalized += sum(s for s in sizes[:-1] if s is not None)
+        packed += sizes[-1]
+        n_packed += 1
+
+    if n_packed == 0:
+        print("No sampled images have packed records; run migrate_packed_records.py")
+        return
+
+    # packed records are stored alongside the normalized layout, not instead
+    # of it, so enabling them costs their full size on top
+    layouts = (
+        ("normalized only", normalized),
+        ("packed record", packed),
+        ("both (as stored)", normalized + packed),
+    )
+
+    print("Sampled {:d} of {:d} images".format(n_packed, total))
+
+    for name, size in layouts:
+        print(
+            "  {:<17s} {:8.1f} bytes/image  ~{:8.1f} MiB total".format(
+                name + ":", size / n_packed, total * size / n_packed / 2 ** 20
+            )
+        )
+
+    print(
+        "  packed records add {:.1f}% to per-image record memory".format(
+            100 * packed / normalized if normalized > 0 else 0
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,117 @@
 import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from redis import Redis
-from rq import Queue
 
-from indexer.scraper import danbooru, gelbooru
+# `tag@site` entries still to be merged by the current run; entries are
+# removed as their tags are merged, so an interrupted run can be resumed
+PENDING_KEY = "index:tags:merge:pending"
+
+
+def usage():
+    print(
+        "Usage: generate_merged_tags.py <redis url> "
+        "[--resume] [--workers=N] [--batch=N]"
+    )
+    sys.exit(1)
+
+
+def queue_tags(redis):
+    """Fill the pending set with the tags this run has to merge."""
+    redis.zunionstore(PENDING_KEY, ["index:tags:all"])
+
+
+def pending_tags(redis):
+    """Group the pending `tag@site` entries by tag.
+
+    Returns:
+        list: `(tag, sites)` pairs, sorted by tag.
+    """
+    sites = defaultdict(list)
+
+    for tag_id, _ in redis.zscan_iter(PENDING_KEY, count=1000):
+        tag, source_site = tag_id.decode("utf-8").rsplit("@", 1)
+        sites[tag].append(source_site)
+
+    return sorted(sites.items())
+
+
+def merge_batch(redis, batch):
+    """Rebuild the merged sets for a batch of tags in one transaction.
+
+    `index:tags:merged:<tag>@<site>` becomes a copy of the site's own tag set,
+    and `index:tags:merged:<tag>` is replaced by the union of every site's set.
+    """
+    tr = redis.pipeline()
+
+    for tag, sites in batch:
+        site_keys = ["index:tags:" + site + ":" + tag for site in sites]
+
+        for site, site_key in zip(sites, site_keys):
+            tr.zunionstore("index:tags:merged:" + tag + "@" + site, [site_key])
+
+        tr.zunionstore("index:tags:merged:" + tag, site_keys, aggregate="MAX")
+        tr.zrem(PENDING_KEY, *(tag + "@" + site for site in sites))
+
+    tr.execute()
+    return len(batch)
 
 
 def main():
+    if len(sys.argv) < 2:
+        usage()
+
     redis_url = sys.argv[1]
+    resume = "--resume" in sys.argv[2:]
+    n_workers = 4
+    batch_size = 200
+
+    for arg in sys.argv[2:]:
+        if arg.startswith("--workers="):
+            n_workers = int(arg[len("--workers=") :])
+        elif arg.startswith("--batch="):
+            batch_size = int(arg[len("--batch=") :])
+        elif arg != "--resume":
+            usage()
+
     redis = Redis.from_url(redis_url)
 
-    for tag_id, _ in redis.zscan_iter("index:tags:all"):
-        tag_id = tag_id.decode("utf-8")
+    if resume:
+        print("Resuming interrupted run")
+    else:
+        queue_tags(redis)
+
+    tags = pending_tags(redis)
+    batches = [tags[i : i + batch_size] for i in range(0, len(tags), batch_size)]
+
+    print("Merging {:d} tags in {:d} batches".format(len(tags), len(batches)))
+
+    start = time.perf_counter()
+    n_merged = 0
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(merge_batch, redis, batch) for batch in batches]
 
-        print("Processing tag: " + tag_id)
-        tag, source_site = tag_id.rsplit("@", 1)
+        try:
+            for future in as_completed(futures):
+                n_merged += future.result()
+                elapsed = time.perf_counter() - start
 
-        data = {}
+                print(
+                    "Merged {:d} / {:d} tags ({:.1f} tags/s)".format(
+                        n_merged, len(tags), n_merged / elapsed
+                    )
+                )
+        except BaseException:
+            for future in futures:
+                future.cancel()
 
-        for img_id, score in redis.zscan_iter("index:tags:" + source_site + ":" + tag):
-            img_id = int(img_id.decode("utf-8"))
-            data[img_id] = int(score)
+            print("Interrupted; rerun with --resume to continue")
+            raise
 
-        redis.zadd("index:tags:merged:" + tag, data)
-        redis.zadd("index:tags:merged:" + tag_id, data)
+    print("Merged {:d} tags in {:.1f}s".format(n_merged, time.perf_counter() - start))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+import sys
+
+from redis import Redis
+
+from indexer.characters import merge_characters
+
+
+def main():
+    redis_url = sys.argv[1]
+    from_name = sys.argv[2]
+    into_name = sys.argv[3]
+
+    redis = Redis.from_url(redis_url)
+
+    def progress(n_moved, total):
+        print("Moved {:d} / {:d} images...".format(n_moved, total))
+
+    # rerunning the same merge resumes it if it was interrupted
+    dropped = merge_characters(redis, from_name, into_name, progress=progress)
+
+    for site in dropped:
+        print(
+            "Dropped {} tag association for {}; {} keeps its own".format(
+                site, from_name, into_name
+            )
+        )
+
+    print("Merged {} into {}".format(from_name, into_name))
+
+
+if __name__ == "__main__":
+    main()
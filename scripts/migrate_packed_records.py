@@ -0,0 +1,48 @@
+import sys
+
+from redis import Redis
+
+from indexer.structures import IndexedImage
+from indexer.tag_dict import get_tag_dictionary
+
+
+def main():
+    redis_url = sys.argv[1]
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    redis = Redis.from_url(redis_url)
+
+    total = redis.scard("index:images")
+    n_processed = 0
+    batch = []
+
+    tag_dict = get_tag_dictionary(redis)
+
+    def flush():
+        tr = redis.pipeline(transaction=False)
+        for indexed_image in IndexedImage.load_many(redis, batch, packed=False):
+            tr.set(
+                "index:image:" + str(indexed_image.img_id) + ":packed",
+                indexed_image.pack(tag_dict),
+            )
+        tr.execute()
+
+    for img_id in redis.sscan_iter("index:images", count=batch_size):
+        batch.append(img_id.decode("utf-8"))
+
+        if len(batch) >= batch_size:
+            flush()
+            n_processed += len(batch)
+            batch = []
+
+            print("Packed {:d} / {:d} image records".format(n_processed, total))
+
+    if len(batch) > 0:
+        flush()
+        n_processed += len(batch)
+
+    print("Packed {:d} image records".format(n_processed))
+
+
+if __name__ == "__main__":
+    main()
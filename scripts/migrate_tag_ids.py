@@ -0,0 +1,68 @@
+import sys
+
+from redis import Redis
+
+from indexer.structures import IndexedImage
+from indexer.tag_dict import get_tag_dictionary
+
+
+def main():
+    redis_url = sys.argv[1]
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    redis = Redis.from_url(redis_url)
+
+    total = redis.scard("index:images")
+    n_processed = 0
+    batch = []
+
+    tag_dict = get_tag_dictionary(redis)
+
+    def flush():
+        indexed_images = [
+            img
+            for img in IndexedImage.load_many(redis, batch, packed=False)
+            if img is not None
+        ]
+
+        # intern the whole batch's tags at once
+        tag_dict.ids(
+            t for img in indexed_images for t in img.queued_img_data.source_tags
+        )
+
+        tr = redis.pipeline(transaction=False)
+        for indexed_image in indexed_images:
+            redis_key = "index:image:" + str(indexed_image.img_id)
+            tag_ids = tag_dict.ids(indexed_image.queued_img_data.source_tags)
+
+            tr.delete(redis_key + ":source_tags")
+            tr.delete(redis_key + ":tag_ids")
+            if len(tag_ids) > 0:
+                tr.sadd(redis_key + ":tag_ids", *tag_ids)
+
+            tr.set(redis_key + ":packed", indexed_image.pack(tag_dict))
+        tr.execute()
+
+    for img_id in redis.sscan_iter("index:images", count=batch_size):
+        batch.append(img_id.decode("utf-8"))
+
+        if len(batch) >= batch_size:
+            flush()
+            n_processed += len(batch)
+            batch = []
+
+            print("Migrated {:d} / {:d} image records".format(n_processed, total))
+
+    if len(batch) > 0:
+        flush()
+        n_processed += len(batch)
+
+    print(
+        "Migrated {:d} image records; {:d} distinct tags".format(
+            n_processed, len(tag_dict)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import sys
+
+from redis import Redis
+
+from indexer.ratelimit import CONFIG_KEY, RedisRateLimiter
+
+
+def usage():
+    print("usage: rate_limits.py <redis url> show")
+    print("       rate_limits.py <redis url> set <host> <requests/sec> <burst>")
+    print("       rate_limits.py <redis url> unset <host>")
+    sys.exit(1)
+
+
+def main():
+    if len(sys.argv) < 3:
+        usage()
+
+    redis = Redis.from_url(sys.argv[1])
+    command = sys.argv[2]
+
+    if command == "set" and len(sys.argv) == 6:
+        host, rate, burst = sys.argv[3:6]
+        redis.hset(CONFIG_KEY, host, "{:f},{:f}".format(float(rate), float(burst)))
+        print("Set rate limit for {} to {} req/s (burst {})".format(host, rate, burst))
+    elif command == "unset" and len(sys.argv) == 4:
+        redis.hdel(CONFIG_KEY, sys.argv[3])
+        print("Removed rate limit override for " + sys.argv[3])
+    elif command == "show":
+        limiter = RedisRateLimiter(redis)
+        limiter._refresh_config()
+
+        print("Rates:")
+        for host, (rate, burst) in sorted(limiter.rates.items()):
+            print("    {:30s} {:8.2f} req/s  burst {:g}".format(host, rate, burst))
+
+        print("Wait-time metrics:")
+        for name, stats in sorted(limiter.stats().items()):
+            requests = stats.get("requests", 0)
+            wait_ms = stats.get("wait_ms", 0)
+
+            print(
+                "    {:30s} {:10d} requests  {:10d} waited  {:8.1f} ms avg wait".format(
+                    name,
+                    requests,
+                    stats.get("waited", 0),
+                    wait_ms / requests if requests > 0 else 0,
+                )
+            )
+    else:
+        usage()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import sys
+import time
+
+from redis import Redis
+
+from indexer.index import rebuild_hash_index
+
+
+def main():
+    redis_url = sys.argv[1]
+    args = [a for a in sys.argv[2:] if not a.startswith("--")]
+    batch_size = int(args[0]) if len(args) > 0 else 1000
+
+    # also write the `hash_idx:*` bucket sets, for searches without a matrix;
+    # without the flag, `index.HASH_BUCKET_SETS` decides
+    bucket_sets = True if "--bucket-sets" in sys.argv else None
+
+    redis = Redis.from_url(redis_url)
+
+    total = redis.scard("index:images")
+    start = time.perf_counter()
+
+    for n_processed in rebuild_hash_index(
+        redis, batch_size=batch_size, bucket_sets=bucket_sets
+    ):
+        elapsed = time.perf_counter() - start
+        print(
+            "Indexed {:d} / {:d} image hashes ({:.0f} images/s)".format(
+                n_processed, total, n_processed / max(elapsed, 1e-6)
+            )
+        )
+
+    print("Rebuilt hash index in {:.1f}s".format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,40 @@
+import asyncio
 import sys
 
 from redis import Redis
-from rq import Queue
+
+from indexer import ratelimit
+from indexer.backend.recache import character_image_ids, recache_images
 
 
 def main():
     redis_url = sys.argv[1]
-    character = sys.argv[2]
+    app_redis_url = sys.argv[2]
+    image_cache_dir = sys.argv[3]
+    character = sys.argv[4]
+    concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else None
 
     redis = Redis.from_url(redis_url)
-
-    q = Queue("backend-index", connection=redis)
-
-    for img_id, _ in redis.zscan_iter("index:characters:" + character):
-        img_id = img_id.decode("utf-8")
-        q.enqueue(
-            "indexer.backend.worker.cache_saved_image", img_id, job_timeout="6h"
+    app_redis = Redis.from_url(app_redis_url)
+
+    # share the backend workers' per-host rate limits
+    ratelimit.configure(redis)
+
+    img_ids = character_image_ids(redis, character)
+    print("Recaching {:d} images for {}".format(len(img_ids), character))
+
+    stats = asyncio.get_event_loop().run_until_complete(
+        recache_images(
+            redis,
+            app_redis,
+            image_cache_dir,
+            img_ids,
+            concurrency=concurrency,
+            progress=lambda stats: print(stats.format()),
         )
+    )
 
-        print("Queued recache job for {}".format(img_id))
+    print("Done: " + stats.format())
 
 
 if __name__ == "__main__":
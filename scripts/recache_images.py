@@ -0,0 +1,45 @@
+import asyncio
+import sys
+
+from redis import Redis
+
+from indexer import ratelimit
+from indexer.backend.recache import recache_images
+
+
+def main():
+    redis_url = sys.argv[1]
+    app_redis_url = sys.argv[2]
+    image_cache_dir = sys.argv[3]
+    id_file = sys.argv[4]
+    concurrency = int(sys.argv[5]) if len(sys.argv) > 5 else None
+
+    redis = Redis.from_url(redis_url)
+    app_redis = Redis.from_url(app_redis_url)
+
+    # share the backend workers' per-host rate limits
+    ratelimit.configure(redis)
+
+    # one image ID per line; "-" reads them from stdin
+    f = sys.stdin if id_file == "-" else open(id_file, "r")
+    with f:
+        img_ids = [line.strip() for line in f if len(line.strip()) > 0]
+
+    print("Recaching {:d} images".format(len(img_ids)))
+
+    stats = asyncio.get_event_loop().run_until_complete(
+        recache_images(
+            redis,
+            app_redis,
+            image_cache_dir,
+            img_ids,
+            concurrency=concurrency,
+            progress=lambda stats: print(stats.format()),
+        )
+    )
+
+    print("Done: " + stats.format())
+
+
+if __name__ == "__main__":
+    main()
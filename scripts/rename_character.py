@@ -1,8 +1,8 @@
 import sys
 
-import attr
 from redis import Redis
-from rq import Queue
+
+from indexer.characters import rename_character
 
 
 def main():
@@ -12,25 +12,16 @@ def main():
 
     redis = Redis.from_url(redis_url)
 
-    redis.zrem("index:characters", from_name)
-    redis.zadd("index:characters", {to_name: "0"})
-    redis.rename("index:characters:" + from_name, "index:characters:" + to_name)
-
-    print("Performed global rename...")
-
-    for img_id, _ in redis.zscan_iter("index:characters:" + to_name):
-        img_id = img_id.decode("utf-8")
-
-        redis_key = "index:image:" + img_id
-
-        tr = redis.pipeline()
+    def progress(n_moved, total):
+        print("Moved {:d} / {:d} images...".format(n_moved, total))
 
-        tr.srem(redis_key + ":characters", from_name)
-        tr.sadd(redis_key + ":characters", to_name)
+    # rerunning the same rename resumes it if it was interrupted
+    dropped = rename_character(redis, from_name, to_name, progress=progress)
 
-        tr.execute()
+    for site in dropped:
+        print("Dropped {} tag association for {}".format(site, from_name))
 
-        print("Processed image " + img_id + "...")
+    print("Renamed {} to {}".format(from_name, to_name))
 
 
 if __name__ == "__main__":
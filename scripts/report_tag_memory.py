@@ -0,0 +1,93 @@
+import sys
+
+import msgpack
+from redis import Redis
+
+from indexer.structures import IndexedImage
+from indexer.tag_dict import TAG_IDS_KEY, TAG_STRINGS_KEY, get_tag_dictionary
+
+SCRATCH_KEY = "scratch:tag_memory"
+
+
+def main():
+    """Estimate how much memory the tag dictionary saves on an index.
+
+    Sampled images' tags are written to scratch sets both as strings and as
+    dictionary IDs, and their packed records are encoded both ways, so the
+    report does not depend on how far `migrate_tag_ids.py` has got.
+    """
+    redis_url = sys.argv[1]
+    n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    redis = Redis.from_url(redis_url)
+    tag_dict = get_tag_dictionary(redis)
+
+    total = redis.scard("index:images")
+    img_ids = [i.decode("utf-8") for i in redis.srandmember("index:images", n_samples)]
+    indexed_images = [
+        img for img in IndexedImage.load_many(redis, img_ids) if img is not None
+    ]
+
+    string_sets = 0
+    id_sets = 0
+    strings_packed = 0
+    ids_packed = 0
+
+    try:
+        for indexed_image in indexed_images:
+            source_tags = indexed_image.queued_img_data.source_tags
+            if len(source_tags) == 0:
+                continue
+
+            tag_ids = tag_dict.ids(source_tags)
+
+            tr = redis.pipeline(transaction=False)
+            tr.sadd(SCRATCH_KEY + ":strings", *source_tags)
+            tr.sadd(SCRATCH_KEY + ":ids", *tag_ids)
+            tr.memory_usage(SCRATCH_KEY + ":strings")
+            tr.memory_usage(SCRATCH_KEY + ":ids")
+            tr.delete(SCRATCH_KEY + ":strings", SCRATCH_KEY + ":ids")
+            string_size, id_size = tr.execute()[2:4]
+
+            string_sets += string_size
+            id_sets += id_size
+
+            # a version 1 record stored the tag strings inline
+            fields = msgpack.unpackb(indexed_image.pack(tag_dict), raw=False)
+            ids_packed += len(msgpack.packb(fields, use_bin_type=True))
+            fields[0], fields[-1] = 1, list(source_tags)
+            strings_packed += len(msgpack.packb(fields, use_bin_type=True))
+    finally:
+        redis.delete(SCRATCH_KEY + ":strings", SCRATCH_KEY + ":ids")
+
+    n = len(indexed_images)
+    if n == 0:
+        print("No images to sample")
+        return
+
+    dictionary = (redis.memory_usage(TAG_IDS_KEY) or 0) + (
+        redis.memory_usage(TAG_STRINGS_KEY) or 0
+    )
+
+    def report(name, before, after):
+        saved = total * (before - after) / n
+        print(
+            "  {:14s} {:8.1f} -> {:8.1f} bytes/image  ~{:8.1f} MiB saved".format(
+                name, before / n, after / n, saved / 2 ** 20
+            )
+        )
+        return saved
+
+    print("Sampled {:d} of {:d} images".format(n, total))
+    saved = report("tag sets:", string_sets, id_sets)
+    saved += report("packed record:", strings_packed, ids_packed)
+    print(
+        "  dictionary:    {:d} tags, {:8.1f} MiB".format(
+            len(tag_dict), dictionary / 2 ** 20
+        )
+    )
+    print("  net saving:   ~{:8.1f} MiB".format((saved - dictionary) / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
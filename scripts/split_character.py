@@ -0,0 +1,30 @@
+import sys
+
+from redis import Redis
+
+from indexer.characters import split_character
+
+
+def main():
+    redis_url = sys.argv[1]
+    from_name = sys.argv[2]
+    to_name = sys.argv[3]
+    tag = sys.argv[4]
+
+    redis = Redis.from_url(redis_url)
+
+    def progress(n_moved, total):
+        print("Moved {:d} / {:d} images...".format(n_moved, total))
+
+    # rerunning the same split resumes it if it was interrupted
+    n_moved = split_character(redis, from_name, to_name, tag, progress=progress)
+
+    print(
+        "Moved {:d} images tagged {} from {} to {}".format(
+            n_moved, tag, from_name, to_name
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
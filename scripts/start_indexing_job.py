@@ -8,12 +8,17 @@ def main():
     redis_url = sys.argv[1]
     site = sys.argv[2]
     character = sys.argv[3]
+    full = "--full" in sys.argv[4:]
 
     redis = Redis.from_url(redis_url)
 
     q = Queue("scraper", connection=redis)
     q.enqueue(
-        "indexer.scraper.worker.do_indexing_crawl", site, character, job_timeout="6h"
+        "indexer.scraper.worker.do_indexing_crawl",
+        site,
+        character,
+        full,
+        job_timeout="6h",
     )
     print("Enqueued scraping job for " + site)
 
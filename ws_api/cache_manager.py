@@ -0,0 +1,223 @@
+import os
+import os.path as osp
+import sys
+import time
+
+from redis import Redis
+
+from .img_cache import CACHE_LIVE_KEY, CACHE_STATS_KEY
+
+DEFAULT_MAX_BYTES = 50 * 2 ** 30
+DEFAULT_TTL = 14 * 24 * 3600
+DEFAULT_INTERVAL = 300
+
+# `.part` files older than this are left over from failed downloads
+PARTIAL_FILE_TTL = 3600
+
+EVICT_BATCH_SIZE = 1000
+
+# Removes cache entries (ARGV holds path, last seen access time pairs), unless
+# they were accessed after the sweep read them. Returns the paths that were
+# removed; only their files may be deleted.
+_EVICT_SCRIPT = """
+local evicted = {}
+
+for i = 1, #ARGV, 2 do
+    local score = redis.call("ZSCORE", KEYS[1], ARGV[i])
+
+    if not score or tonumber(score) <= tonumber(ARGV[i + 1]) then
+        redis.call("ZREM", KEYS[1], ARGV[i])
+        evicted[#evicted + 1] = ARGV[i]
+    end
+end
+
+return evicted
+"""
+
+
+class CacheManager(object):
+    """Enforces size and age limits on the image cache directory.
+
+    Each sweep lists the cache directory once, and evicts files in order of
+    last access (their `img_cache:live` scores, as bumped by the API
+    servers): first every file older than `ttl`, then the least recently
+    used files until the cache fits in `max_bytes`. Files that aren't
+    tracked in `img_cache:live` (yet: downloads and recaches register files
+    shortly after writing them) count as last accessed when they were
+    written, and entries for files that no longer exist are dropped.
+
+    Args:
+        redis (redis.Redis): The API server's Redis interface.
+        cache_dir (str): The image cache directory.
+        max_bytes (int): Maximum total size of the cached files.
+        ttl (float): Maximum time since a file was last accessed, in seconds.
+    """
+
+    def __init__(self, redis, cache_dir, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.redis = redis
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._evict_script = redis.register_script(_EVICT_SCRIPT)
+
+    def _list_files(self):
+        """List the cached files.
+
+        Returns:
+            tuple: Dicts mapping paths to sizes, and to modification times
+                (in ms).
+        """
+        files = {}
+        mtimes = {}
+        now = time.time()
+
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+
+                st = entry.stat()
+
+                if entry.name.endswith(".part"):
+                    if now - st.st_mtime > PARTIAL_FILE_TTL:
+                        os.remove(entry.path)
+                    continue
+
+                path = osp.join(self.cache_dir, entry.name)
+                files[path] = st.st_size
+                mtimes[path] = int(st.st_mtime * 1000)
+
+        return files, mtimes
+
+    def _evict(self, paths, scores):
+        evicted = []
+
+        for i in range(0, len(paths), EVICT_BATCH_SIZE):
+            args = []
+            for path in paths[i : i + EVICT_BATCH_SIZE]:
+                args.extend((path, scores[path]))
+
+            evicted.extend(self._evict_script(keys=[CACHE_LIVE_KEY], args=args))
+
+        for path in evicted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        return [p.decode("utf-8") for p in evicted]
+
+    def sweep(self):
+        """Run one eviction pass.
+
+        Returns:
+            dict: Statistics for this pass.
+        """
+        files, mtimes = self._list_files()
+        tracked = dict(
+            (path.decode("utf-8"), int(score))
+            for path, score in self.redis.zscan_iter(CACHE_LIVE_KEY, count=1000)
+        )
+
+        # files can appear between the listing and the scan
+        stale = [p for p in tracked if p not in files and not osp.exists(p)]
+        for i in range(0, len(stale), EVICT_BATCH_SIZE):
+            self.redis.zrem(CACHE_LIVE_KEY, *stale[i : i + EVICT_BATCH_SIZE])
+
+        # untracked files count as accessed when they were written
+        scores = dict((p, tracked.get(p, mtimes[p])) for p in files)
+
+        # least recently used first
+        order = sorted(files, key=lambda p: scores[p])
+        expire_before = (time.time() - self.ttl) * 1000
+        total = sum(files.values())
+
+        to_evict = []
+        for path in order:
+            if scores[path] >= expire_before and total <= self.max_bytes:
+                break
+
+            to_evict.append(path)
+            total -= files[path]
+
+        evicted = self._evict(to_evict, scores)
+        evicted_bytes = sum(files[p] for p in evicted)
+
+        tr = self.redis.pipeline()
+        tr.hincrby(CACHE_STATS_KEY, "evicted_files", len(evicted))
+        tr.hincrby(CACHE_STATS_KEY, "evicted_bytes", evicted_bytes)
+        tr.hset(CACHE_STATS_KEY, "files", len(files) - len(evicted))
+        tr.hset(CACHE_STATS_KEY, "bytes", sum(files.values()) - evicted_bytes)
+        tr.execute()
+
+        return {
+            "files": len(files) - len(evicted),
+            "bytes": sum(files.values()) - evicted_bytes,
+            "evicted_files": len(evicted),
+            "evicted_bytes": evicted_bytes,
+            "stale_entries": len(stale),
+        }
+
+
+def format_stats(stats):
+    """Format the counters in `img_cache:stats`."""
+    stats = dict((k.decode("utf-8"), int(v)) for k, v in stats.items())
+
+    hits = stats.get("hits", 0)
+    requests = hits + stats.get("misses", 0)
+
+    return (
+        "{:d} files ({:.1f} MiB); hit rate {:.1f}% of {:d} requests; "
+        "evicted {:d} files ({:.1f} MiB)"
+    ).format(
+        stats.get("files", 0),
+        stats.get("bytes", 0) / 2 ** 20,
+        100 * hits / requests if requests > 0 else 0,
+        requests,
+        stats.get("evicted_files", 0),
+        stats.get("evicted_bytes", 0) / 2 ** 20,
+    )
+
+
+def main():
+    app_redis_url = sys.argv[1]
+    image_cache_dir = sys.argv[2]
+    max_bytes = DEFAULT_MAX_BYTES
+    ttl = DEFAULT_TTL
+    interval = DEFAULT_INTERVAL
+
+    for arg in sys.argv[3:]:
+        if arg.startswith("--max-mb="):
+            max_bytes = int(arg[len("--max-mb=") :]) * 2 ** 20
+        elif arg.startswith("--ttl="):
+            ttl = float(arg[len("--ttl=") :])
+        elif arg.startswith("--interval="):
+            interval = float(arg[len("--interval=") :])
+
+    manager = CacheManager(
+        Redis.from_url(app_redis_url), image_cache_dir, max_bytes=max_bytes, ttl=ttl
+    )
+
+    print(
+        "Managing {} (max {:.1f} MiB, TTL {:.0f}s, sweeping every {:.0f}s)".format(
+            image_cache_dir, max_bytes / 2 ** 20, ttl, interval
+        )
+    )
+
+    while True:
+        start = time.perf_counter()
+        result = manager.sweep()
+
+        print(
+            "Swept in {:.2f}s: evicted {:d} files ({:.1f} MiB), "
+            "dropped {:d} stale entries".format(
+                time.perf_counter() - start,
+                result["evicted_files"],
+                result["evicted_bytes"] / 2 ** 20,
+                result["stale_entries"],
+            )
+        )
+        print(format_stats(manager.redis.hgetall(CACHE_STATS_KEY)))
+
+        time.sleep(interval)
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import time
+
+from indexer.bitmap import (
+    CHUNK_SIZE,
+    NEXT_ORDINAL_KEY,
+    ORDINAL_IDS_KEY,
+    RoaringBitmap,
+    facet_for_key,
+    intersect,
+    queue_facet_load,
+)
+
+
+class FilterBitmapCache(object):
+    """An in-process cache of facet bitmaps for filtered character queries.
+
+    Bitmaps are loaded from Redis on first use and kept for `ttl` seconds, so
+    multi-facet queries resolve as in-process ANDs and only the IDs for the
+    requested page have to be fetched from Redis.
+
+    Args:
+        ttl (float): How long to keep a loaded bitmap, in seconds.
+        max_facets (int): Maximum number of bitmaps to keep.
+    """
+
+    def __init__(self, ttl=60, max_facets=256):
+        self.ttl = ttl
+        self.max_facets = max_facets
+        self._bitmaps = OrderedDict()
+
+    async def load(self, aredis, facets):
+        """Get the bitmaps for a list of facets, loading any that are missing.
+
+        Returns:
+            A list of `RoaringBitmap`s, one per facet.
+        """
+        now = time.monotonic()
+        missing = []
+
+        for facet in facets:
+            entry = self._bitmaps.get(facet)
+
+            if entry is None or entry[0] < now:
+                missing.append(facet)
+            else:
+                self._bitmaps.move_to_end(facet)
+
+        if len(missing) > 0:
+            n_ordinals = int(await aredis.get(NEXT_ORDINAL_KEY) or 0)
+            n_chunks = (n_ordinals + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+            tr = aredis.pipeline()
+            for facet in missing:
+                queue_facet_load(tr, facet, n_chunks)
+            results = await tr.execute()
+
+            for i, facet in enumerate(missing):
+                bitmap = RoaringBitmap.from_redis_results(
+                    results[2 * n_chunks * i : 2 * n_chunks * (i + 1)]
+                )
+
+                self._bitmaps[facet] = (now + self.ttl, bitmap)
+                self._bitmaps.move_to_end(facet)
+
+            while len(self._bitmaps) > self.max_facets:
+                self._bitmaps.popitem(last=False)
+
+        return [self._bitmaps[facet][1] for facet in facets]
+
+    async def query(self, aredis, keys):
+        """Intersect the bitmaps for a list of index keys.
+
+        Args:
+            aredis (aioredis.Redis): An asynchronous Redis interface.
+            keys (list): Index keys to intersect, such as
+                `index:characters:<name>` or `index:rating:<rating>`.
+
+        Returns:
+            A sorted `int64` ndarray of the matching image ordinals.
+        """
+        bitmaps = await self.load(aredis, [facet_for_key(k) for k in keys])
+        return intersect(bitmaps).to_ordinals()
+
+
+async def ordinals_to_ids(aredis, ordinals):
+    """Look up the image IDs for a list of ordinals."""
+    if len(ordinals) == 0:
+        return []
+
+    return await aredis.hmget(
+        ORDINAL_IDS_KEY, *(int(o) for o in ordinals), encoding="utf-8"
+    )
@@ -1,35 +1,456 @@
+import asyncio
 import io
+import os
 import os.path as osp
 import hashlib
+import secrets
 import time
 
 import aiofiles
 
+from indexer.thumbnails import generate_thumbnail, thumbnail_filename
+
 ALLOWED_FILE_TYPES = ("png", "jpg", "jpeg", "gif")
 
+# cached file paths, scored by last access time (in ms)
+CACHE_LIVE_KEY = "img_cache:live"
+
+# hit/miss and eviction counters
+CACHE_STATS_KEY = "img_cache:stats"
+
+# held by the API worker downloading a file, as `img_cache:lock:<filename>`;
+# the lock's value names the download's `<path>.<token>.part` file, and the
+# lock is renewed every CACHE_LOCK_RENEW_INTERVAL seconds while it runs
+CACHE_LOCK_PREFIX = "img_cache:lock:"
+CACHE_LOCK_TTL = 60 * 1000
+CACHE_LOCK_RENEW_INTERVAL = 15
+
+# upstream reads return whatever has arrived, up to this much, so a large
+# buffer costs no latency and keeps per-chunk overhead (file writes, response
+# writes) low
+DOWNLOAD_CHUNK_SIZE = 2 ** 18
+DOWNLOAD_START_TIMEOUT = 30
+
+# how often readers following an in-progress download check for new data
+TAIL_POLL_INTERVAL = 0.05
+
+_RENEW_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+
+return 0
+"""
+
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+
+return 0
+"""
+
+
+def part_path(path, lock_token):
+    """Get the path a download holding a given lock writes to."""
+    return "{}.{}.part".format(path, lock_token)
+
+
+class CacheAccessLog(object):
+    """Collects image cache accesses in-process, so that access times and
+    hit/miss counts can be written to Redis in one batch per `flush` rather
+    than one command per request.
+    """
+
+    def __init__(self):
+        self.accessed = {}
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, path, hit):
+        self.accessed[path] = int(time.time() * 1000)
+
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    async def flush(self, aredis):
+        accessed, hits, misses = self.accessed, self.hits, self.misses
+        self.accessed, self.hits, self.misses = {}, 0, 0
+
+        if len(accessed) == 0 and hits == 0 and misses == 0:
+            return
+
+        tr = aredis.pipeline()
+
+        if len(accessed) > 0:
+            pairs = []
+            for path, ts in accessed.items():
+                pairs.extend((ts, path))
+
+            # only bump files that are still cached, so that a concurrent
+            # eviction isn't undone
+            tr.zadd(CACHE_LIVE_KEY, *pairs, exist=aredis.ZSET_IF_EXIST)
+
+        tr.hincrby(CACHE_STATS_KEY, "hits", hits)
+        tr.hincrby(CACHE_STATS_KEY, "misses", misses)
+
+        await tr.execute()
+
+
+class ImageDownload(object):
+    """An upstream download running in this process.
+
+    Each chunk is written to the cache file and handed to every subscribed
+    reader as soon as it arrives, so readers don't have to poll the file for
+    new data.
+
+    Args:
+        app: The Sanic app.
+        filename (str): The cache filename.
+        url (str): The upstream URL.
+        lock_token (str): The value of this download's
+            `img_cache:lock:<filename>` lock.
+    """
+
+    def __init__(self, app, filename, url, lock_token):
+        self.app = app
+        self.filename = filename
+        self.url = url
+        self.lock_token = lock_token
+
+        self.path = osp.join(app.config["IMAGE_CACHE_DIR"], filename)
+        self.part_path = part_path(self.path, lock_token)
+
+        self.started = asyncio.Event()
+        self.n_written = 0
+        self.subscribers = []
+        self.task = None
+
+        # set before the final item is published, so that late subscribers
+        # don't wait for it
+        self.finished = False
+        self.error = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def subscribe(self):
+        """Start receiving chunks.
+
+        Returns:
+            tuple: The number of bytes written before this call (which have
+                to be read from the file), and a queue that receives every
+                later chunk, followed by `None` at the end of the download
+                or the exception it failed with. Returns `None` if the
+                download has already finished (see `finished` and `error`).
+        """
+        if self.finished or self.error is not None:
+            return None
+
+        queue = asyncio.Queue()
+        self.subscribers.append(queue)
+
+        return self.n_written, queue
+
+    def _publish(self, item):
+        for queue in self.subscribers:
+            queue.put_nowait(item)
+
+    async def _renew_lock(self):
+        while True:
+            await asyncio.sleep(CACHE_LOCK_RENEW_INTERVAL)
+
+            renewed = await self.app.app_redis.eval(
+                _RENEW_LOCK_SCRIPT,
+                keys=[CACHE_LOCK_PREFIX + self.filename],
+                args=[self.lock_token, CACHE_LOCK_TTL],
+            )
+
+            if not renewed:
+                # another worker may download the file as well now, but into
+                # its own `.part` file
+                print("Lost the cache lock for " + self.filename)
+                return
+
+    async def run(self):
+        """Download the image into the cache.
+
+        The file is written to `<path>.<token>.part` and renamed into place
+        once it is complete, so readers never see a partial file under the
+        final name, and a download that outlives its lock can't collide with
+        the next one. The `.part` file is only created once the upstream
+        server has accepted the request, so that a failed download can still
+        be reported before any response is sent.
+        """
+        renew_task = asyncio.ensure_future(self._renew_lock())
+
+        try:
+            async with self.app.http_session.get(self.url) as resp:
+                if resp.status < 200 or resp.status > 299:
+                    raise OSError(
+                        "Got error " + str(resp.status) + " when fetching " + self.url
+                    )
+
+                cur_ts = int(time.time() * 1000)
+
+                async with aiofiles.open(self.part_path, "wb") as f:
+                    self.started.set()
+
+                    while True:
+                        chunk = await resp.content.read(DOWNLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+
+                        # readers subscribing during the write catch up on
+                        # this chunk from the queue; earlier chunks have to be
+                        # on disk, as they are read back from the file
+                        await f.write(chunk)
+                        await f.flush()
+                        self.n_written += len(chunk)
+                        self._publish(chunk)
+
+            os.replace(self.part_path, self.path)
+            self.finished = True
+            self._publish(None)
+
+            await self.app.app_redis.zadd(CACHE_LIVE_KEY, cur_ts, self.path)
+        except BaseException as e:
+            if osp.exists(self.part_path):
+                os.remove(self.part_path)
+
+            self.error = e
+            self._publish(e)
+            raise
+        finally:
+            renew_task.cancel()
+            self.started.set()
+            await self.app.app_redis.eval(
+                _RELEASE_LOCK_SCRIPT,
+                keys=[CACHE_LOCK_PREFIX + self.filename],
+                args=[self.lock_token],
+            )
+
+        return self.path
+
+
+class PendingImage(object):
+    """An image that is being downloaded into the cache, either by this
+    process or by another API worker.
+
+    Readers of a download in this process get its chunks as they arrive;
+    readers of another worker's download follow its `.part` file until it is
+    renamed into place.
+
+    Args:
+        app: The Sanic app.
+        filename (str): The cache filename.
+        download (ImageDownload): The download, if it is running in this
+            process.
+        lock_token (str): The value of the download's lock, if it is running
+            in another process (or `None` if the lock was already released).
+    """
+
+    def __init__(self, app, filename, download=None, lock_token=None):
+        self.app = app
+        self.filename = filename
+        self.download = download
+
+        if download is not None:
+            lock_token = download.lock_token
+
+        self.lock_token = lock_token
+        self.path = osp.join(app.config["IMAGE_CACHE_DIR"], filename)
+        self.part_path = (
+            part_path(self.path, lock_token) if lock_token is not None else None
+        )
+
+    async def _check_failed(self):
+        """Raise if the download failed before producing a complete file."""
+        if osp.exists(self.path):
+            return
+
+        if self.download is not None:
+            if self.download.error is not None:
+                raise self.download.error
+        else:
+            token = await self.app.app_redis.get(
+                CACHE_LOCK_PREFIX + self.filename, encoding="utf-8"
+            )
+
+            # the other worker gave up (or died) without renaming its file
+            if token is None or token != self.lock_token:
+                if not osp.exists(self.path):
+                    raise OSError("Download of " + self.filename + " failed")
 
-async def download_image(app, filename, url):
-    async with app.http_session.get(url) as resp:
-        if resp.status < 200 or resp.status > 299:
-            raise OSError("Got error " + str(resp.status) + " when fetching " + url)
+    async def wait_started(self, timeout=None):
+        """Wait for the first bytes of the download to be written.
 
-        cur_ts = int(time.time() * 1000)
-        out_path = osp.join(app.config["IMAGE_CACHE_DIR"], filename)
+        Raises:
+            OSError: If the download did not start in time, or failed before
+                any data was written (the download's own error is raised, if
+                it ran in this process).
+        """
+        if timeout is None:
+            timeout = DOWNLOAD_START_TIMEOUT
+
+        if self.download is not None:
+            try:
+                await asyncio.wait_for(self.download.started.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise OSError("Timed out waiting for " + self.filename)
+
+            await self._check_failed()
+            return
+
+        deadline = time.monotonic() + timeout
+
+        while not (
+            (self.part_path is not None and osp.exists(self.part_path))
+            or osp.exists(self.path)
+        ):
+            await self._check_failed()
+
+            if time.monotonic() > deadline:
+                raise OSError("Timed out waiting for " + self.filename)
+
+            await asyncio.sleep(TAIL_POLL_INTERVAL)
+
+    async def wait_complete(self):
+        """Wait for the file to be renamed into place.
+
+        Returns:
+            str: The cache path.
+        """
+        if self.download is not None:
+            return await asyncio.shield(self.download.task)
+
+        while not osp.exists(self.path):
+            await self._check_failed()
+            await asyncio.sleep(TAIL_POLL_INTERVAL)
+
+        return self.path
+
+    async def _open(self):
+        try:
+            if self.part_path is None:
+                raise FileNotFoundError(self.filename)
+
+            return await aiofiles.open(self.part_path, "rb")
+        except FileNotFoundError:
+            # renamed into place since it was checked
+            return await aiofiles.open(self.path, "rb")
+
+    async def _stream_file(self, response, limit=None):
+        """Write the file to a streaming response, following it while it is
+        being downloaded. With `limit`, only that many bytes are written, and
+        the file isn't followed.
+        """
+        f = await self._open()
+
+        try:
+            complete = limit is not None
+            remaining = limit
+
+            while remaining is None or remaining > 0:
+                n = DOWNLOAD_CHUNK_SIZE
+                if remaining is not None:
+                    n = min(n, remaining)
+
+                chunk = await f.read(n)
+
+                if chunk:
+                    await response.write(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    continue
+
+                if complete:
+                    break
+
+                # the file handle follows the rename, so once the final path
+                # exists everything that is left can be read from it
+                if osp.exists(self.path):
+                    complete = True
+                    continue
+
+                await self._check_failed()
+                await asyncio.sleep(TAIL_POLL_INTERVAL)
+        finally:
+            await f.close()
+
+    async def stream(self, response):
+        """Write the image to a streaming response as it is downloaded."""
+        subscription = self.download.subscribe() if self.download is not None else None
+
+        if subscription is None:
+            # the download has already finished, or failed
+            await self._check_failed()
+            await self._stream_file(response)
+            return
+
+        offset, queue = subscription
+
+        try:
+            # catch up on what was written before subscribing
+            if offset > 0:
+                await self._stream_file(response, limit=offset)
 
-        async with aiofiles.open(out_path, "wb") as f:
             while True:
-                chunk = await resp.content.read(128)
-                if not chunk:
+                chunk = await queue.get()
+
+                if chunk is None:
                     break
-                await f.write(chunk)
+                elif isinstance(chunk, BaseException):
+                    raise chunk
 
-        await app.app_redis.zadd("img_cache:live", cur_ts, out_path)
+                await response.write(chunk)
+        finally:
+            self.download.subscribers.remove(queue)
 
-        return out_path
 
+def _forget_download(app, filename, task):
+    app.image_downloads.pop(filename, None)
 
-async def load_indexed_image(app, indexed_image):
-    img_id = str(indexed_image.img_id)
+    if not task.cancelled() and task.exception() is not None:
+        print("Failed to cache {}: {}".format(filename, task.exception()))
+
+
+async def fetch_image(app, filename, url):
+    """Get the download of an uncached image, starting it if no process is
+    downloading it yet.
+
+    Returns:
+        PendingImage: The in-progress download.
+    """
+    download = app.image_downloads.get(filename)
+    if download is not None:
+        return PendingImage(app, filename, download)
+
+    token = secrets.token_hex(8)
+    acquired = await app.app_redis.set(
+        CACHE_LOCK_PREFIX + filename,
+        token,
+        pexpire=CACHE_LOCK_TTL,
+        exist=app.app_redis.SET_IF_NOT_EXIST,
+    )
+
+    if not acquired:
+        token = await app.app_redis.get(CACHE_LOCK_PREFIX + filename, encoding="utf-8")
+        return PendingImage(app, filename, lock_token=token)
+
+    # coroutines in this process that miss the download while the lock is
+    # being acquired follow it through the lock, as other workers do
+    download = ImageDownload(app, filename, url, token)
+    download.start().add_done_callback(lambda t: _forget_download(app, filename, t))
+    app.image_downloads[filename] = download
+
+    return PendingImage(app, filename, download)
+
+
+def _original_filename(indexed_image):
     url = indexed_image.source_url
 
     _, ext = osp.splitext(url)
@@ -40,12 +461,87 @@ async def load_indexed_image(app, indexed_image):
     if ext not in ALLOWED_FILE_TYPES:
         raise ValueError("Invalid filetype " + ext + " for URL " + url)
 
-    filename = img_id + "." + ext
+    return str(indexed_image.img_id) + "." + ext
+
+
+async def load_indexed_image(app, indexed_image):
+    """Get an image from the cache.
+
+    Concurrent misses for the same image, in this process or in other API
+    workers, share a single upstream download.
+
+    Returns:
+        tuple: The cache path, and a `PendingImage` to stream from if the
+            image is still being downloaded (or `None`).
+    """
+    filename = _original_filename(indexed_image)
     path = osp.join(app.config["IMAGE_CACHE_DIR"], filename)
     if osp.isfile(path):
-        return path
+        app.cache_access.record(path, True)
+        return path, None
+
+    pending = await fetch_image(app, filename, indexed_image.source_url)
+    app.cache_access.record(path, False)
+
+    return path, pending
+
 
-    path = await download_image(app, filename, url)
+async def _render_thumbnail(app, indexed_image, path, width, fmt):
+    # the thumbnail request has already been recorded; reading the original
+    # to render it is not an access to the original
+    filename = _original_filename(indexed_image)
+    img_path = osp.join(app.config["IMAGE_CACHE_DIR"], filename)
+    if not osp.isfile(img_path):
+        pending = await fetch_image(app, filename, indexed_image.source_url)
+        await pending.wait_complete()
 
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(
+        app.thumbnail_executor, generate_thumbnail, img_path, path, width, fmt
+    )
+
+    await app.app_redis.zadd(CACHE_LIVE_KEY, int(time.time() * 1000), path)
     return path
 
+
+def _forget_thumbnail(app, filename, future):
+    app.thumbnail_jobs.pop(filename, None)
+
+    if not future.cancelled() and future.exception() is not None:
+        print("Failed to render {}: {}".format(filename, future.exception()))
+
+
+async def load_thumbnail(app, indexed_image, width, fmt):
+    """Get a thumbnail from the cache, rendering it if needed.
+
+    Thumbnails are normally rendered by the backend worker when an image is
+    indexed; missing ones are rendered from the cached original on the
+    app's process pool. Concurrent requests for the same thumbnail in this
+    process share one render, and since thumbnails are written atomically,
+    a render racing one in another worker is merely redundant.
+
+    Args:
+        width (int): A standard thumbnail width.
+        fmt (str): A format name from `indexer.thumbnails.FORMATS`.
+
+    Returns:
+        str: The thumbnail's cache path.
+    """
+    filename = thumbnail_filename(indexed_image.img_id, width, fmt)
+    path = osp.join(app.config["IMAGE_CACHE_DIR"], filename)
+
+    if osp.isfile(path):
+        app.cache_access.record(path, True)
+        return path
+
+    app.cache_access.record(path, False)
+
+    future = app.thumbnail_jobs.get(filename)
+    if future is None:
+        future = asyncio.ensure_future(
+            _render_thumbnail(app, indexed_image, path, width, fmt)
+        )
+        future.add_done_callback(lambda f: _forget_thumbnail(app, filename, f))
+        app.thumbnail_jobs[filename] = future
+
+    return await asyncio.shield(future)
@@ -1,3 +1,5 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 import base64
 import hashlib
 import os
@@ -13,9 +15,18 @@ from redis import Redis
 from rq import Queue
 from sanic import Sanic, exceptions, response
 
-from .img_cache import load_indexed_image
+from .img_cache import CacheAccessLog, load_indexed_image, load_thumbnail
 from indexer.structures import IndexedImage
+from indexer.thumbnails import FORMATS, thumbnail_width
+from indexer.structures.indexed_image import (
+    FILTER_BITMAPS,
+    INVALIDATION_CHANNEL,
+    PACKED_RECORDS,
+)
+from .filter_bitmaps import FilterBitmapCache, ordinals_to_ids
 from .management import bp as management_bp
+from .pagination import Cursor, cursor_page
+from .response_cache import ResponseCache, serve_cached
 
 app = Sanic(load_env="WAIFUSTREAM_")
 app.blueprint(management_bp)
@@ -27,12 +38,36 @@ app.config.update(
         "REDIS_URL": "redis://localhost:6380",
         "INDEX_DB": 0,
         "APP_DB": 1,
+        "RESPONSE_CACHE_SIZE": 4096,
+        "RESPONSE_CACHE_TTL": 600,
+        # query the facet bitmaps; set by WAIFUSTREAM_FILTER_BITMAPS, which
+        # also makes the indexer's writers maintain them (see
+        # `indexed_image.FILTER_BITMAPS`)
+        "FILTER_BITMAPS": FILTER_BITMAPS,
+        # read packed image records; set by WAIFUSTREAM_PACKED_RECORDS, which
+        # the indexer's writers read too (see `indexed_image.PACKED_RECORDS`)
+        "PACKED_RECORDS": PACKED_RECORDS,
+        "FILTER_BITMAP_TTL": 60,
+        "CACHE_ACCESS_FLUSH_INTERVAL": 5,
+        "INVALIDATION_RETRY_INTERVAL": 1,
+        "STREAM_UNCACHED_IMAGES": True,
+        "THUMBNAIL_PROCS": 2,
     }
 )
 
 app.index_redis = None
 app.app_redis = None
 app.scraper_queue = None
+app.pubsub_redis = None
+app.response_cache = None
+app.filter_bitmaps = None
+app.cache_access = None
+app.image_downloads = None
+app.thumbnail_executor = None
+app.thumbnail_jobs = None
+
+# failures of upstream downloads, reported to clients as 502s
+UPSTREAM_ERRORS = (OSError, asyncio.TimeoutError, aiohttp.ClientError)
 
 image_types = {
     "png": "image/png",
@@ -64,30 +99,93 @@ async def init(app, loop):
 
     app.http_session = aiohttp.ClientSession()
 
+    app.response_cache = ResponseCache(
+        max_entries=int(app.config["RESPONSE_CACHE_SIZE"]),
+        ttl=float(app.config["RESPONSE_CACHE_TTL"]),
+    )
+
+    app.filter_bitmaps = FilterBitmapCache(ttl=float(app.config["FILTER_BITMAP_TTL"]))
+
+    app.invalidation_task = loop.create_task(listen_for_invalidations(app))
+
+    app.cache_access = CacheAccessLog()
+    app.image_downloads = {}
+
+    app.thumbnail_executor = ProcessPoolExecutor(
+        max_workers=int(app.config["THUMBNAIL_PROCS"])
+    )
+    app.thumbnail_jobs = {}
+    app.cache_access_task = loop.create_task(flush_cache_access(app))
+
+
+async def listen_for_invalidations(app):
+    """Drop cached responses as index changes are announced.
+
+    If the subscription fails, the error is logged and the listener
+    reconnects. Messages may have been missed in the meantime, so the whole
+    response cache is cleared each time the subscription is (re)established.
+    """
+    retry_interval = float(app.config["INVALIDATION_RETRY_INTERVAL"])
+
+    while True:
+        try:
+            if app.pubsub_redis is None or app.pubsub_redis.closed:
+                app.pubsub_redis = await aioredis.create_redis(
+                    app.config["REDIS_URL"], db=int(app.config["INDEX_DB"])
+                )
+
+            (channel,) = await app.pubsub_redis.subscribe(INVALIDATION_CHANNEL)
+            app.response_cache.clear()
+
+            async for tag in channel.iter(encoding="utf-8"):
+                app.response_cache.invalidate(tag)
+
+            print("Invalidation subscription closed; resubscribing")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Invalidation listener failed: " + str(e))
+
+        if app.pubsub_redis is not None:
+            app.pubsub_redis.close()
+
+        await asyncio.sleep(retry_interval)
+
+
+async def flush_cache_access(app):
+    interval = float(app.config["CACHE_ACCESS_FLUSH_INTERVAL"])
+
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await app.cache_access.flush(app.app_redis)
+        except Exception as e:
+            print("Failed to record image cache accesses: " + str(e))
+
 
 @app.listener("after_server_stop")
 async def teardown(app, loop):
+    app.invalidation_task.cancel()
+    app.cache_access_task.cancel()
+    await app.cache_access.flush(app.app_redis)
+
     app.index_redis.close()
     app.app_redis.close()
 
     await app.index_redis.wait_closed()
     await app.app_redis.wait_closed()
 
+    if app.pubsub_redis is not None:
+        app.pubsub_redis.close()
+        await app.pubsub_redis.wait_closed()
+
     await app.http_session.close()
 
+    app.thumbnail_executor.shutdown()
 
-@app.route("/images/<img_id:int>")
-async def get_index_data(request, img_id):
-    try:
-        indexed_image = await IndexedImage.load_from_index_async(
-            app.index_redis, img_id
-        )
-    except KeyError as e:
-        if e.args[0].startswith("No image"):
-            raise exceptions.NotFound("No image " + str(img_id) + " in index")
-        else:
-            raise e
 
+def serialize_indexed_image(indexed_image):
     data = {
         "img_id": str(indexed_image.img_id),
         "imhash": base64.b64encode(indexed_image.imhash),
@@ -95,14 +193,36 @@ async def get_index_data(request, img_id):
     }
     data.update(attr.asdict(indexed_image.queued_img_data))
 
-    return response.json(data)
+    return data
+
+
+@app.route("/images/<img_id:int>")
+async def get_index_data(request, img_id):
+    cache_key = ("image", img_id)
+    entry = app.response_cache.get(cache_key)
+
+    if entry is None:
+        try:
+            indexed_image = await IndexedImage.load_from_index_async(
+                app.index_redis, img_id, packed=app.config["PACKED_RECORDS"]
+            )
+        except KeyError as e:
+            if e.args[0].startswith("No image"):
+                raise exceptions.NotFound("No image " + str(img_id) + " in index")
+            else:
+                raise e
+
+        body = response.json(serialize_indexed_image(indexed_image)).body
+        entry = app.response_cache.put(cache_key, body, tags=("image:" + str(img_id),))
+
+    return serve_cached(request, entry)
 
 
 @app.route("/image/<img_id:int>")
 async def get_image_route(request, img_id):
     try:
         indexed_image = await IndexedImage.load_from_index_async(
-            app.index_redis, img_id
+            app.index_redis, img_id, packed=app.config["PACKED_RECORDS"]
         )
     except KeyError as e:
         if e.args[0].startswith("No image"):
@@ -110,10 +230,55 @@ async def get_image_route(request, img_id):
         else:
             raise e
 
-    img_path = await load_indexed_image(app, indexed_image)
+    if "w" in request.args:
+        return await get_thumbnail(request, indexed_image)
+
+    img_path, pending = await load_indexed_image(app, indexed_image)
     _, ext = osp.splitext(img_path)
 
-    return await response.file_stream(img_path, mime_type=image_types[ext[1:]])
+    if pending is None:
+        return await response.file_stream(img_path, mime_type=image_types[ext[1:]])
+
+    try:
+        if not app.config["STREAM_UNCACHED_IMAGES"]:
+            await pending.wait_complete()
+            return await response.file_stream(
+                img_path, mime_type=image_types[ext[1:]]
+            )
+
+        await pending.wait_started()
+    except UPSTREAM_ERRORS as e:
+        raise exceptions.ServerError(str(e) or repr(e), status_code=502)
+
+    # send upstream bytes to the client as they arrive
+    return response.stream(pending.stream, content_type=image_types[ext[1:]])
+
+
+async def get_thumbnail(request, indexed_image):
+    try:
+        width = thumbnail_width(int(request.args["w"][0]))
+    except ValueError:
+        raise exceptions.InvalidUsage("Width argument must be an integer")
+
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+
+    if "format" in request.args:
+        fmt = request.args["format"][0]
+        if fmt not in FORMATS:
+            raise exceptions.InvalidUsage(
+                "Format argument must be one of: " + ", ".join(FORMATS)
+            )
+    else:
+        # serve WebP to clients that accept it
+        fmt = "webp" if "image/webp" in request.headers.get("Accept", "") else "jpeg"
+        headers["Vary"] = "Accept"
+
+    try:
+        path = await load_thumbnail(app, indexed_image, width, fmt)
+    except UPSTREAM_ERRORS as e:
+        raise exceptions.ServerError(str(e) or repr(e), status_code=502)
+
+    return await response.file_stream(path, mime_type=FORMATS[fmt][2], headers=headers)
 
 
 @app.route("/characters")
@@ -159,6 +324,37 @@ async def get_character_images_route(request, character):
 
     start_index = page * count
 
+    order = request.args.get("order", "asc")
+    if order not in ("asc", "desc"):
+        raise exceptions.InvalidUsage("Order argument must be 'asc' or 'desc'")
+
+    cursor = None
+    if "cursor" in request.args:
+        token = request.args["cursor"][0]
+
+        if token == "start":
+            cursor = Cursor.start(reverse=(order == "desc"))
+        else:
+            try:
+                cursor = Cursor.decode(token)
+            except ValueError:
+                raise exceptions.InvalidUsage("Malformed cursor")
+
+    cache_key = (
+        "character",
+        character,
+        page if cursor is None else cursor,
+        count,
+        tuple(
+            (arg, tuple(sorted(request.args.get(arg, []))))
+            for arg in ("tag", "author", "site", "rating")
+        ),
+    )
+
+    entry = app.response_cache.get(cache_key)
+    if entry is not None:
+        return serve_cached(request, entry)
+
     if not (await app.index_redis.exists("index:characters:" + character) > 0):
         raise exceptions.NotFound("No character " + character + " found in index")
 
@@ -176,7 +372,33 @@ async def get_character_images_route(request, character):
     if "rating" in request.args:
         filter_sets.extend("index:rating:" + r for r in request.args["rating"])
 
-    if len(filter_sets) > 0:
+    headers = {}
+
+    if cursor is not None:
+        ids, next_cursor = await cursor_page(
+            app.index_redis,
+            ["index:characters:" + character] + filter_sets,
+            cursor,
+            count,
+        )
+
+        if next_cursor is not None:
+            headers["X-Next-Cursor"] = next_cursor.encode()
+
+        if len(filter_sets) == 0:
+            headers["X-Total-Items"] = await app.index_redis.zcard(
+                "index:characters:" + character
+            )
+    elif len(filter_sets) > 0 and app.config["FILTER_BITMAPS"]:
+        ordinals = await app.filter_bitmaps.query(
+            app.index_redis, ["index:characters:" + character] + filter_sets
+        )
+
+        headers["X-Total-Items"] = len(ordinals)
+        ids = await ordinals_to_ids(
+            app.index_redis, ordinals[start_index : start_index + count + 1]
+        )
+    elif len(filter_sets) > 0:
         filter_sets.insert(0, "index:characters:" + character)
 
         h = hashlib.sha1()
@@ -189,12 +411,14 @@ async def get_character_images_route(request, character):
 
         await app.index_redis.expire(dest_key, 15 * 60)
 
-        total = await app.index_redis.zcard(dest_key)
+        headers["X-Total-Items"] = await app.index_redis.zcard(dest_key)
         ids = await app.index_redis.zrange(
             dest_key, start_index, start_index + count, encoding="utf-8"
         )
     else:
-        total = await app.index_redis.zcard("index:characters:" + character)
+        headers["X-Total-Items"] = await app.index_redis.zcard(
+            "index:characters:" + character
+        )
         ids = await app.index_redis.zrange(
             "index:characters:" + character,
             start_index,
@@ -202,22 +426,21 @@ async def get_character_images_route(request, character):
             encoding="utf-8",
         )
 
-    resp = []
-    for img_id in ids:
-        indexed_image = await IndexedImage.load_from_index_async(
-            app.index_redis, int(img_id)
-        )
-
-        index_data = {
-            "img_id": str(indexed_image.img_id),
-            "imhash": base64.b64encode(indexed_image.imhash),
-            "cache_path": "image/" + indexed_image.cache_filename,
-        }
-        index_data.update(attr.asdict(indexed_image.queued_img_data))
-
-        resp.append(index_data)
+    indexed_images = await IndexedImage.load_many_async(
+        app.index_redis, ids, packed=app.config["PACKED_RECORDS"]
+    )
+    resp = [serialize_indexed_image(indexed_image) for indexed_image in indexed_images]
+
+    body = response.json(resp).body
+    entry = app.response_cache.put(
+        cache_key,
+        body,
+        headers=headers,
+        tags=["character:" + character]
+        + ["image:" + str(img.img_id) for img in indexed_images],
+    )
 
-    return response.json(resp, headers={"X-Total-Items": total})
+    return serve_cached(request, entry)
 
 
 def main():
@@ -44,11 +44,15 @@ async def index_characters_route(request, character):
 
     character = character.lower()
 
+    # re-crawl every post instead of only those newer than the last crawl
+    full = request.args.get("full", "false").lower() in ("1", "true")
+
     for site in request.json:
         request.app.scraper_queue.enqueue(
             "indexer.scraper.worker.do_indexing_crawl",
             site,
             character,
+            full,
             job_timeout="6h",
         )
 
@@ -0,0 +1,202 @@
+import base64
+import binascii
+
+import attr
+
+# filter keys holding plain sets rather than sorted sets
+SET_KEY_PREFIXES = ("index:sites:", "index:rating:")
+
+
+@attr.s(frozen=True, slots=True)
+class Cursor(object):
+    """A position within a score-ordered sorted set.
+
+    A cursor points just past the member `last_member` with score `score`,
+    so it stays valid as other members are added or removed. Members with
+    equal scores are ordered lexicographically, as Redis orders them.
+    """
+
+    reverse: bool = attr.ib(converter=bool)
+    score: float = attr.ib(converter=float)
+    last_member: str = attr.ib(default=None)
+
+    @classmethod
+    def start(cls, reverse=False):
+        return cls(reverse=reverse, score=float("inf") if reverse else float("-inf"))
+
+    def encode(self):
+        """Encode this cursor as an opaque URL-safe token."""
+        data = "{}:{!r}:{}".format(
+            "d" if self.reverse else "a", self.score, self.last_member or ""
+        )
+
+        return base64.urlsafe_b64encode(data.encode("utf-8")).decode("utf-8")
+
+    @classmethod
+    def decode(cls, token):
+        """Decode a token produced by `encode`.
+
+        Raises:
+            ValueError: If the token is malformed.
+        """
+        try:
+            data = base64.urlsafe_b64decode(token.encode("utf-8")).decode("utf-8")
+            direction, score, last_member = data.split(":", 2)
+        except (binascii.Error, UnicodeError):
+            raise ValueError("Malformed cursor")
+
+        if direction not in ("a", "d"):
+            raise ValueError("Malformed cursor")
+
+        return cls(
+            reverse=(direction == "d"), score=score, last_member=last_member or None
+        )
+
+    def seen(self, member, score):
+        """Check whether a member lies at or before this cursor."""
+        if self.last_member is None or score != self.score:
+            return False
+
+        if self.reverse:
+            return member >= self.last_member
+        return member <= self.last_member
+
+    def advance(self, member, score):
+        return Cursor(reverse=self.reverse, score=score, last_member=member)
+
+
+async def iter_from_cursor(aredis, key, cursor, chunk_size=100):
+    """Iterate over a sorted set, starting just after a cursor.
+
+    Members are fetched with ZRANGEBYSCORE (or ZREVRANGEBYSCORE) starting at
+    the cursor's score, `chunk_size` members at a time.
+
+    Yields:
+        (member, score) tuples, with members decoded as UTF-8.
+    """
+    offset = 0
+
+    while True:
+        if cursor.reverse:
+            items = await aredis.zrevrangebyscore(
+                key,
+                max=cursor.score,
+                withscores=True,
+                offset=offset,
+                count=chunk_size,
+                encoding="utf-8",
+            )
+        else:
+            items = await aredis.zrangebyscore(
+                key,
+                min=cursor.score,
+                withscores=True,
+                offset=offset,
+                count=chunk_size,
+                encoding="utf-8",
+            )
+
+        offset += len(items)
+
+        for member, score in items:
+            if not cursor.seen(member, score):
+                yield member, score
+
+        if len(items) < chunk_size:
+            return
+
+
+async def filter_members(aredis, members, filter_keys):
+    """Check which members belong to every one of a list of filter keys.
+
+    Returns:
+        A list of bools, one per member.
+    """
+    if len(filter_keys) == 0:
+        return [True] * len(members)
+
+    is_set = [key.startswith(SET_KEY_PREFIXES) for key in filter_keys]
+    tr = aredis.pipeline()
+
+    for member in members:
+        for key, key_is_set in zip(filter_keys, is_set):
+            if key_is_set:
+                tr.sismember(key, member)
+            else:
+                tr.zscore(key, member)
+
+    results = await tr.execute()
+    n = len(filter_keys)
+
+    return [
+        all(
+            bool(r) if key_is_set else r is not None
+            for r, key_is_set in zip(results[i * n : (i + 1) * n], is_set)
+        )
+        for i in range(len(members))
+    ]
+
+
+async def cursor_page(aredis, keys, cursor, count):
+    """Fetch one page of the intersection of several index keys.
+
+    The intersection is computed lazily: the smallest sorted set among
+    `keys` is walked from the cursor in chunks, and each chunk's members are
+    checked against the remaining keys with one pipelined round trip, until
+    the page is full.
+
+    Args:
+        aredis (aioredis.Redis): An asynchronous Redis interface.
+        keys (list): Keys to intersect. The first key must be a sorted set
+            scored by image timestamp.
+        cursor (Cursor): Where to start the page.
+        count (int): Maximum number of IDs to return.
+
+    Returns:
+        A tuple of (ids, next_cursor). `next_cursor` is `None` once the
+        intersection is exhausted.
+    """
+    zset_keys = [k for k in keys if not k.startswith(SET_KEY_PREFIXES)]
+
+    if len(zset_keys) > 1:
+        tr = aredis.pipeline()
+        for key in zset_keys:
+            tr.zcard(key)
+        cards = await tr.execute()
+
+        driver = zset_keys[cards.index(min(cards))]
+    else:
+        driver = keys[0]
+
+    filter_keys = [k for k in keys if k != driver]
+    chunk_size = max(count, 1) * (2 if len(filter_keys) > 0 else 1) + 1
+
+    ids = []
+    chunk = []
+
+    async def flush():
+        nonlocal cursor
+
+        matches = await filter_members(aredis, [m for m, _ in chunk], filter_keys)
+        for (member, score), matched in zip(chunk, matches):
+            if len(ids) >= count:
+                return True
+
+            cursor = cursor.advance(member, score)
+            if matched:
+                ids.append(member)
+
+        return False
+
+    async for item in iter_from_cursor(aredis, driver, cursor, chunk_size):
+        chunk.append(item)
+
+        if len(chunk) >= chunk_size:
+            if await flush():
+                return ids, cursor
+            chunk = []
+
+    if await flush():
+        return ids, cursor
+
+    return ids, None
@@ -0,0 +1,141 @@
+from collections import OrderedDict
+import hashlib
+import time
+
+import attr
+from sanic import response
+
+
+@attr.s(slots=True)
+class CachedResponse(object):
+    """A serialized response body, along with the headers sent with it."""
+
+    body: bytes = attr.ib()
+    headers: dict = attr.ib()
+    tags: tuple = attr.ib(converter=tuple)
+    expires: float = attr.ib()
+    etag: str = attr.ib()
+
+    @etag.default
+    def compute_etag(self):
+        return '"' + hashlib.sha1(self.body).hexdigest() + '"'
+
+
+class ResponseCache(object):
+    """An in-process LRU cache of serialized JSON responses.
+
+    Entries are tagged (for instance with `image:<id>` or `character:<name>`)
+    so that they can be invalidated when the underlying index data changes,
+    and expire after `ttl` seconds regardless.
+
+    Args:
+        max_entries (int): Maximum number of responses to keep.
+        ttl (float): Maximum age of a cached response, in seconds.
+    """
+
+    def __init__(self, max_entries=4096, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._tagged = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+
+        for tag in entry.tags:
+            keys = self._tagged.get(tag)
+            if keys is None:
+                continue
+
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._tagged[tag]
+
+    def get(self, key):
+        """Get a cached response.
+
+        Returns:
+            CachedResponse: The cached response, or `None` if there is no
+                live entry for this key.
+        """
+        entry = self._entries.get(key)
+
+        if entry is None or entry.expires < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return entry
+
+    def put(self, key, body, headers=None, tags=()):
+        """Cache a serialized response.
+
+        Args:
+            key: A hashable cache key.
+            body (bytes): The serialized response body.
+            headers (dict): Extra headers to send with the cached response.
+            tags (iterable): Invalidation tags for this entry.
+
+        Returns:
+            CachedResponse: The new cache entry.
+        """
+        if key in self._entries:
+            self._remove(key)
+
+        entry = CachedResponse(
+            body=body,
+            headers=dict(headers or {}),
+            tags=tags,
+            expires=time.monotonic() + self.ttl,
+        )
+
+        self._entries[key] = entry
+        for tag in entry.tags:
+            self._tagged.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+        return entry
+
+    def invalidate(self, tag):
+        """Drop every entry with a given tag."""
+        for key in list(self._tagged.get(tag, ())):
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._tagged.clear()
+
+
+def etag_matches(request, etag):
+    """Check whether a request's `If-None-Match` header matches an ETag."""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is None:
+        return False
+
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or ("W/" + etag) in tags
+
+
+def serve_cached(request, entry, content_type="application/json"):
+    """Build a response for a cache entry, honoring `If-None-Match`."""
+    headers = dict(entry.headers)
+    headers["ETag"] = entry.etag
+
+    if etag_matches(request, entry.etag):
+        return response.raw(b"", status=304, headers=headers)
+
+    return response.raw(entry.body, headers=headers, content_type=content_type)